@@ -0,0 +1,20 @@
+"""
+ASGI config for budgetbuddy project.
+
+It exposes the ASGI callable as a module-level variable named
+``application``. The hot read endpoints are served by async views, see
+budgetbuddy.async_views, e.g.:
+
+    uvicorn budgetbuddy.asgi:application --workers 4
+"""
+
+import os
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'budgetbuddy.settings')
+django.setup(set_prefix=False)
+
+from budgetbuddy.async_views import BudgetBuddyASGIHandler  # noqa: E402
+
+application = BudgetBuddyASGIHandler()
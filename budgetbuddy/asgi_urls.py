@@ -0,0 +1,22 @@
+"""
+URLs of the ASGI deployment: the hot read endpoints are served by async
+views, see budgetbuddy.async_views, the rest by ROOT_URLCONF.
+"""
+from django.conf import settings
+from django.urls import path, include
+
+from budgetbuddy.async_views import async_view
+from budgetplanner.api.views import CategoryTypeViewSet, CategoryViewSet
+from profiles.api.views import ProfileAPIViewSet
+
+urlpatterns = [
+    path('api/bp/category-types/', async_view(
+        CategoryTypeViewSet, {'get': 'list', 'post': 'create'})),
+    path('api/bp/categories/', async_view(
+        CategoryViewSet, {'get': 'list', 'post': 'create',
+                          'patch': 'partial_bulk_update'})),
+    path('api/accounts/profiles/<str:user__username>/', async_view(
+        ProfileAPIViewSet, {'get': 'retrieve', 'put': 'update',
+                            'patch': 'partial_update'})),
+    path('', include(settings.ROOT_URLCONF)),
+]
@@ -0,0 +1,77 @@
+"""
+ASGI support: the async views of the hot read endpoints and the ASGI
+handler serving them.
+
+The ORM and DRF are synchronous. The async views run the DRF viewset of
+the endpoint with database_sync_to_async, in a pool of threads, instead of
+Django's single thread for sync code under ASGI, so concurrent requests
+wait on the database in parallel without a WSGI thread each.
+
+The ASGI handler resolves requests with budgetbuddy.asgi_urls, which routes
+the hot endpoints to the async views and everything else to ROOT_URLCONF,
+WSGI deployments keep the sync views.
+"""
+
+import functools
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIHandler
+from django.db import close_old_connections
+
+from budgetbuddy.middleware import execute_wrappers
+
+
+ASGI_URLCONF = 'budgetbuddy.asgi_urls'
+
+
+def database_sync_to_async(func):
+    '''
+    Run func in a worker thread of the sync_to_async executor. The thread
+    keeps its database connections between calls, connections that are
+    broken or past CONN_MAX_AGE are closed before and after func as at the
+    start and end of a request.
+    '''
+    @functools.wraps(func)
+    def run(*args, **kwargs):
+        close_old_connections()
+        try:
+            with execute_wrappers():
+                return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+    return sync_to_async(run, thread_sensitive=False)
+
+
+def async_view(viewset, actions, **initkwargs):
+    '''
+    Return an async view running the actions of a DRF viewset, e.g.
+    async_view(CategoryViewSet, {'get': 'list', 'post': 'create'}).
+    '''
+    sync_view = viewset.as_view(actions, **initkwargs)
+
+    def render_view(request, *args, **kwargs):
+        response = sync_view(request, *args, **kwargs)
+        if hasattr(response, 'render'):
+            # Render in the worker thread rather than in the handler
+            response.render()
+        return response
+
+    run = database_sync_to_async(render_view)
+
+    async def view(request, *args, **kwargs):
+        return await run(request, *args, **kwargs)
+
+    view.cls = viewset
+    view.actions = actions
+    view.initkwargs = initkwargs
+    view.csrf_exempt = True
+    return view
+
+
+class BudgetBuddyASGIHandler(ASGIHandler):
+
+    def create_request(self, scope, body_file):
+        request, error_response = super().create_request(scope, body_file)
+        if request is not None:
+            request.urlconf = ASGI_URLCONF
+        return request, error_response
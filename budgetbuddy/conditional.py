@@ -0,0 +1,82 @@
+"""
+Conditional GET support for the budgetbuddy API views.
+
+Views compute a cheap validator (a last modified time and change counters)
+before running the queryset and serializer, answer 304 Not Modified when the
+client copy is still current and otherwise add ETag and Last-Modified
+headers to the response.
+"""
+
+import hashlib
+
+from django.utils.http import http_date, parse_etags, parse_http_date_safe
+from django.utils.http import quote_etag
+
+from rest_framework import status
+from rest_framework.response import Response
+
+
+class ConditionalGetMixin:
+    '''
+    Add ETag / Last-Modified handling to the list and retrieve actions.
+    Subclasses implement get_last_modified() and may add values that change
+    on every write, e.g. row counts or version counters, with
+    get_etag_parts().
+    '''
+
+    def get_last_modified(self):
+        raise NotImplementedError
+
+    def get_etag_parts(self):
+        return []
+
+    def get_validators(self, request):
+        last_modified = self.get_last_modified()
+        parts = [type(self).__name__, self.action, request.user.pk,
+                 sorted(self.kwargs.items()),
+                 request.META.get('QUERY_STRING', ''),
+                 last_modified and last_modified.isoformat()]
+        parts += self.get_etag_parts()
+        etag = quote_etag(hashlib.sha1(repr(parts).encode()).hexdigest())
+        return etag, last_modified
+
+    def is_not_modified(self, request, etag, last_modified):
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            etags = parse_etags(if_none_match)
+            return '*' in etags or etag in etags
+
+        if_modified_since = parse_http_date_safe(
+            request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+        if if_modified_since and last_modified:
+            return int(last_modified.timestamp()) <= if_modified_since
+        return False
+
+    def conditional_response(self, handler, request, *args, **kwargs):
+        etag, last_modified = self.get_validators(request)
+        if self.is_not_modified(request, etag, last_modified):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = handler(request, *args, **kwargs)
+
+        if response.status_code in (status.HTTP_200_OK,
+                                    status.HTTP_304_NOT_MODIFIED):
+            response['ETag'] = etag
+            if last_modified:
+                response['Last-Modified'] = http_date(
+                    last_modified.timestamp())
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional_response(
+            super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        # Missing and forbidden objects are answered before the
+        # preconditions, If-None-Match: * only matches an existing object
+        instance = self.get_object()
+
+        def handler(request, *args, **kwargs):
+            return Response(self.get_serializer(instance).data)
+
+        return self.conditional_response(handler, request, *args, **kwargs)
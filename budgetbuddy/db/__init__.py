@@ -0,0 +1,3 @@
+"""
+Database backends selected by the database profiles in budgetbuddy.settings.
+"""
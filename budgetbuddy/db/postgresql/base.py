@@ -0,0 +1,141 @@
+"""
+PostgreSQL backend returning closed connections to a per process pool.
+
+Use with CONN_MAX_AGE = 0: Django closes the connection at the end of every
+request and the next request, from any thread, reuses an idle pooled
+connection instead of opening a new one. OPTIONS['pool'] accepts
+max_idle, the number of idle connections kept per database, and
+max_idle_time, the seconds after which an idle connection is discarded.
+
+Pools are keyed by the connection parameters, so a wrapper whose NAME
+changes, e.g. by create_test_db(), never gets a connection to the previous
+database. Connections are closed for real when the settings changed since
+they were opened, and the pooled connections of a test database are closed
+before it is dropped.
+"""
+
+import copy
+import threading
+import time
+
+from django.db.backends.postgresql import base, creation
+from psycopg2 import extensions
+
+
+class ConnectionPool:
+    '''
+    LIFO stack of idle psycopg2 connections.
+    '''
+
+    def __init__(self, max_idle=10, max_idle_time=300):
+        self.max_idle = max_idle
+        self.max_idle_time = max_idle_time
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        '''
+        Return an idle connection or None.
+        '''
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                connection, returned_at = self._idle.pop()
+            if not connection.closed and \
+                    time.monotonic() - returned_at < self.max_idle_time:
+                return connection
+            connection.close()
+
+    def put(self, connection):
+        '''
+        Keep connection for reuse, return False if it has to be closed.
+        '''
+        if connection.closed:
+            return False
+        status = connection.info.transaction_status
+        if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if status != extensions.TRANSACTION_STATUS_IDLE:
+            connection.rollback()
+        with self._lock:
+            if len(self._idle) >= self.max_idle:
+                return False
+            self._idle.append((connection, time.monotonic()))
+        return True
+
+    def __len__(self):
+        return len(self._idle)
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection, _ in idle:
+            connection.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool_key(params):
+    # Host, port, database, user and options, the password can't change
+    # where a connection goes
+    return tuple(sorted((name, repr(value)) for name, value in params.items()
+                        if name != 'password'))
+
+
+def get_pool(params, options):
+    key = get_pool_key(params)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(**options)
+        return _pools[key]
+
+
+def close_pools(database):
+    '''
+    Close the idle connections to database, e.g. before dropping it.
+    '''
+    with _pools_lock:
+        pools = [pool for key, pool in _pools.items()
+                 if ('database', repr(database)) in key]
+    for pool in pools:
+        pool.clear()
+
+
+class DatabaseCreation(creation.DatabaseCreation):
+
+    def _destroy_test_db(self, test_database_name, verbosity):
+        close_pools(test_database_name)
+        super()._destroy_test_db(test_database_name, verbosity)
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    creation_class = DatabaseCreation
+
+    def get_connection_params(self):
+        params = super().get_connection_params()
+        # Not an argument of psycopg2.connect()
+        options = params.pop('pool', {})
+        self.pool = get_pool(params, options)
+        self.pool_settings = copy.deepcopy(self.settings_dict)
+        return params
+
+    def get_new_connection(self, conn_params):
+        connection = self.pool.get()
+        if connection is None:
+            return super().get_new_connection(conn_params)
+        # Set up by the first get_new_connection() of the connection
+        self.isolation_level = self.settings_dict['OPTIONS'].get(
+            'isolation_level', connection.isolation_level)
+        return connection
+
+    def _close(self):
+        if self.connection is not None:
+            with self.wrap_database_errors:
+                # Not reusable when NAME or another setting was changed
+                if self.settings_dict != self.pool_settings or \
+                        not self.pool.put(self.connection):
+                    self.connection.close()
@@ -0,0 +1,114 @@
+"""
+Read replica routing.
+
+ReplicaMiddleware runs the reads of safe (GET, HEAD, OPTIONS) requests on
+the DATABASE_REPLICA['ALIAS'] database, ReplicaRouter sends everything else
+to the primary. After a client writes, its reads stay on the primary for
+STICKY_SECONDS so it reads its own writes despite the replication lag.
+
+Clients are told apart by their Authorization header or session cookie,
+hashed, as the user is only authenticated by DRF in the view. The pins are
+stored in the DATABASE_REPLICA['CACHE'] cache, which has to be shared by the
+worker processes, a local memory cache is refused. Logins and sign ups have
+no credentials to pin yet, so tokens and users are always read from the
+primary, a token is usable as soon as it is issued.
+"""
+
+import contextvars
+import hashlib
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured, MiddlewareNotUsed
+from django.db import DEFAULT_DB_ALIAS
+
+from budgetbuddy.middleware import HybridMiddleware
+
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_read_alias = contextvars.ContextVar('read_alias', default=None)
+
+
+@contextmanager
+def read_from(alias):
+    '''
+    Route the reads of the block to alias, None for the primary.
+    '''
+    token = _read_alias.set(alias)
+    try:
+        yield
+    finally:
+        _read_alias.reset(token)
+
+
+def get_primary_models():
+    # Authentication reads the token and its user
+    return {'authtoken.token', settings.AUTH_USER_MODEL.lower()}
+
+
+class ReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        if model._meta.label_lower in get_primary_models():
+            return None
+        return _read_alias.get()
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica holds the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+def get_client_key(request):
+    '''
+    Return a cache key identifying the client making the request, or None
+    for anonymous requests.
+    '''
+    credentials = request.META.get('HTTP_AUTHORIZATION') or \
+        request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+    if not credentials:
+        return None
+    digest = hashlib.sha1(credentials.encode()).hexdigest()
+    return f'budgetbuddy:replica-pin:{digest}'
+
+
+class ReplicaMiddleware(HybridMiddleware):
+
+    def __init__(self, get_response):
+        options = settings.DATABASE_REPLICA
+        if not options['ALIAS']:
+            raise MiddlewareNotUsed
+        super().__init__(get_response)
+        self.alias = options['ALIAS']
+        self.sticky_seconds = options['STICKY_SECONDS']
+        self.cache = caches[options['CACHE']]
+        if isinstance(self.cache, LocMemCache):
+            raise ImproperlyConfigured(
+                "DATABASE_REPLICA['CACHE'] has to be shared by the worker "
+                "processes, not a local memory cache")
+
+    def wrap(self, request):
+        key = get_client_key(request)
+        if request.method not in SAFE_METHODS:
+            if key is not None:
+                # Pinned before the write for concurrent reads and again
+                # after it so the window starts once the write is committed
+                self.cache.set(key, True, self.sticky_seconds)
+            return read_from(None)
+
+        pinned = key is not None and self.cache.get(key, False)
+        return read_from(None if pinned else self.alias)
+
+    def process_response(self, request, response, state):
+        key = get_client_key(request)
+        if request.method not in SAFE_METHODS and key is not None:
+            self.cache.set(key, True, self.sticky_seconds)
+        return response
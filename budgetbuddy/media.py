@@ -0,0 +1,161 @@
+"""
+Serving of the uploaded media files.
+
+serve_media() answers conditional requests (If-None-Match,
+If-Modified-Since) and single byte ranges itself. Full files are returned as
+a FileResponse, which WSGI servers send with their wsgi.file_wrapper, i.e.
+sendfile(). With MEDIA_SERVING['OFFLOAD'] set to 'x-accel-redirect' (nginx)
+or 'x-sendfile' (Apache, lighttpd) only the headers are produced and the
+front server streams the bytes, ranges included, so no worker is held while
+the file is sent.
+
+Paths matching MEDIA_SERVING['IMMUTABLE'] are content addressed, e.g. the
+avatars named after their SHA-256, and are cached for a year.
+"""
+
+import mimetypes
+import os
+import re
+import stat
+
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse
+from django.http import HttpResponseNotModified, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.http import http_date, parse_etags, quote_etag
+from django.views.static import was_modified_since
+
+
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+CHUNK_SIZE = 64 * 1024
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range(header, size):
+    '''
+    Return the (start, end) byte positions, end included, of a single
+    range Range header or None for headers that are ignored: invalid or
+    multiple ranges.
+    '''
+    match = RANGE.match(header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    start, end = match.groups()
+    if not start:
+        # Suffix range: the last bytes of the file
+        length = int(end)
+        if not length or not size:
+            raise RangeNotSatisfiable
+        return max(size - length, 0), size - 1
+    start = int(start)
+    if end and int(end) < start:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable
+    end = min(int(end), size - 1) if end else size - 1
+    return start, end
+
+
+def iter_range(path, start, length):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def get_cache_control(path):
+    options = settings.MEDIA_SERVING
+    if any(re.match(pattern, path) for pattern in options['IMMUTABLE']):
+        return f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+    return f'public, max-age={options["MAX_AGE"]}'
+
+
+def offload(path, fullpath):
+    response = HttpResponse()
+    mode = settings.MEDIA_SERVING['OFFLOAD']
+    if mode == 'x-accel-redirect':
+        response['X-Accel-Redirect'] = \
+            settings.MEDIA_SERVING['INTERNAL_PREFIX'] + path
+    elif mode == 'x-sendfile':
+        response['X-Sendfile'] = fullpath
+    else:
+        raise ValueError(f'Unknown media offload {mode}')
+    # Set by the front server from the file
+    del response['Content-Type']
+    return response
+
+
+def serve_media(request, path):
+    try:
+        fullpath = safe_join(settings.MEDIA_ROOT, path)
+        stats = os.stat(fullpath)
+    except (ValueError, OSError):
+        # ValueError: outside of MEDIA_ROOT
+        raise Http404
+    if not stat.S_ISREG(stats.st_mode):
+        raise Http404
+
+    size = stats.st_size
+    etag = quote_etag(f'{int(stats.st_mtime)}-{size}')
+    last_modified = http_date(stats.st_mtime)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': last_modified,
+        'Cache-Control': get_cache_control(path),
+    }
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        not_modified = etag in parse_etags(if_none_match) or \
+            if_none_match.strip() == '*'
+    else:
+        not_modified = not was_modified_since(
+            request.META.get('HTTP_IF_MODIFIED_SINCE'), stats.st_mtime)
+    if not_modified:
+        response = HttpResponseNotModified()
+    elif settings.MEDIA_SERVING['OFFLOAD']:
+        response = offload(path, fullpath)
+    else:
+        response = file_response(request, fullpath, size,
+                                 [etag, last_modified])
+
+    for name, value in headers.items():
+        response[name] = value
+    return response
+
+
+def file_response(request, fullpath, size, validators):
+    content_type = mimetypes.guess_type(fullpath)[0] or \
+        'application/octet-stream'
+    byte_range = None
+    range_header = request.META.get('HTTP_RANGE')
+    if_range = request.META.get('HTTP_IF_RANGE')
+    # A stale If-Range asks for the whole, changed, file
+    if range_header and (not if_range or if_range in validators):
+        try:
+            byte_range = parse_range(range_header, size)
+        except RangeNotSatisfiable:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+
+    if byte_range is None:
+        response = FileResponse(open(fullpath, 'rb'),
+                                content_type=content_type)
+    else:
+        start, end = byte_range
+        response = StreamingHttpResponse(
+            iter_range(fullpath, start, end - start + 1), status=206,
+            content_type=content_type)
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Content-Length'] = end - start + 1
+    response['Accept-Ranges'] = 'bytes'
+    return response
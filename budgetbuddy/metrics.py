@@ -0,0 +1,300 @@
+"""
+In-process request metrics exposed in the Prometheus text format.
+
+MetricsMiddleware records, per DRF view and action (e.g.
+CategoryViewSet.list), the request count, latency, response size and query
+count in the process wide registry. MetricsView renders them for an admin
+scraper.
+
+With several worker processes every process writes its registry to
+METRICS['DIRECTORY'] (metrics-<pid>.json, replaced atomically at most every
+FLUSH_INTERVAL seconds) and the scrape sums the files of all processes.
+Counters and histograms of exited processes keep counting, gauges only
+include live processes. Without a directory only the serving process is
+reported.
+
+Database connections are per thread, the connections of every thread are
+tracked from the connection_created signal and the open ones are counted
+when a response is recorded.
+"""
+
+import atexit
+import glob
+import json
+import os
+import threading
+import time
+import weakref
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.http import HttpResponse
+
+from rest_framework import permissions
+from rest_framework.views import APIView
+
+from budgetbuddy.middleware import HybridMiddleware, record_queries
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DURATION_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+SIZE_BUCKETS = [100, 1000, 10000, 100000, 1000000, 10000000]
+QUERY_BUCKETS = [1, 2, 5, 10, 20, 50, 100]
+
+# name: (type, help, histogram buckets)
+METRICS = {
+    'budgetbuddy_requests_total': (
+        'counter', 'Requests handled.', None),
+    'budgetbuddy_request_duration_seconds': (
+        'histogram', 'Request latency.', DURATION_BUCKETS),
+    'budgetbuddy_response_size_bytes': (
+        'histogram', 'Size of the non streaming response bodies.',
+        SIZE_BUCKETS),
+    'budgetbuddy_db_queries': (
+        'histogram', 'Database queries per request.', QUERY_BUCKETS),
+    'budgetbuddy_db_connections': (
+        'gauge', 'Open database connections of all threads.', None),
+    'budgetbuddy_token_cache_lookups_total': (
+        'counter', 'Token authentication cache lookups.', None),
+}
+
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class MetricsRegistry:
+    '''
+    Counters, gauges and histograms keyed by (name, labels). Histograms are
+    stored as per bucket counts with a final +Inf bucket, plus the sum.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.values = {}
+            self.histograms = {}
+            self._last_flush = time.monotonic()
+
+    def inc(self, name, labels, value=1):
+        key = (name, _key(labels))
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, labels, value):
+        with self._lock:
+            self.values[(name, _key(labels))] = value
+
+    def observe(self, name, labels, value):
+        buckets = METRICS[name][2]
+        key = (name, _key(labels))
+        with self._lock:
+            counts, total = self.histograms.get(
+                key, ([0] * (len(buckets) + 1), 0))
+            index = next((i for i, bound in enumerate(buckets)
+                          if value <= bound), len(buckets))
+            counts[index] += 1
+            self.histograms[key] = (counts, total + value)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'pid': os.getpid(),
+                'values': [[name, labels, value]
+                           for (name, labels), value in self.values.items()],
+                'histograms': [
+                    [name, labels, counts, total]
+                    for (name, labels), (counts, total)
+                    in self.histograms.items()],
+            }
+
+    def flush(self, directory, force=False):
+        '''
+        Write the snapshot of this process to directory, at most every
+        FLUSH_INTERVAL seconds unless forced.
+        '''
+        now = time.monotonic()
+        if not force and \
+                now - self._last_flush < settings.METRICS['FLUSH_INTERVAL']:
+            return
+        self._last_flush = now
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'metrics-{os.getpid()}.json')
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(f'{path}.tmp', path)
+
+
+registry = MetricsRegistry()
+
+# Connection wrappers of every thread, dropped with their thread
+_connections = weakref.WeakSet()
+_connections_lock = threading.Lock()
+
+
+@receiver(connection_created)
+def track_connection(sender, connection, **kwargs):
+    with _connections_lock:
+        _connections.add(connection)
+
+
+def count_connections():
+    '''
+    Return {alias: open connections} over all threads.
+    '''
+    counts = dict.fromkeys(connections, 0)
+    with _connections_lock:
+        wrappers = list(_connections)
+    for wrapper in wrappers:
+        if wrapper.connection is not None:
+            counts[wrapper.alias] = counts.get(wrapper.alias, 0) + 1
+    return counts
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def collect(directory=None):
+    '''
+    Merge the snapshots of every process, or of this process only without
+    a directory. Returns (values, histograms) in the registry layout.
+    '''
+    if directory:
+        registry.flush(directory, force=True)
+        snapshots = []
+        for path in glob.glob(os.path.join(directory, 'metrics-*.json')):
+            try:
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+    else:
+        snapshots = [registry.snapshot()]
+
+    values = defaultdict(int)
+    histograms = {}
+    for snapshot in snapshots:
+        alive = _is_alive(snapshot['pid'])
+        for name, labels, value in snapshot['values']:
+            if METRICS[name][0] == 'gauge' and not alive:
+                continue
+            values[(name, tuple(map(tuple, labels)))] += value
+        for name, labels, counts, total in snapshot['histograms']:
+            key = (name, tuple(map(tuple, labels)))
+            merged, merged_total = histograms.get(
+                key, ([0] * len(counts), 0))
+            histograms[key] = ([a + b for a, b in zip(merged, counts)],
+                               merged_total + total)
+    return values, histograms
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace('\\', r'\\').replace('"', r'\"') \
+            .replace('\n', r'\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+def render(values, histograms):
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        if kind != 'histogram':
+            for (metric, labels), value in sorted(values.items()):
+                if metric == name:
+                    lines.append(f'{name}{_format_labels(labels)} {value}')
+            continue
+
+        for (metric, labels), (counts, total) in sorted(histograms.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets + ['+Inf'], counts):
+                cumulative += count
+                bucket_labels = labels + (('le', str(bound)),)
+                lines.append(f'{name}_bucket{_format_labels(bucket_labels)} '
+                             f'{cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {total}')
+            lines.append(f'{name}_count{_format_labels(labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+def get_view_label(request):
+    '''
+    Name the DRF view and action handling the request, e.g.
+    CategoryViewSet.list or MonthlyReportView.get.
+    '''
+    match = request.resolver_match
+    if match is None:
+        return 'unmatched'
+    view = match.func
+    cls = getattr(view, 'cls', None)
+    if cls is None:
+        return f'{view.__module__}.{view.__name__}'
+    method = request.method.lower()
+    actions = getattr(view, 'actions', None) or {}
+    return f'{cls.__name__}.{actions.get(method, method)}'
+
+
+class MetricsMiddleware(HybridMiddleware):
+
+    def __init__(self, get_response):
+        if not settings.METRICS['ENABLED']:
+            raise MiddlewareNotUsed
+        super().__init__(get_response)
+        self.directory = settings.METRICS['DIRECTORY']
+        if self.directory:
+            atexit.register(registry.flush, self.directory, force=True)
+
+    def wrap(self, request):
+        return record_queries()
+
+    def process_response(self, request, response, recorder):
+        duration = time.perf_counter() - recorder.start
+
+        labels = {'view': get_view_label(request)}
+        registry.inc('budgetbuddy_requests_total',
+                     dict(labels, method=request.method,
+                          status=str(response.status_code)))
+        registry.observe('budgetbuddy_request_duration_seconds', labels,
+                         duration)
+        registry.observe('budgetbuddy_db_queries', labels, recorder.count)
+        if not response.streaming:
+            registry.observe('budgetbuddy_response_size_bytes', labels,
+                             len(response.content))
+        for alias, count in count_connections().items():
+            registry.set('budgetbuddy_db_connections', {'alias': alias},
+                         count)
+
+        if self.directory:
+            registry.flush(self.directory)
+        return response
+
+
+class MetricsView(APIView):
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        values, histograms = collect(settings.METRICS['DIRECTORY'])
+        return HttpResponse(render(values, histograms),
+                            content_type=CONTENT_TYPE)
@@ -0,0 +1,208 @@
+"""
+Per request SQL instrumentation and the base class of the budgetbuddy
+middleware.
+
+SQLInstrumentationMiddleware installs an execute wrapper on every database
+connection for the duration of a request, counts and times the queries and
+reports them in a Server-Timing header. Requests over the configured query
+count or duration thresholds are logged to the budgetbuddy.sql logger with
+the normalised SQL of the most expensive statements.
+
+The middleware is opt-in, enable it with SQL_INSTRUMENTATION['ENABLED'].
+Queries run while a streaming response is consumed happen after the
+middleware returns and are not counted.
+
+Database connections are per thread, under ASGI the queries of a request
+run in the threads of budgetbuddy.async_views.database_sync_to_async. The
+recorders of the request are kept in a context variable and installed on
+the connections of those threads with execute_wrappers().
+"""
+
+import asyncio
+import contextvars
+import logging
+import re
+import time
+from collections import defaultdict
+from contextlib import ExitStack, contextmanager, nullcontext
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+try:
+    from asgiref.sync import markcoroutinefunction
+except ImportError:
+    # asgiref < 3.6, Django's own idiom for Python < 3.12
+    def markcoroutinefunction(func):
+        func._is_coroutine = asyncio.coroutines._is_coroutine
+        return func
+
+
+logger = logging.getLogger('budgetbuddy.sql')
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PLACEHOLDERS = re.compile(r'(?:\?|%s)(?:\s*,\s*(?:\?|%s))+')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_sql(sql):
+    '''
+    Replace literals with placeholders and collapse placeholder lists so
+    statements that only differ in their parameters group together, e.g.
+    "IN (1, 2, 3)" and "IN (%s, %s)" both become "IN (?, ...)".
+    '''
+    sql = _STRING.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    sql = sql.replace('%s', '?')
+    sql = _PLACEHOLDERS.sub('?, ...', sql)
+    return _WHITESPACE.sub(' ', sql).strip()
+
+
+class QueryRecorder:
+    '''
+    Database execute wrapper recording the duration of every query.
+    '''
+
+    def __init__(self):
+        self.queries = []
+        self.start = time.perf_counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((sql, time.perf_counter() - start))
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def duration(self):
+        return sum(duration for _, duration in self.queries)
+
+    def worst(self, limit):
+        '''
+        Return [(normalised sql, count, total duration)] of the statements
+        with the largest total duration.
+        '''
+        stats = defaultdict(lambda: [0, 0.0])
+        for sql, duration in self.queries:
+            entry = stats[normalize_sql(sql)]
+            entry[0] += 1
+            entry[1] += duration
+        ranked = sorted(stats.items(), key=lambda item: item[1][1],
+                        reverse=True)
+        return [(sql, count, duration)
+                for sql, (count, duration) in ranked[:limit]]
+
+
+_recorders = contextvars.ContextVar('query_recorders', default=())
+
+
+@contextmanager
+def execute_wrappers():
+    '''
+    Install the recorders of the current request on the connections of the
+    current thread.
+    '''
+    with ExitStack() as stack:
+        for recorder in _recorders.get():
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+        yield
+
+
+@contextmanager
+def record_queries():
+    '''
+    Record the queries of the block, and of the threads it hands work to
+    with execute_wrappers(), in a new QueryRecorder.
+    '''
+    recorder = QueryRecorder()
+    token = _recorders.set(_recorders.get() + (recorder,))
+    try:
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            yield recorder
+    finally:
+        _recorders.reset(token)
+
+
+class HybridMiddleware:
+    '''
+    Middleware usable in both the sync (WSGI) and async (ASGI) handler
+    chains, a sync only middleware would run the rest of an ASGI request in
+    a thread. Subclasses override wrap(request), a context manager around
+    the next handler, and/or process_response(request, response, state)
+    with state as yielded by wrap(), None by default.
+    '''
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        with self.wrap(request) as state:
+            response = self.get_response(request)
+        return self.process_response(request, response, state)
+
+    async def __acall__(self, request):
+        with self.wrap(request) as state:
+            response = await self.get_response(request)
+        return self.process_response(request, response, state)
+
+    def wrap(self, request):
+        return nullcontext()
+
+    def process_response(self, request, response, state):
+        return response
+
+
+class SQLInstrumentationMiddleware(HybridMiddleware):
+
+    def __init__(self, get_response):
+        options = settings.SQL_INSTRUMENTATION
+        if not options['ENABLED']:
+            raise MiddlewareNotUsed
+        super().__init__(get_response)
+        self.max_queries = options['MAX_QUERIES']
+        self.max_duration = options['MAX_DURATION_MS']
+        self.report_limit = options['REPORT_LIMIT']
+
+    def wrap(self, request):
+        return record_queries()
+
+    def process_response(self, request, response, recorder):
+        total = (time.perf_counter() - recorder.start) * 1000
+        db_time = recorder.duration * 1000
+
+        response['Server-Timing'] = ', '.join([
+            f'db;desc="{recorder.count} queries";dur={db_time:.1f}',
+            f'app;dur={total - db_time:.1f}',
+            f'total;dur={total:.1f}',
+        ])
+
+        if recorder.count > self.max_queries or db_time > self.max_duration:
+            self.log(request, response, recorder, db_time, total)
+        return response
+
+    def log(self, request, response, recorder, db_time, total):
+        lines = [f'{count}x {duration * 1000:.1f}ms {sql}'
+                 for sql, count, duration in recorder.worst(self.report_limit)]
+        logger.warning(
+            '%s %s %s: %d queries in %.1fms (%.1fms total)\n%s',
+            request.method, request.get_full_path(), response.status_code,
+            recorder.count, db_time, total, '\n'.join(lines),
+            extra={'request': request, 'queries': recorder.count,
+                   'db_time': db_time})
@@ -0,0 +1,212 @@
+"""
+On-demand request profiling for staff users.
+
+A staff user adds the REQUEST_PROFILER HEADER (or QUERY_PARAM) to a request
+and ProfilerMiddleware runs the rest of the request under cProfile. The
+stats are saved to REQUEST_PROFILER['DIRECTORY'] as <id>.prof, loadable with
+pstats or snakeviz, next to <id>.json with the view name and timings. The
+id is returned in the X-Profile-Id response header and the profiles are
+listed and downloaded through the staff only ProfileListView and
+ProfileDownloadView.
+
+Requests without the header only pay for a header lookup, the staff check
+and the profiler run when profiling is requested.
+"""
+
+import cProfile
+import datetime
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import FileResponse, Http404
+
+from rest_framework import exceptions
+from rest_framework import permissions
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.views import APIView
+
+from budgetbuddy.async_views import database_sync_to_async
+from budgetbuddy.middleware import HybridMiddleware
+
+
+PROFILE_ID = re.compile(r'^\d{8}T\d{6}-[0-9a-f]{8}$')
+
+# Only one cProfile profiler can be active at a time
+_profiler_lock = threading.Lock()
+
+
+def get_profile_dir():
+    return settings.REQUEST_PROFILER['DIRECTORY']
+
+
+def get_profile_path(profile_id, ext):
+    if not PROFILE_ID.match(profile_id):
+        raise ValueError(f'{profile_id} is not a valid profile id')
+    return os.path.join(get_profile_dir(), f'{profile_id}.{ext}')
+
+
+def save_profile(profiler, metadata):
+    '''
+    Write the stats and metadata of a finished profiler, drop the oldest
+    profiles over MAX_FILES and return the profile id.
+    '''
+    created = datetime.datetime.now(datetime.timezone.utc)
+    profile_id = f'{created:%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}'
+    os.makedirs(get_profile_dir(), exist_ok=True)
+
+    profiler.dump_stats(get_profile_path(profile_id, 'prof'))
+    metadata = dict(metadata, id=profile_id, created=created.isoformat())
+    with open(get_profile_path(profile_id, 'json'), 'w') as f:
+        json.dump(metadata, f)
+
+    for stale in list_profiles()[settings.REQUEST_PROFILER['MAX_FILES']:]:
+        for ext in ['prof', 'json']:
+            try:
+                os.remove(get_profile_path(stale['id'], ext))
+            except FileNotFoundError:
+                pass
+    return profile_id
+
+
+def list_profiles():
+    '''
+    Return the metadata of the saved profiles, newest first.
+    '''
+    try:
+        names = os.listdir(get_profile_dir())
+    except FileNotFoundError:
+        return []
+
+    profiles = []
+    for name in sorted(names, reverse=True):
+        profile_id, ext = os.path.splitext(name)
+        if ext != '.json' or not PROFILE_ID.match(profile_id):
+            continue
+        try:
+            with open(get_profile_path(profile_id, 'json')) as f:
+                profiles.append(json.load(f))
+        except (OSError, ValueError):
+            # Removed or still being written
+            continue
+    return profiles
+
+
+def get_staff_user(request):
+    '''
+    Return the staff user making the request or None. Token authenticated
+    requests are only authenticated by DRF in the view, so the API
+    authentication classes are run here.
+    '''
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated:
+        drf_request = Request(request, authenticators=[
+            auth() for auth in api_settings.DEFAULT_AUTHENTICATION_CLASSES])
+        try:
+            user = drf_request.user
+        except exceptions.APIException:
+            return None
+    return user if user.is_staff else None
+
+
+class ProfilerMiddleware(HybridMiddleware):
+    '''
+    Under ASGI only the code running on the event loop thread is profiled,
+    not the database_sync_to_async threads.
+    '''
+
+    def __init__(self, get_response):
+        options = settings.REQUEST_PROFILER
+        if not options['ENABLED']:
+            raise MiddlewareNotUsed
+        super().__init__(get_response)
+        self.header = 'HTTP_' + options['HEADER'].upper().replace('-', '_')
+        self.query_param = options['QUERY_PARAM']
+
+    def is_requested(self, request):
+        return self.header in request.META or self.query_param in request.GET
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not self.is_requested(request):
+            return self.get_response(request)
+        user = get_staff_user(request)
+        with self.profile(user) as state:
+            response = self.get_response(request)
+        return self.process_response(request, response, state)
+
+    async def __acall__(self, request):
+        if not self.is_requested(request):
+            return await self.get_response(request)
+        user = await database_sync_to_async(get_staff_user)(request)
+        with self.profile(user) as state:
+            response = await self.get_response(request)
+        return self.process_response(request, response, state)
+
+    @contextmanager
+    def profile(self, user):
+        '''
+        Profile the block for a staff user, yields the profiler state or
+        None when another request is being profiled.
+        '''
+        if user is None or not _profiler_lock.acquire(blocking=False):
+            yield None
+            return
+
+        state = {'user': user, 'profiler': cProfile.Profile()}
+        try:
+            start, cpu_start = time.perf_counter(), time.process_time()
+            state['profiler'].enable()
+            try:
+                yield state
+            finally:
+                state['profiler'].disable()
+                state['duration'] = (time.perf_counter() - start) * 1000
+                state['cpu_time'] = (time.process_time() - cpu_start) * 1000
+        finally:
+            _profiler_lock.release()
+
+    def process_response(self, request, response, state):
+        if state is None:
+            return response
+        match = request.resolver_match
+        response['X-Profile-Id'] = save_profile(state['profiler'], {
+            'view': match.view_name if match else None,
+            'method': request.method,
+            'path': request.get_full_path(),
+            'user': state['user'].get_username(),
+            'status': response.status_code,
+            'duration_ms': round(state['duration'], 3),
+            'cpu_ms': round(state['cpu_time'], 3),
+        })
+        return response
+
+
+class ProfileListView(APIView):
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        return Response(list_profiles())
+
+
+class ProfileDownloadView(APIView):
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request, profile_id, *args, **kwargs):
+        try:
+            path = get_profile_path(profile_id, 'prof')
+            stats = open(path, 'rb')
+        except (ValueError, FileNotFoundError):
+            raise Http404
+        return FileResponse(stats, as_attachment=True,
+                            filename=os.path.basename(path),
+                            content_type='application/octet-stream')
@@ -12,6 +12,8 @@ https://docs.djangoproject.com/en/2.2/ref/settings/
 
 import os
 
+from django.core.exceptions import ImproperlyConfigured
+
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -50,6 +52,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'budgetbuddy.metrics.MetricsMiddleware',
+    'budgetbuddy.middleware.SQLInstrumentationMiddleware',
+    'budgetbuddy.db.routers.ReplicaMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -57,6 +62,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'budgetbuddy.profiling.ProfilerMiddleware',
 ]
 
 ROOT_URLCONF = 'budgetbuddy.urls'
@@ -83,11 +89,140 @@ WSGI_APPLICATION = 'budgetbuddy.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/2.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+#
+# The database profile is picked with BUDGETBUDDY_DB:
+#   sqlite    (default) WAL journaled SQLite file, see budgetbuddy.db.sqlite3
+#   postgres  PostgreSQL configured by BUDGETBUDDY_DB_NAME, _USER, _PASSWORD,
+#             _HOST and _PORT. Connections persist for
+#             BUDGETBUDDY_DB_CONN_MAX_AGE seconds, or are shared through
+#             the budgetbuddy.db.postgresql pool with BUDGETBUDDY_DB_POOL=1.
+#
+# To run the tests against a local PostgreSQL:
+#   BUDGETBUDDY_DB=postgres BUDGETBUDDY_DB_POOL=1 ./manage.py test
+
+DATABASE_PROFILE = os.environ.get('BUDGETBUDDY_DB', 'sqlite')
+CONN_MAX_AGE = int(os.environ.get('BUDGETBUDDY_DB_CONN_MAX_AGE', 600))
+
+if DATABASE_PROFILE == 'sqlite':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'budgetbuddy.db.sqlite3',
+            'NAME': os.environ.get('BUDGETBUDDY_DB_NAME',
+                                   os.path.join(BASE_DIR, 'db.sqlite3')),
+            'CONN_MAX_AGE': CONN_MAX_AGE,
+            'OPTIONS': {
+                # Seconds to wait for a lock before "database is locked"
+                'timeout': 20,
+                'pragmas': {
+                    'journal_mode': 'WAL',
+                    # Durable at checkpoints, safe with WAL
+                    'synchronous': 'NORMAL',
+                    # Negative values are KiB: 64MB page cache
+                    'cache_size': -64000,
+                    'mmap_size': 256 * 1024 * 1024,
+                    'busy_timeout': 20000,
+                    'temp_store': 'MEMORY',
+                },
+            },
+        }
     }
+elif DATABASE_PROFILE == 'postgres':
+    POOLED = os.environ.get('BUDGETBUDDY_DB_POOL') == '1'
+    DATABASES = {
+        'default': {
+            'ENGINE': ('budgetbuddy.db.postgresql' if POOLED
+                       else 'django.db.backends.postgresql'),
+            'NAME': os.environ.get('BUDGETBUDDY_DB_NAME', 'budgetbuddy'),
+            'USER': os.environ.get('BUDGETBUDDY_DB_USER', 'budgetbuddy'),
+            'PASSWORD': os.environ.get('BUDGETBUDDY_DB_PASSWORD', ''),
+            'HOST': os.environ.get('BUDGETBUDDY_DB_HOST', 'localhost'),
+            'PORT': os.environ.get('BUDGETBUDDY_DB_PORT', '5432'),
+            # The pool keeps the connections between requests
+            'CONN_MAX_AGE': 0 if POOLED else CONN_MAX_AGE,
+            'OPTIONS': {
+                'connect_timeout': 5,
+            },
+        }
+    }
+    if POOLED:
+        DATABASES['default']['OPTIONS']['pool'] = {
+            'max_idle': int(os.environ.get('BUDGETBUDDY_DB_POOL_SIZE', 10)),
+            'max_idle_time': 300,
+        }
+else:
+    raise ImproperlyConfigured(
+        f'Unknown BUDGETBUDDY_DB database profile {DATABASE_PROFILE}')
+
+# Read replica of the default database, used for the reads of GET requests
+# by budgetbuddy.db.routers. Set BUDGETBUDDY_DB_REPLICA_NAME and/or
+# BUDGETBUDDY_DB_REPLICA_HOST to point a copy of the default settings at it.
+# Clients read from the primary for STICKY_SECONDS after they write, the
+# pins are kept in CACHE, which has to be shared by the worker processes.
+
+if os.environ.get('BUDGETBUDDY_DB_REPLICA_NAME') or \
+        os.environ.get('BUDGETBUDDY_DB_REPLICA_HOST'):
+    DATABASES['replica'] = dict(
+        DATABASES['default'],
+        NAME=os.environ.get('BUDGETBUDDY_DB_REPLICA_NAME',
+                            DATABASES['default']['NAME']),
+        HOST=os.environ.get('BUDGETBUDDY_DB_REPLICA_HOST',
+                            DATABASES['default'].get('HOST', '')),
+        TEST={'MIRROR': 'default'})
+
+DATABASE_ROUTERS = ['budgetbuddy.db.routers.ReplicaRouter']
+DATABASE_REPLICA = {
+    'ALIAS': 'replica' if 'replica' in DATABASES else None,
+    'STICKY_SECONDS': 5,
+    'CACHE': 'file',
+}
+
+
+# Cache
+# https://docs.djangoproject.com/en/2.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'budgetbuddy',
+    },
+    'file': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, '.cache'),
+    },
+}
+
+
+# Per request query count and timing, see budgetbuddy.middleware.
+# Requests over MAX_QUERIES or MAX_DURATION_MS of database time are logged
+# with the REPORT_LIMIT most expensive statements.
+
+SQL_INSTRUMENTATION = {
+    'ENABLED': False,
+    'MAX_QUERIES': 20,
+    'MAX_DURATION_MS': 200,
+    'REPORT_LIMIT': 5,
+}
+
+# cProfile requests of staff users sending the X-Profile header or the
+# ?profile query parameter, see budgetbuddy.profiling. The MAX_FILES most
+# recent profiles are kept in DIRECTORY.
+
+REQUEST_PROFILER = {
+    'ENABLED': True,
+    'HEADER': 'X-Profile',
+    'QUERY_PARAM': 'profile',
+    'DIRECTORY': os.path.join(BASE_DIR, '.profiles'),
+    'MAX_FILES': 100,
+}
+
+# Request metrics served at /api/metrics/, see budgetbuddy.metrics. Set
+# DIRECTORY to a directory shared by the worker processes to aggregate
+# their metrics, it should be emptied when the service is redeployed.
+
+METRICS = {
+    'ENABLED': True,
+    'DIRECTORY': None,
+    'FLUSH_INTERVAL': 5,
 }
 
 
@@ -130,6 +265,45 @@ USE_TZ = True
 STATIC_URL = '/static/'
 
 
+# Uploaded files
+
+MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+MEDIA_URL = '/media/'
+
+# Square avatar thumbnails generated by profiles.avatars in a pool of
+# WORKERS threads, 0 generates them during the upload request. Uploads over
+# MAX_SIZE bytes or MAX_PIXELS pixels are rejected.
+PROFILE_AVATARS = {
+    'SIZES': [64, 128, 256],
+    'WORKERS': 2,
+    'MAX_SIZE': 5 * 1024 * 1024,
+    'MAX_PIXELS': 4096 * 4096,
+}
+
+# Media served by budgetbuddy.media. OFFLOAD hands the file to the front
+# server: 'x-accel-redirect' to INTERNAL_PREFIX + path for nginx, with an
+# internal location aliased to MEDIA_ROOT, or 'x-sendfile' with the file
+# path. Paths matching IMMUTABLE are content addressed and cached for a
+# year, the others for MAX_AGE seconds.
+MEDIA_SERVING = {
+    'OFFLOAD': os.environ.get('BUDGETBUDDY_MEDIA_OFFLOAD') or None,
+    'INTERNAL_PREFIX': '/protected-media/',
+    'IMMUTABLE': [r'^avatars/'],
+    'MAX_AGE': 60 * 60,
+}
+
+# Users of the recently used API tokens, see profiles.authentication. CACHE
+# names an entry of CACHES shared by the worker processes, None keeps the
+# per process LRU only, with entries expiring after LOCAL_TIMEOUT seconds
+# as the other processes can't invalidate them.
+TOKEN_AUTH_CACHE = {
+    'MAX_SIZE': 10000,
+    'TIMEOUT': 300,
+    'LOCAL_TIMEOUT': 5,
+    'CACHE': None,
+}
+
+
 # Import app specific settings
 
 try:
@@ -148,6 +322,14 @@ try:
 except ImportError:
     pass
 
+# Token lookups go through the cache of profiles.authentication
+if 'REST_FRAMEWORK' in globals():
+    REST_FRAMEWORK['DEFAULT_AUTHENTICATION_CLASSES'] = [
+        'profiles.authentication.CachedTokenAuthentication'
+        if name == 'rest_framework.authentication.TokenAuthentication'
+        else name
+        for name in REST_FRAMEWORK.get('DEFAULT_AUTHENTICATION_CLASSES', [])]
+
 
 # authentication settings
 ACCOUNT_EMAIL_VERIFICATION = 'none'
@@ -13,13 +13,24 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
 from django.contrib import admin
 from django.urls import path, include
 
+from budgetbuddy.media import serve_media
+from budgetbuddy.metrics import MetricsView
+from budgetbuddy.profiling import ProfileListView, ProfileDownloadView
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/auth/', include('authentication.api.urls')),
     path('api-auth/', include('rest_framework.urls')),
     path('api/accounts/', include('profiles.api.urls')),
-    path('api/bp/', include('budgetplanner.api.urls'))
+    path('api/bp/', include('budgetplanner.api.urls')),
+    path('api/metrics/', MetricsView.as_view(), name='metrics'),
+    path('api/profiling/', ProfileListView.as_view(), name='profiling-list'),
+    path('api/profiling/<str:profile_id>/', ProfileDownloadView.as_view(),
+         name='profiling-detail'),
+    path(settings.MEDIA_URL.lstrip('/') + '<path:path>', serve_media,
+         name='media'),
 ]
@@ -1,6 +1,9 @@
 from django.contrib import admin
 from budgetplanner.models import Category, CategoryType, Transaction
+from budgetplanner.models import MonthlyRollup, CategoryForecast
 
 admin.site.register(Category)
 admin.site.register(CategoryType)
 admin.site.register(Transaction)
+admin.site.register(MonthlyRollup)
+admin.site.register(CategoryForecast)
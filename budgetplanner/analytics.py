@@ -0,0 +1,218 @@
+"""
+Columnar per user transaction snapshots for the spending trend analytics.
+
+A user's transactions are loaded once into NumPy arrays and kept in a
+process wide LRU cache bounded by memory. Snapshots are refreshed
+incrementally from Transaction.updated_at, the metrics are computed with
+vectorized operations over the arrays.
+"""
+
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from budgetplanner.models import Transaction
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+ANALYTICS_SETTINGS = settings.BUDGET_PLANNER_ANALYTICS
+
+
+def is_available():
+    return np is not None
+
+
+class TransactionSnapshot:
+    '''
+    The transactions of a user as parallel arrays, ordered by id.
+    '''
+
+    def __init__(self, ids, dates, category_ids, amounts, last_updated):
+        self.ids = ids
+        self.dates = dates
+        self.category_ids = category_ids
+        self.amounts = amounts
+        self.last_updated = last_updated
+
+    @classmethod
+    def from_rows(cls, rows):
+        '''
+        Build a snapshot from (id, date, category_id, amount, updated_at)
+        tuples.
+        '''
+        rows = list(rows)
+        last_updated = max((row[4] for row in rows), default=None)
+        snapshot = cls(
+            ids=np.fromiter((row[0] for row in rows), np.int64, len(rows)),
+            dates=np.array([row[1] for row in rows], dtype='datetime64[D]'),
+            category_ids=np.fromiter((row[2] for row in rows), np.int64,
+                                     len(rows)),
+            amounts=np.fromiter((row[3] for row in rows), np.float64,
+                                len(rows)),
+            last_updated=last_updated)
+        return snapshot.sorted()
+
+    def sorted(self):
+        order = np.argsort(self.ids, kind='stable')
+        return TransactionSnapshot(self.ids[order], self.dates[order],
+                                   self.category_ids[order],
+                                   self.amounts[order], self.last_updated)
+
+    def merge(self, changes):
+        '''
+        Return a new snapshot with the rows of changes replacing or extending
+        the rows of this one.
+        '''
+        keep = ~np.isin(self.ids, changes.ids)
+        last_updated = max(filter(None, [self.last_updated,
+                                         changes.last_updated]), default=None)
+        return TransactionSnapshot(
+            np.concatenate([self.ids[keep], changes.ids]),
+            np.concatenate([self.dates[keep], changes.dates]),
+            np.concatenate([self.category_ids[keep], changes.category_ids]),
+            np.concatenate([self.amounts[keep], changes.amounts]),
+            last_updated).sorted()
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def nbytes(self):
+        return (self.ids.nbytes + self.dates.nbytes +
+                self.category_ids.nbytes + self.amounts.nbytes)
+
+    def select(self, start=None, end=None):
+        '''
+        Return a boolean mask of the rows dated between start and end.
+        '''
+        mask = np.ones(len(self), dtype=bool)
+        if start is not None:
+            mask &= self.dates >= np.datetime64(start, 'D')
+        if end is not None:
+            mask &= self.dates <= np.datetime64(end, 'D')
+        return mask
+
+
+def _transaction_rows(user):
+    return Transaction.objects.filter(category__user=user).values_list(
+        'id', 'date', 'category_id', 'amount', 'updated_at')
+
+
+class SnapshotCache:
+    '''
+    LRU cache of TransactionSnapshot per user id, bounded by the total size
+    of the arrays.
+    '''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._snapshots = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        return sum(snapshot.nbytes for snapshot in self._snapshots.values())
+
+    def get(self, user):
+        with self._lock:
+            snapshot = self._snapshots.pop(user.pk, None)
+
+        if snapshot is None:
+            snapshot = TransactionSnapshot.from_rows(
+                _transaction_rows(user).iterator())
+        else:
+            snapshot = self.refresh(user, snapshot)
+
+        with self._lock:
+            self._snapshots[user.pk] = snapshot
+            while len(self._snapshots) > 1 and self.nbytes > self.max_bytes:
+                self._snapshots.popitem(last=False)
+        return snapshot
+
+    def refresh(self, user, snapshot):
+        '''
+        Apply the rows updated since the snapshot was taken. Deletes do not
+        move updated_at, they are detected by comparing the row count.
+        '''
+        rows = _transaction_rows(user)
+        if snapshot.last_updated is not None:
+            rows = rows.filter(updated_at__gte=snapshot.last_updated)
+        changes = TransactionSnapshot.from_rows(rows)
+        if len(changes):
+            snapshot = snapshot.merge(changes)
+        if len(snapshot) != _transaction_rows(user).count():
+            snapshot = TransactionSnapshot.from_rows(
+                _transaction_rows(user).iterator())
+        return snapshot
+
+    def clear(self):
+        with self._lock:
+            self._snapshots.clear()
+
+
+snapshots = SnapshotCache(ANALYTICS_SETTINGS['MAX_BYTES'])
+
+
+def monthly_totals(snapshot, mask):
+    '''
+    Return (months, totals) for every calendar month between the first and
+    the last selected transaction, months without transactions included.
+    '''
+    months = snapshot.dates[mask].astype('datetime64[M]')
+    if not len(months):
+        return np.array([], dtype='datetime64[M]'), np.array([])
+    first = months.min()
+    index = (months - first).astype(np.int64)
+    totals = np.bincount(index, weights=snapshot.amounts[mask])
+    return first + np.arange(len(totals)), totals
+
+
+def rolling_average(totals, window):
+    '''
+    Trailing average over window months, shorter at the start.
+    '''
+    if not len(totals):
+        return totals
+    sums = np.convolve(totals, np.ones(window))[:len(totals)]
+    counts = np.minimum(np.arange(1, len(totals) + 1), window)
+    return sums / counts
+
+
+def category_share(snapshot, mask):
+    '''
+    Return (category_ids, totals, shares) of the selected transactions.
+    '''
+    category_ids, index = np.unique(snapshot.category_ids[mask],
+                                    return_inverse=True)
+    totals = np.bincount(index, weights=snapshot.amounts[mask],
+                         minlength=len(category_ids))
+    grand_total = totals.sum()
+    shares = totals / grand_total if grand_total else np.zeros_like(totals)
+    return category_ids, totals, shares
+
+
+def spending_trends(user, start=None, end=None, window=3):
+    snapshot = snapshots.get(user)
+    mask = snapshot.select(start, end)
+
+    months, totals = monthly_totals(snapshot, mask)
+    deltas = np.diff(totals, prepend=totals[:1])
+    averages = rolling_average(totals, window)
+    category_ids, category_totals, shares = category_share(snapshot, mask)
+
+    return {
+        'months': [str(month) for month in months],
+        'totals': totals.tolist(),
+        'month_over_month': deltas.tolist(),
+        'rolling_average': averages.tolist(),
+        'categories': [
+            {'id': int(category_id), 'total': float(total),
+             'share': float(share)}
+            for category_id, total, share in zip(
+                category_ids, category_totals, shares)],
+    }
@@ -0,0 +1,88 @@
+from django.db.models import Q
+from django.utils.dateparse import parse_date
+
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import Cursor, CursorPagination
+from rest_framework.pagination import PageNumberPagination
+
+
+class TransactionCursorPagination(CursorPagination):
+    '''
+    Keyset pagination over (date, id). The cursor holds the date and id of
+    the last row of the page and the next page starts strictly after it,
+    so rows sharing a date are never skipped or repeated and the cost of a
+    page does not grow with its depth the way OFFSET pagination does.
+
+    DRF's CursorPagination only seeks on the first ordering field and
+    breaks ties with an offset capped at offset_cutoff, which loops on
+    dates with more rows than that.
+    '''
+    ordering = ('-date', '-id')
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.cursor = self.decode_cursor(request)
+        reverse = self.cursor is not None and self.cursor.reverse
+        if self.cursor is not None:
+            date, pk = self.parse_position(self.cursor.position)
+            if reverse:
+                queryset = queryset.filter(
+                    Q(date__gt=date) | Q(date=date, id__gt=pk))
+            else:
+                queryset = queryset.filter(
+                    Q(date__lt=date) | Q(date=date, id__lt=pk))
+        queryset = queryset.order_by(
+            *(('date', 'id') if reverse else self.ordering))
+
+        results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        if reverse:
+            self.page.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = self.cursor is not None
+        return self.page
+
+    def parse_position(self, position):
+        try:
+            date, pk = position.split('|')
+            date, pk = parse_date(date), int(pk)
+        except (AttributeError, TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if date is None:
+            raise NotFound(self.invalid_cursor_message)
+        return date, pk
+
+    def _get_link(self, instance, reverse):
+        return self.encode_cursor(Cursor(
+            offset=0, reverse=reverse,
+            position=f'{instance.date.isoformat()}|{instance.pk}'))
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self._get_link(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self._get_link(self.page[0], reverse=True)
+
+
+class SearchPagination(PageNumberPagination):
+    '''
+    Ranked search results do not have a stable column to seek on, pages
+    are LIMIT / OFFSET queries on the search index.
+    '''
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
@@ -0,0 +1,12 @@
+from rest_framework.routers import DefaultRouter
+
+
+class BulkRouter(DefaultRouter):
+    '''
+    DefaultRouter that also maps PATCH on the list route to the viewset's
+    partial_bulk_update action, when the viewset defines one.
+    '''
+    routes = [route._replace(mapping={**route.mapping,
+                                      'patch': 'partial_bulk_update'})
+              if route.name == '{basename}-list' else route
+              for route in DefaultRouter.routes]
@@ -1,12 +1,11 @@
-from django.db.models import Q
-from django.conf import settings
+from django.db.models import Q, Sum
+from django.utils import timezone
 
 from rest_framework import serializers
 
 from budgetplanner.models import Category, CategoryType, Transaction
-
-
-ADMIN_USERNAME = settings.ADMIN_USERNAME
+from budgetplanner.global_types import get_admin_id
+from budgetplanner.global_types import get_global_category_types
 
 
 class CategoryTypeSerializer(serializers.ModelSerializer):
@@ -20,12 +19,16 @@ class CategoryTypeSerializer(serializers.ModelSerializer):
 
     def validate_name(self, value):
         user = self.context['request'].user
-        category_types = CategoryType.objects.filter(
-            Q(user__username=ADMIN_USERNAME) | Q(user=user))
+        # Global types come from the in-process cache, only the user's own
+        # types are looked up.
+        global_id = get_global_category_types().get(value)
+        if global_id is not None:
+            category_type = CategoryType(id=global_id, name=value)
+        else:
+            category_type = CategoryType.objects.filter(
+                user=user, name=value).first()
 
-        try:
-            category_type = category_types.get(name=value)
-        except CategoryType.DoesNotExist:
+        if category_type is None:
             return value
         else:
             if self.context['request'].method == 'POST':
@@ -39,6 +42,83 @@ class CategoryTypeSerializer(serializers.ModelSerializer):
             return value
 
 
+class CategoryListSerializer(serializers.ListSerializer):
+    '''
+    Bulk create and update of categories. Names and category types of the
+    whole batch are validated with one query each, rows are written with
+    bulk_create / bulk_update.
+    '''
+
+    def get_instance_ids(self):
+        if self.instance is None:
+            return [None] * len(self.initial_data)
+        return [item.get('id') for item in self.initial_data]
+
+    def to_internal_value(self, data):
+        # Batch checks run here rather than in validate() so errors keep
+        # the same per item list shape as field errors.
+        attrs = super().to_internal_value(data)
+        user = self.context['request'].user
+        ids = self.get_instance_ids()
+        errors = [{} for _ in attrs]
+
+        names = [item.get('name') for item in attrs]
+        existing = dict(Category.objects.filter(
+            user=user, name__in=[name for name in names if name])
+            .values_list('name', 'id'))
+        seen = set()
+        for index, name in enumerate(names):
+            if name is None:
+                continue
+            if name in seen or existing.get(name, ids[index]) != ids[index]:
+                errors[index]['name'] = [f'{name} category already exist']
+            seen.add(name)
+
+        cat_type_ids = {item['cat_type']['id'] for item in attrs
+                        if 'cat_type' in item}
+        allowed = set(CategoryType.objects.filter(
+            Q(user_id=get_admin_id()) | Q(user=user), id__in=cat_type_ids)
+            .values_list('id', flat=True))
+        for index, item in enumerate(attrs):
+            if 'cat_type' in item and item['cat_type']['id'] not in allowed:
+                errors[index]['category_type_id'] = [
+                    f'{item["cat_type"]["id"]} category type does not exist']
+
+        if any(errors):
+            raise serializers.ValidationError(errors)
+        return attrs
+
+    def _apply(self, instance, data):
+        fields = []
+        for attr, value in data.items():
+            if attr == 'cat_type':
+                attr, value = 'cat_type_id', value['id']
+            setattr(instance, attr, value)
+            fields.append(attr)
+        return fields
+
+    def create(self, validated_data):
+        user = self.context['request'].user
+        categories = []
+        for data in validated_data:
+            category = Category(user=user)
+            self._apply(category, data)
+            categories.append(category)
+        return Category.objects.bulk_create(categories)
+
+    def update(self, instances, validated_data):
+        by_id = {instance.id: instance for instance in instances}
+        fields = {'updated_at'}
+        for id, data in zip(self.get_instance_ids(), validated_data):
+            fields.update(self._apply(by_id[id], data))
+        # auto_now is not applied by bulk_update
+        now = timezone.now()
+        for instance in instances:
+            instance.updated_at = now
+        Category.objects.bulk_update(instances, fields)
+        return instances
+
+
 class CategorySerializer(serializers.ModelSerializer):
 
     user = serializers.StringRelatedField()
@@ -50,8 +130,13 @@ class CategorySerializer(serializers.ModelSerializer):
     class Meta:
         model = Category
         exclude = ['cat_type']
+        list_serializer_class = CategoryListSerializer
 
     def validate_name(self, value):
+        if isinstance(self.parent, serializers.ListSerializer):
+            # Validated for the whole batch by CategoryListSerializer
+            return value
+
         try:
             category = Category.objects.get(
                 user=self.context['request'].user, name=value)
@@ -70,7 +155,14 @@ class CategorySerializer(serializers.ModelSerializer):
             return value
 
     def get_amount_actual(self, obj):
-        return sum([transaction.amount for transaction in obj.transaction.all()])
+        # CategoryViewSet annotates amount_actual in SQL. Fall back to a
+        # single aggregate query for instances that were not annotated,
+        # e.g. freshly created or updated objects.
+        amount_actual = getattr(obj, 'amount_actual', None)
+        if amount_actual is None:
+            amount_actual = obj.transaction.aggregate(
+                total=Sum('amount'))['total']
+        return amount_actual or 0
 
     def get_cat_type_name(self):
         if not self.instance.cat_type:
@@ -78,8 +170,45 @@ class CategorySerializer(serializers.ModelSerializer):
         return ''
 
 
+class CategorySearchSerializer(serializers.ModelSerializer):
+    '''
+    Category search result, without the amount_actual aggregate.
+    '''
+    category_type = serializers.CharField(source='cat_type.name',
+                                          read_only=True)
+
+    class Meta:
+        model = Category
+        fields = ['id', 'name', 'description', 'amount_planned',
+                  'category_type', 'updated_at']
+
+
 class TransactionSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Transaction
         fields = '__all__'
+
+    def validate_category(self, value):
+        # TransactionViewSet lists the transactions of the user's categories,
+        # one without a category could not be read or changed again
+        if value is None:
+            raise serializers.ValidationError(
+                'A transaction needs a category.')
+        if value.user != self.context['request'].user:
+            raise serializers.ValidationError(
+                f'{value.name} category does not exist')
+        return value
+
+
+class TransactionImportSerializer(serializers.Serializer):
+    '''
+    Validates a single imported row. The category is given by name and is
+    resolved to an id in bulk by budgetplanner.importers.
+    '''
+    date = serializers.DateField(required=False)
+    category = serializers.CharField(max_length=50)
+    amount = serializers.FloatField()
+    description = serializers.CharField(max_length=100)
+    comment = serializers.CharField(
+        required=False, allow_null=True, allow_blank=True)
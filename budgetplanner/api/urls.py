@@ -1,17 +1,32 @@
 from django.urls import path, include
-from rest_framework.routers import DefaultRouter
 
+from budgetplanner.api.routers import BulkRouter
 from budgetplanner.api.views import CategoryTypeViewSet, CategoryViewSet
+from budgetplanner.api.views import TransactionViewSet, TransactionImportView
+from budgetplanner.api.views import TransactionExportView, MonthlyReportView
 from budgetplanner.api.views import CategoryTypeAdminCreateView
+from budgetplanner.api.views import AnalyticsView, ForecastView
+from budgetplanner.api.views import SearchView
 
 
-router = DefaultRouter()
+router = BulkRouter()
 router.register('category-types', CategoryTypeViewSet,
                 basename='category-type')
 router.register('categories', CategoryViewSet, basename='category')
+router.register('transactions', TransactionViewSet, basename='transaction')
 
 urlpatterns = [
+    # Must come before the router so these are not taken as a pk
+    path('transactions/import/', TransactionImportView.as_view(),
+         name='transaction-import'),
+    path('transactions/export/', TransactionExportView.as_view(),
+         name='transaction-export'),
     path('', include(router.urls)),
+    path('reports/monthly/', MonthlyReportView.as_view(),
+         name='monthly-report'),
+    path('analytics/', AnalyticsView.as_view(), name='analytics'),
+    path('forecasts/', ForecastView.as_view(), name='forecasts'),
+    path('search/', SearchView.as_view(), name='search'),
     path('create-defaults/', CategoryTypeAdminCreateView.as_view(),
          name='create-defaults'),
 ]
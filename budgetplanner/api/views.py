@@ -1,6 +1,13 @@
+import datetime
+
 from django.contrib.auth import get_user_model
-from django.db.models import Q
+from django.db.models import Q, Count, Sum, Max, Value, FloatField
+from django.db.models import Func, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from django.conf import settings
+from django.db import transaction
+from django.http import StreamingHttpResponse
+from django.utils.dateparse import parse_date
 
 from rest_framework import generics
 from rest_framework import permissions
@@ -10,21 +17,96 @@ from rest_framework import viewsets
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework import filters
+from rest_framework import serializers
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.parsers import MultiPartParser, FileUploadParser
 
 from budgetplanner.api.serializers import CategorySerializer
+from budgetplanner.api.serializers import CategorySearchSerializer
 from budgetplanner.api.serializers import CategoryTypeSerializer
 from budgetplanner.api.serializers import TransactionSerializer
 from budgetplanner.api.permissions import IsAuthenticatedOrReadOnly
 from budgetplanner.api.permissions import IsObjectOwnerOrReadOnly
 from budgetplanner.api.permissions import IsCategoryOwnerOrReadOnly
+from budgetplanner.api.pagination import SearchPagination
+from budgetplanner.api.pagination import TransactionCursorPagination
 from budgetplanner.models import Category, CategoryType, Transaction
+from budgetplanner.importers import IMPORT_FORMATS
+from budgetplanner.importers import get_import_format, import_transactions
+from budgetplanner.exporters import EXPORT_FORMATS, export_transactions
+from budgetplanner.rollups import monthly_report
+from budgetplanner import analytics
+from budgetplanner import search
+from budgetplanner.forecasts import compute_forecasts, get_stored_forecasts
+from budgetplanner.cache import CachedListMixin, GLOBAL_VERSION_OWNER
+from budgetplanner.cache import bump_version
+from budgetplanner.cache import get_versions, version_to_datetime
+from budgetplanner.global_types import get_admin_id
+from budgetbuddy.conditional import ConditionalGetMixin
 
 
 USER_MODEL = get_user_model()
 ADMIN_USERNAME = settings.ADMIN_USERNAME
 
 
-class CategoryTypeViewSet(viewsets.GenericViewSet,
+def get_date_param(request, param):
+    '''
+    Parse an optional YYYY-MM-DD query parameter.
+    '''
+    value = request.query_params.get(param)
+    if not value:
+        return None
+    try:
+        date = parse_date(value)
+    except ValueError:
+        date = None
+    if date is None:
+        raise ValidationError(
+            {param: f'{value} is not a valid date (YYYY-MM-DD)'})
+    return date
+
+
+class BudgetPlannerConditionalGetMixin(ConditionalGetMixin):
+    '''
+    Validators for the per user budget planner data. The cache versions are
+    bumped on every write, deletes included, and are also change timestamps.
+    Versions live in a per process cache unless BUDGET_PLANNER_CACHE points
+    to a shared one, so the ETag also includes the row counts and latest ids
+    of get_db_state(), which change on deletes and bulk writes made by other
+    processes.
+    '''
+
+    def get_versions(self):
+        return get_versions(self.request.user.pk, GLOBAL_VERSION_OWNER)
+
+    def get_db_state(self):
+        '''
+        Return {'last_modified', 'count', 'max_id'} of the listed rows.
+        '''
+        raise NotImplementedError
+
+    def _get_db_state(self):
+        # Cached per request, the ETag and Last-Modified share the query
+        if not hasattr(self, '_db_state'):
+            self._db_state = self.get_db_state()
+        return self._db_state
+
+    def get_last_modified(self):
+        times = [version_to_datetime(version)
+                 for version in self.get_versions()]
+        db_last_modified = self._get_db_state()['last_modified']
+        if db_last_modified is not None:
+            times.append(db_last_modified)
+        return max(times)
+
+    def get_etag_parts(self):
+        state = self._get_db_state()
+        return self.get_versions() + [state['count'], state['max_id']]
+
+
+class CategoryTypeViewSet(BudgetPlannerConditionalGetMixin,
+                          CachedListMixin,
+                          viewsets.GenericViewSet,
                           mixins.ListModelMixin,
                           mixins.CreateModelMixin,
                           mixins.RetrieveModelMixin,
@@ -35,15 +117,25 @@ class CategoryTypeViewSet(viewsets.GenericViewSet,
     permission_classes = [permissions.IsAuthenticated, IsObjectOwnerOrReadOnly]
 
     def get_queryset(self):
-        return CategoryType.objects.filter(Q(user__username=ADMIN_USERNAME) |
-                                           Q(user=self.request.user))
+        # Global types are matched on the cached admin id, no join on the
+        # user table.
+        return CategoryType.objects.filter(Q(user_id=get_admin_id()) |
+                                           Q(user=self.request.user)) \
+            .select_related('user')
+
+    def get_db_state(self):
+        return self.get_queryset().aggregate(
+            last_modified=Max('updated_at'), count=Count('id'),
+            max_id=Max('id'))
 
     def perform_create(self, serializer):
         user = self.request.user
         serializer.save(user=user)
 
 
-class CategoryViewSet(viewsets.GenericViewSet,
+class CategoryViewSet(BudgetPlannerConditionalGetMixin,
+                      CachedListMixin,
+                      viewsets.GenericViewSet,
                       mixins.ListModelMixin,
                       mixins.CreateModelMixin,
                       mixins.RetrieveModelMixin,
@@ -54,16 +146,319 @@ class CategoryViewSet(viewsets.GenericViewSet,
     permission_classes = [permissions.IsAuthenticated, IsObjectOwnerOrReadOnly]
     filter_backends = [filters.SearchFilter, filters.OrderingFilter]
     search_fields = ['name', 'cat_type__name']
-    ordering_fields = ['name', 'amount_planned']
+    ordering_fields = ['name', 'amount_planned', 'amount_actual']
 
     def get_queryset(self):
-        return Category.objects.filter(user=self.request.user)
+        # Aggregate the actual amount per category in a single query instead
+        # of loading every transaction in the serializer.
+        transaction_filter = self.get_transaction_filter()
+        return Category.objects.filter(user=self.request.user) \
+            .select_related('user', 'cat_type') \
+            .annotate(amount_actual=Coalesce(
+                Sum('transaction__amount', filter=transaction_filter),
+                Value(0), output_field=FloatField()))
+
+    def create(self, request, *args, **kwargs):
+        if not isinstance(request.data, list):
+            return super().create(request, *args, **kwargs)
+
+        serializer = self.get_serializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        with transaction.atomic():
+            categories = serializer.save()
+        return self.bulk_response(categories, status.HTTP_201_CREATED)
+
+    def partial_bulk_update(self, request, *args, **kwargs):
+        '''
+        PATCH a list of categories, each item identified by its id.
+        '''
+        if not isinstance(request.data, list) or \
+                not all(isinstance(item, dict) for item in request.data):
+            raise ValidationError('Expected a list of categories.')
+        id_field = serializers.IntegerField()
+        try:
+            ids = [id_field.run_validation(item.get('id'))
+                   for item in request.data]
+        except ValidationError:
+            ids = None
+        if ids is None or len(set(ids)) != len(ids):
+            raise ValidationError('Every item needs a unique integer id.')
+        data = [dict(item, id=id) for item, id in zip(request.data, ids)]
+
+        categories = list(self.get_queryset().filter(id__in=ids))
+        missing = set(ids) - {category.id for category in categories}
+        if missing:
+            raise NotFound(f'{sorted(missing)} categories do not exist')
+
+        serializer = self.get_serializer(
+            categories, data=data, many=True, partial=True)
+        serializer.is_valid(raise_exception=True)
+        with transaction.atomic():
+            categories = serializer.save()
+        return self.bulk_response(categories, status.HTTP_200_OK)
+
+    def bulk_response(self, categories, status_code):
+        # bulk_create / bulk_update skip post_save, invalidate and index
+        # explicitly
+        bump_version(self.request.user.pk)
+        # Reload with the amount_actual annotation, and the ids that are
+        # not set by bulk_create on every database.
+        names = [category.name for category in categories]
+        queryset = self.get_queryset().filter(name__in=names)
+        search.index_categories(Category.objects.filter(
+            user=self.request.user, name__in=names))
+        serializer = self.get_serializer(queryset, many=True)
+        return Response(serializer.data, status=status_code)
+
+    def get_db_state(self):
+        # Index lookups on Transaction(category, updated_at) and
+        # Transaction(category, id) per category instead of scanning every
+        # transaction of the user.
+        transactions = Transaction.objects.filter(category=OuterRef('pk'))
+        latest_transaction = transactions \
+            .order_by('-updated_at').values('updated_at')[:1]
+        last_transaction = transactions.order_by('-id').values('id')[:1]
+        # COUNT() without a GROUP BY, the subquery is per category already
+        transaction_count = transactions.order_by() \
+            .annotate(count=Func('id', function='COUNT')).values('count')
+        state = Category.objects.filter(user=self.request.user) \
+            .annotate(transaction_updated_at=Subquery(latest_transaction),
+                      last_transaction_id=Subquery(last_transaction),
+                      transactions=Subquery(transaction_count)) \
+            .aggregate(category=Max('updated_at'),
+                       transaction=Max('transaction_updated_at'),
+                       category_count=Count('id'),
+                       category_id=Max('id'),
+                       transaction_count=Sum('transactions'),
+                       transaction_id=Max('last_transaction_id'))
+        times = [state[key] for key in ('category', 'transaction')
+                 if state[key] is not None]
+        return {
+            'last_modified': max(times) if times else None,
+            'count': (state['category_count'], state['transaction_count']),
+            'max_id': (state['category_id'], state['transaction_id']),
+        }
+
+    def get_transaction_filter(self):
+        '''
+        Build the transaction date range filter from the ?from= and ?to=
+        query parameters (YYYY-MM-DD).
+        '''
+        transaction_filter = Q()
+        for param, lookup in [('from', 'gte'), ('to', 'lte')]:
+            date = get_date_param(self.request, param)
+            if date is not None:
+                transaction_filter &= Q(
+                    **{f'transaction__date__{lookup}': date})
+        return transaction_filter or None
 
     def perform_create(self, serializer):
         user = self.request.user
         serializer.save(user=user)
 
 
+class TransactionViewSet(viewsets.GenericViewSet,
+                         mixins.ListModelMixin,
+                         mixins.CreateModelMixin,
+                         mixins.RetrieveModelMixin,
+                         mixins.UpdateModelMixin,
+                         mixins.DestroyModelMixin):
+
+    serializer_class = TransactionSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    pagination_class = TransactionCursorPagination
+
+    def get_queryset(self):
+        return Transaction.objects.filter(category__user=self.request.user)
+
+
+class TransactionImportView(APIView):
+    '''
+    Import transactions from an uploaded CSV or NDJSON file. The format is
+    taken from ?format_type= or guessed from the file name.
+    '''
+
+    permission_classes = [permissions.IsAuthenticated]
+    parser_classes = [MultiPartParser, FileUploadParser]
+
+    def post(self, request, **kwargs):
+        upload = request.data.get('file')
+        if upload is None:
+            raise ValidationError({'file': 'No file was submitted.'})
+
+        fmt = request.query_params.get(
+            'format_type', get_import_format(upload.name))
+        if fmt not in IMPORT_FORMATS:
+            raise ValidationError(
+                {'format_type': f'{fmt} is not a supported import format'})
+
+        report = import_transactions(request.user, upload, fmt=fmt)
+        if report['created'] or not report['error_count']:
+            return Response(report, status=status.HTTP_201_CREATED)
+        return Response(report, status=status.HTTP_400_BAD_REQUEST)
+
+
+class TransactionExportView(APIView):
+    '''
+    Stream the user's transactions as CSV or NDJSON (?format_type=). Pass
+    ?names=true to include the category and category type names.
+    '''
+
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, **kwargs):
+        fmt = request.query_params.get('format_type', 'csv')
+        if fmt not in EXPORT_FORMATS:
+            raise ValidationError(
+                {'format_type': f'{fmt} is not a supported export format'})
+        names = request.query_params.get('names') in ('1', 'true')
+
+        response = StreamingHttpResponse(
+            export_transactions(request.user, fmt=fmt, names=names),
+            content_type=EXPORT_FORMATS[fmt])
+        response['Content-Disposition'] = \
+            f'attachment; filename="transactions.{fmt}"'
+        return response
+
+
+class MonthlyReportView(APIView):
+    '''
+    Planned vs actual amounts per month, optionally limited with ?from= and
+    ?to= (YYYY-MM), over at most MAX_REPORT_MONTHS months.
+    '''
+
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, **kwargs):
+        months = {}
+        for param in ['from', 'to']:
+            value = request.query_params.get(param)
+            if not value:
+                continue
+            try:
+                months[param] = parse_date(f'{value}-01')
+            except ValueError:
+                months[param] = None
+            if months[param] is None:
+                raise ValidationError(
+                    {param: f'{value} is not a valid month (YYYY-MM)'})
+
+        try:
+            report = monthly_report(request.user, start=months.get('from'),
+                                    end=months.get('to'))
+        except ValueError as e:
+            raise ValidationError(f'{e}, narrow ?from= and ?to=.')
+        return Response(report)
+
+
+class AnalyticsView(APIView):
+    '''
+    Spending trends of the user: monthly totals, month over month deltas,
+    a trailing average over ?window= months and the share of each category,
+    optionally limited with ?from= and ?to= (YYYY-MM-DD).
+    '''
+
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, **kwargs):
+        if not analytics.is_available():
+            return Response({'detail': 'Analytics requires numpy.'},
+                            status=status.HTTP_501_NOT_IMPLEMENTED)
+
+        window = request.query_params.get('window', '3')
+        if not window.isdigit() or not 1 <= int(window) <= 24:
+            raise ValidationError(
+                {'window': 'Expected a number of months from 1 to 24.'})
+
+        trends = analytics.spending_trends(
+            request.user,
+            start=get_date_param(request, 'from'),
+            end=get_date_param(request, 'to'),
+            window=int(window))
+
+        names = dict(Category.objects.filter(user=request.user)
+                     .values_list('id', 'name'))
+        for category in trends['categories']:
+            category['name'] = names.get(category['id'])
+        return Response(trends)
+
+
+class ForecastView(APIView):
+    '''
+    Projected month end spend per category. Served from the forecasts
+    stored by the forecast_spending command when available, ?live=true
+    always computes them. ?date= (YYYY-MM-DD) forecasts as of another day,
+    stored forecasts are only served when the batch ran as of that day.
+    '''
+
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, **kwargs):
+        today = get_date_param(request, 'date') or datetime.date.today()
+        live = request.query_params.get('live') in ('1', 'true')
+
+        forecasts = None
+        if not live:
+            forecasts = get_stored_forecasts(request.user, today=today)
+        stored = forecasts is not None
+        if not stored:
+            forecasts = compute_forecasts(request.user, today=today)
+
+        return Response({'month': f'{today:%Y-%m}', 'stored': stored,
+                         'categories': forecasts})
+
+
+class SearchView(APIView):
+    '''
+    Ranked full-text search over the user's transactions and categories.
+    Every word of ?q= is required, the last one also matches as a prefix.
+    ?type=transaction or ?type=category returns a single kind.
+    '''
+
+    permission_classes = [permissions.IsAuthenticated]
+    pagination_class = SearchPagination
+    serializer_classes = {
+        'transaction': TransactionSerializer,
+        'category': CategorySearchSerializer,
+    }
+
+    def get(self, request, **kwargs):
+        kind = request.query_params.get('type')
+        if kind is not None and kind not in search.KINDS:
+            raise ValidationError(
+                {'type': f'Expected one of {", ".join(search.KINDS)}.'})
+
+        paginator = self.pagination_class()
+        hits = paginator.paginate_queryset(search.SearchHits(
+            request.user, request.query_params.get('q', ''), kind=kind),
+            request, view=self)
+        return paginator.get_paginated_response(self.get_results(hits))
+
+    def get_results(self, hits):
+        ids = {kind: [] for kind in search.KINDS}
+        for kind, pk, _ in hits:
+            ids[kind].append(pk)
+        objects = {
+            'transaction': Transaction.objects.filter(
+                category__user=self.request.user).in_bulk(
+                    ids['transaction']),
+            'category': Category.objects.filter(user=self.request.user)
+            .select_related('cat_type').in_bulk(ids['category']),
+        }
+
+        results = []
+        for kind, pk, rank in hits:
+            instance = objects[kind].get(pk)
+            if instance is None:
+                # Deleted or moved since the page was searched
+                continue
+            serializer = self.serializer_classes[kind](
+                instance, context={'request': self.request})
+            results.append({'type': kind, 'rank': rank,
+                            'data': serializer.data})
+        return results
+
+
 class CategoryTypeAdminCreateView(APIView):
 
     permission_classes = [permissions.IsAdminUser]
@@ -72,8 +467,13 @@ class CategoryTypeAdminCreateView(APIView):
         # Generate default category types
         admin = USER_MODEL.objects.get(username=ADMIN_USERNAME)
 
-        cat_types = [CategoryType.objects.create(name=typ, user=admin)
-                     for typ in ['income', 'savings', 'expenditure']]
+        # Types that already exist are kept, CategoryType(user, name) is
+        # unique
+        results = [CategoryType.objects.get_or_create(name=typ, user=admin)
+                   for typ in ['income', 'savings', 'expenditure']]
 
-        data = [CategoryTypeSerializer(cat_type).data for cat_type in cat_types]
-        return Response(data, status=status.HTTP_201_CREATED)
+        data = [CategoryTypeSerializer(cat_type).data
+                for cat_type, _ in results]
+        created = any(created for _, created in results)
+        return Response(data, status=status.HTTP_201_CREATED if created
+                        else status.HTTP_200_OK)
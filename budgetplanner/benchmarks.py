@@ -0,0 +1,347 @@
+"""
+Endpoint latency and query count benchmarks, run with the benchmark
+management command, and the WSGI vs ASGI throughput comparison of the
+loadtest command.
+
+Every endpoint declares a budget: the maximum number of SQL queries a request
+may run and its p95 latency in milliseconds. Query budgets must not depend on
+the size of the seeded dataset, which is what catches N+1 regressions.
+"""
+
+import asyncio
+import datetime
+import io
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from django.contrib.auth import get_user_model
+from django.core.handlers.wsgi import WSGIHandler
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.test.utils import setup_test_environment
+from django.test.utils import teardown_test_environment
+from django.urls import reverse
+
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from budgetbuddy.async_views import BudgetBuddyASGIHandler
+from budgetplanner.models import Category, CategoryType, Transaction
+from budgetplanner.provisioning import bulk_provision_users
+from budgetplanner.rollups import rebuild_rollups
+from budgetplanner.search import rebuild_index
+
+
+USER_MODEL = get_user_model()
+
+# name: (url name, url kwargs kind, query budget, p95 budget in ms)
+ENDPOINTS = {
+    'category-type-list': ('category-type-list', None, 4, 50),
+    'category-type-detail': ('category-type-detail', 'category_type', 4, 50),
+    'category-list': ('category-list', None, 4, 100),
+    'category-detail': ('category-detail', 'category', 4, 50),
+    'transaction-list': ('transaction-list', None, 3, 100),
+    'transaction-detail': ('transaction-detail', 'transaction', 3, 50),
+    'transaction-export': ('transaction-export', None, 3, 1000),
+    'monthly-report': ('monthly-report', None, 3, 100),
+    'analytics': ('analytics', None, 5, 200),
+    'forecasts': ('forecasts', None, 4, 100),
+    'profiles-list': ('profiles-list', None, 4, 200),
+    'profiles-detail': ('profiles-detail', 'profile', 4, 50),
+    'users-list': ('users-list', None, 4, 200),
+    'search': ('search', None, 5, 100),
+}
+
+# Query strings of the endpoints that need one
+QUERY_STRINGS = {
+    'search': 'q=transaction',
+}
+
+# Endpoints with an async view under ASGI, see budgetbuddy.asgi_urls
+LOAD_ENDPOINTS = ['category-type-list', 'category-list', 'profiles-detail']
+
+
+@contextmanager
+def benchmark_database():
+    '''
+    Run the block against a new test database, destroyed afterwards.
+    '''
+    setup_test_environment()
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+def seed(admin_username, users=10, categories=10, transactions=1000,
+         seed=0):
+    '''
+    Create the admin user with the global category types and users with
+    categories and transactions spread over the last two years. Returns the
+    first seeded user.
+    '''
+    rng = random.Random(seed)
+    USER_MODEL.objects.create_superuser(
+        username=admin_username, email=f'{admin_username}@budgetbuddy.com',
+        password=None)
+
+    usernames = [f'bench{i}' for i in range(users)]
+    # No password, hashing would dominate the seeding time
+    bulk_provision_users([{'username': username} for username in usernames])
+    user_list = list(USER_MODEL.objects.filter(username__in=usernames))
+
+    expenditure = CategoryType.objects.get(name='expenditure')
+    Category.objects.bulk_create(
+        [Category(name=f'extra{i}', user=user, cat_type=expenditure,
+                  amount_planned=rng.randint(100, 1000))
+         for user in user_list for i in range(max(categories - 10, 0))])
+
+    today = datetime.date.today()
+    category_ids = {}
+    for user_id, category_id in Category.objects.filter(
+            user__in=user_list).values_list('user_id', 'id'):
+        category_ids.setdefault(user_id, []).append(category_id)
+    Transaction.objects.bulk_create(
+        (Transaction(category_id=rng.choice(category_ids[user.id]),
+                     amount=round(rng.uniform(1, 500), 2),
+                     description=f'transaction {i}',
+                     date=today - datetime.timedelta(days=rng.randint(0, 730)))
+         for user in user_list for i in range(transactions)),
+        batch_size=1000)
+    rebuild_rollups()
+    rebuild_index()
+    return user_list[0]
+
+
+def get_url_kwargs(kind, user):
+    if kind is None:
+        return {}
+    if kind == 'category_type':
+        return {'pk': CategoryType.objects.get(name='expenditure').id}
+    if kind == 'category':
+        return {'pk': Category.objects.filter(user=user).first().id}
+    if kind == 'transaction':
+        return {'pk': Transaction.objects.filter(
+            category__user=user).first().id}
+    if kind == 'profile':
+        return {'user__username': user.username}
+    raise ValueError(kind)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def measure(client, url, iterations):
+    '''
+    Request url iterations times, returning the latencies in milliseconds,
+    the largest query count and the last status code.
+    '''
+    latencies, queries = [], 0
+    for _ in range(iterations):
+        with CaptureQueriesContext(connection) as context:
+            start = time.perf_counter()
+            response = client.get(url)
+            if response.streaming:
+                b''.join(response.streaming_content)
+            latencies.append((time.perf_counter() - start) * 1000)
+        queries = max(queries, len(context.captured_queries))
+    return latencies, queries, response.status_code
+
+
+def run(user, admin, iterations=20, endpoints=None, baseline=None,
+        tolerance=0.5):
+    '''
+    Benchmark the endpoints as user (admin for admin only endpoints) and
+    check them against their budgets and an optional baseline, a previous
+    result of run(). Returns {name: result} where result lists the
+    failures.
+    '''
+    clients = {}
+    for account in [user, admin]:
+        token, _ = Token.objects.get_or_create(user=account)
+        clients[account.pk] = APIClient()
+        clients[account.pk].credentials(
+            HTTP_AUTHORIZATION='Token ' + token.key)
+
+    results = {}
+    for name, (url_name, kind, query_budget, p95_budget) in ENDPOINTS.items():
+        if endpoints and name not in endpoints:
+            continue
+        client = clients[admin.pk if name == 'users-list' else user.pk]
+        url = reverse(url_name, kwargs=get_url_kwargs(kind, user))
+        if name in QUERY_STRINGS:
+            url += '?' + QUERY_STRINGS[name]
+        latencies, queries, status_code = measure(client, url, iterations)
+
+        result = {
+            'url': url,
+            'status': status_code,
+            'queries': queries,
+            'query_budget': query_budget,
+            'p50_ms': round(percentile(latencies, 0.5), 3),
+            'p95_ms': round(percentile(latencies, 0.95), 3),
+            'p95_budget_ms': p95_budget,
+            'failures': [],
+        }
+        if status_code != 200:
+            result['failures'].append(f'status {status_code}')
+        if queries > query_budget:
+            result['failures'].append(
+                f'{queries} queries, budget is {query_budget}')
+        if result['p95_ms'] > p95_budget:
+            result['failures'].append(
+                f'p95 {result["p95_ms"]}ms, budget is {p95_budget}ms')
+        previous = (baseline or {}).get(name)
+        if previous and \
+                result['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+            result['failures'].append(
+                f'p95 {result["p95_ms"]}ms, baseline is '
+                f'{previous["p95_ms"]}ms')
+        results[name] = result
+    return results
+
+
+def wsgi_request(application, url, token):
+    '''
+    GET url from a WSGI application, returns (status code, body).
+    '''
+    environ = {
+        'REQUEST_METHOD': 'GET',
+        'PATH_INFO': url,
+        'QUERY_STRING': '',
+        'SERVER_NAME': 'testserver',
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'HTTP_HOST': 'testserver',
+        'HTTP_AUTHORIZATION': f'Token {token}',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': io.BytesIO(),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    status = []
+    body = application(environ, lambda line, headers: status.append(line))
+    try:
+        content = b''.join(body)
+    finally:
+        body.close()
+    return int(status[0].split()[0]), content
+
+
+async def asgi_request(application, url, token):
+    '''
+    GET url from an ASGI application, returns (status code, body).
+    '''
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': 'GET',
+        'scheme': 'http',
+        'path': url,
+        'raw_path': url.encode(),
+        'query_string': b'',
+        'root_path': '',
+        'headers': [(b'host', b'testserver'),
+                    (b'authorization', f'Token {token}'.encode())],
+        'client': ('127.0.0.1', 0),
+        'server': ('testserver', 80),
+    }
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    await application(scope, receive, send)
+    content = b''.join(message.get('body', b'') for message in messages
+                       if message['type'] == 'http.response.body')
+    return messages[0]['status'], content
+
+
+def _load_result(latencies, statuses, elapsed):
+    return {
+        'requests': len(latencies),
+        'requests_per_second': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.5), 3),
+        'p95_ms': round(percentile(latencies, 0.95), 3),
+        'errors': sum(status != 200 for status in statuses),
+    }
+
+
+def run_wsgi_load(url, token, concurrency, requests):
+    '''
+    Send requests GETs with concurrency threads, as a threaded WSGI server.
+    '''
+    application = WSGIHandler()
+
+    def timed_request(_):
+        start = time.perf_counter()
+        status, _ = wsgi_request(application, url, token)
+        return (time.perf_counter() - start) * 1000, status
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(timed_request, range(requests)))
+    elapsed = time.perf_counter() - start
+    return _load_result([latency for latency, _ in results],
+                        [status for _, status in results], elapsed)
+
+
+def run_asgi_load(url, token, concurrency, requests):
+    '''
+    Send requests GETs with at most concurrency in flight on one event
+    loop, as an ASGI server.
+    '''
+    application = BudgetBuddyASGIHandler()
+
+    async def load():
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def timed_request():
+            async with semaphore:
+                start = time.perf_counter()
+                status, _ = await asgi_request(application, url, token)
+                return (time.perf_counter() - start) * 1000, status
+
+        return await asyncio.gather(
+            *(timed_request() for _ in range(requests)))
+
+    start = time.perf_counter()
+    results = asyncio.run(load())
+    elapsed = time.perf_counter() - start
+    return _load_result([latency for latency, _ in results],
+                        [status for _, status in results], elapsed)
+
+
+def run_load(user, endpoints=None, concurrency=16, requests=500):
+    '''
+    Compare the throughput of the WSGI and ASGI handlers on the
+    LOAD_ENDPOINTS. Returns {name: {'wsgi': result, 'asgi': result}}.
+    '''
+    token, _ = Token.objects.get_or_create(user=user)
+    results = {}
+    for name in LOAD_ENDPOINTS:
+        if endpoints and name not in endpoints:
+            continue
+        url_name, kind = ENDPOINTS[name][:2]
+        url = reverse(url_name, kwargs=get_url_kwargs(kind, user))
+        results[name] = {
+            'url': url,
+            'wsgi': run_wsgi_load(url, token.key, concurrency, requests),
+            'asgi': run_asgi_load(url, token.key, concurrency, requests),
+        }
+    return results
@@ -51,3 +51,23 @@ BUDGET_PLANNER_DEFAULTS = {
         },
     ]
 }
+
+# Cache used for the per user list responses, see budgetplanner.cache.
+# Point ALIAS to any entry of CACHES, e.g. a FileBasedCache to share the
+# responses between worker processes.
+BUDGET_PLANNER_CACHE = {
+    'ALIAS': 'default',
+    'TIMEOUT': 300,
+}
+
+# Per process cache of the NumPy transaction snapshots used by
+# budgetplanner.analytics, least recently used users are evicted first.
+BUDGET_PLANNER_ANALYTICS = {
+    'MAX_BYTES': 64 * 1024 * 1024,
+}
+
+# Full-text search of budgetplanner.search. CONFIG is the PostgreSQL text
+# search configuration.
+BUDGET_PLANNER_SEARCH = {
+    'CONFIG': 'english',
+}
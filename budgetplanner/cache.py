@@ -0,0 +1,83 @@
+import datetime
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+from rest_framework.response import Response
+
+
+CACHE_SETTINGS = settings.BUDGET_PLANNER_CACHE
+# Admin owned category types are shared by every user, changing one of them
+# bumps this version instead of a user version.
+GLOBAL_VERSION_OWNER = 'global'
+
+
+def get_cache():
+    return caches[CACHE_SETTINGS['ALIAS']]
+
+
+def _version_key(owner):
+    return f'bp:version:{owner}'
+
+
+def _new_version(previous=0):
+    # Versions are change timestamps in nanoseconds, so a version that was
+    # evicted never comes back with a value older entries were stored under,
+    # and the version doubles as a Last-Modified time.
+    return max(time.time_ns(), previous + 1)
+
+
+def version_to_datetime(version):
+    return datetime.datetime.fromtimestamp(
+        version / 1e9, tz=datetime.timezone.utc)
+
+
+def get_versions(*owners):
+    cache = get_cache()
+    keys = [_version_key(owner) for owner in owners]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, _new_version(), timeout=None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def bump_version(owner):
+    '''
+    Invalidate every cached response of owner, a user id or
+    GLOBAL_VERSION_OWNER.
+    '''
+    cache = get_cache()
+    key = _version_key(owner)
+    cache.set(key, _new_version(cache.get(key, 0)), timeout=None)
+
+
+def get_response_key(request, view_name):
+    user_id = request.user.pk
+    user_version, global_version = get_versions(user_id, GLOBAL_VERSION_OWNER)
+    query = hashlib.sha1(
+        request.META.get('QUERY_STRING', '').encode()).hexdigest()
+    return (f'bp:response:{user_id}:{user_version}:{global_version}:'
+            f'{view_name}:{query}')
+
+
+class CachedListMixin:
+    '''
+    Cache the serialized list response per user and query string. Entries
+    are invalidated by bumping the user version from budgetplanner.signals.
+    '''
+
+    def list(self, request, *args, **kwargs):
+        cache = get_cache()
+        key = get_response_key(request, type(self).__name__)
+        data = cache.get(key)
+        if data is not None:
+            return Response(data)
+
+        response = super().list(request, *args, **kwargs)
+        if response.status_code == 200:
+            cache.set(key, response.data, CACHE_SETTINGS['TIMEOUT'])
+        return response
@@ -0,0 +1,73 @@
+import csv
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from budgetplanner.models import Transaction
+
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+EXPORT_CHUNK_SIZE = 2000
+EXPORT_FIELDS = ['id', 'date', 'category_id', 'amount', 'description',
+                 'comment', 'updated_at']
+EXPORT_NAME_FIELDS = {
+    'category': 'category__name',
+    'category_type': 'category__cat_type__name',
+}
+
+
+class _Echo:
+    '''
+    File-like object that returns what is written so csv.writer can be used
+    to build lines for a streaming response.
+    '''
+
+    def write(self, value):
+        return value
+
+
+def get_export_rows(user, names=False):
+    '''
+    Lazily iterate over the user's transactions as dicts. Uses a chunked
+    .iterator() so rows are fetched with a server-side cursor where the
+    database supports it and are never cached on the queryset.
+    '''
+    fields = dict(zip(EXPORT_FIELDS, EXPORT_FIELDS))
+    if names:
+        fields.update(EXPORT_NAME_FIELDS)
+
+    queryset = Transaction.objects.filter(category__user=user) \
+        .order_by('date', 'id') \
+        .values_list(*fields.values())
+    for row in queryset.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        yield dict(zip(fields.keys(), row))
+
+
+def iter_csv(rows, fields):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(fields)
+    for row in rows:
+        yield writer.writerow([row[field] for field in fields])
+
+
+def iter_ndjson(rows):
+    encoder = DjangoJSONEncoder()
+    for row in rows:
+        yield encoder.encode(row) + '\n'
+
+
+def export_transactions(user, fmt='csv', names=False):
+    '''
+    Return a generator of text chunks with the user's transactions encoded
+    as CSV or NDJSON.
+    '''
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f'{fmt} is not a supported export format')
+
+    rows = get_export_rows(user, names=names)
+    if fmt == 'csv':
+        fields = EXPORT_FIELDS + (list(EXPORT_NAME_FIELDS) if names else [])
+        return iter_csv(rows, fields)
+    return iter_ndjson(rows)
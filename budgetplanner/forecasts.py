@@ -0,0 +1,93 @@
+import calendar
+import datetime
+
+from django.db import transaction
+from django.db.models import FloatField, Q, Sum, Value
+from django.db.models.functions import Coalesce
+
+from budgetplanner.models import Category, CategoryForecast
+from budgetplanner.rollups import month_start
+
+
+FORECAST_FIELDS = ['category_id', 'name', 'planned', 'spent', 'projected',
+                   'status']
+
+
+def project(spent, planned, today):
+    '''
+    Linear projection of the month end spend from the spend so far, and
+    whether it stays within the planned amount.
+    '''
+    days_in_month = calendar.monthrange(today.year, today.month)[1]
+    projected = spent / today.day * days_in_month
+    if projected > planned:
+        return projected, CategoryForecast.OVER_BUDGET
+    return projected, CategoryForecast.ON_TRACK
+
+
+def get_spend_queryset(categories, today):
+    '''
+    Annotate categories with the spend of the month of today, read from the
+    monthly rollups in the same query.
+    '''
+    return categories.annotate(spent=Coalesce(
+        Sum('rollups__total', filter=Q(rollups__month=month_start(today))),
+        Value(0), output_field=FloatField()))
+
+
+def compute_forecasts(user, today=None):
+    '''
+    Forecast every category of user in a single query.
+    '''
+    today = today or datetime.date.today()
+    rows = get_spend_queryset(Category.objects.filter(user=user), today) \
+        .order_by('name') \
+        .values_list('id', 'name', 'amount_planned', 'spent')
+
+    forecasts = []
+    for category_id, name, planned, spent in rows:
+        projected, status = project(spent, planned, today)
+        forecasts.append(dict(zip(FORECAST_FIELDS, [
+            category_id, name, planned, spent, projected, status])))
+    return forecasts
+
+
+def get_stored_forecasts(user, today=None):
+    '''
+    Read the forecasts stored as of today, None if the last batch of the
+    month ran as of another day.
+    '''
+    today = today or datetime.date.today()
+    rows = CategoryForecast.objects \
+        .filter(user=user, month=month_start(today), date=today) \
+        .order_by('category__name') \
+        .values_list('category_id', 'category__name', 'planned', 'spent',
+                     'projected', 'status')
+    return [dict(zip(FORECAST_FIELDS, row)) for row in rows] or None
+
+
+def store_forecasts(today=None, batch_size=1000):
+    '''
+    Forecast the categories of every user as of today and store the result
+    for the month of today, replacing an earlier run. Returns the number of
+    rows written.
+    '''
+    today = today or datetime.date.today()
+    month = month_start(today)
+    rows = get_spend_queryset(
+        Category.objects.filter(user__isnull=False), today) \
+        .values_list('id', 'user_id', 'amount_planned', 'spent')
+
+    def forecasts():
+        for category_id, user_id, planned, spent in rows.iterator():
+            projected, status = project(spent, planned, today)
+            yield CategoryForecast(
+                user_id=user_id, category_id=category_id, month=month,
+                date=today, planned=planned, spent=spent, projected=projected,
+                status=status)
+
+    with transaction.atomic():
+        CategoryForecast.objects.filter(month=month).delete()
+        created = CategoryForecast.objects.bulk_create(
+            forecasts(), batch_size=batch_size)
+    return len(created)
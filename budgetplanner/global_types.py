@@ -0,0 +1,57 @@
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+
+from budgetplanner.models import CategoryType
+
+
+USER_MODEL = get_user_model()
+ADMIN_USERNAME = settings.ADMIN_USERNAME
+
+# Per process cache of the admin user id and of the global category types it
+# owns. Cleared by budgetplanner.signals when a CategoryType is saved or
+# deleted and when the admin user is created or deleted. Signals only reach
+# the process doing the write, so entries also expire after CACHE_TTL
+# seconds.
+CACHE_TTL = 300
+_cache = {}
+
+
+def _expire():
+    if _cache.get('expires', float('inf')) < time.monotonic():
+        _cache.clear()
+    _cache.setdefault('expires', time.monotonic() + CACHE_TTL)
+
+
+def get_admin_id():
+    '''
+    Return the id of the admin user owning the global category types, or
+    None if it does not exist yet.
+    '''
+    _expire()
+    if 'admin_id' not in _cache:
+        _cache['admin_id'] = USER_MODEL.objects.filter(
+            username=ADMIN_USERNAME).values_list('id', flat=True).first()
+    return _cache['admin_id']
+
+
+def get_global_category_types():
+    '''
+    Return a {name: id} dict of the global category types.
+    '''
+    _expire()
+    if 'category_types' not in _cache:
+        _cache['category_types'] = dict(
+            CategoryType.objects.filter(user_id=get_admin_id())
+            .values_list('name', 'id'))
+    return _cache['category_types']
+
+
+def is_global_category_type(category_type):
+    return category_type.user_id is None or \
+        category_type.user_id == get_admin_id()
+
+
+def clear_global_cache():
+    _cache.clear()
@@ -0,0 +1,159 @@
+import codecs
+import csv
+import json
+from itertools import islice
+
+from django.db import transaction
+from django.utils import timezone
+
+from budgetplanner.api.serializers import TransactionImportSerializer
+from budgetplanner.models import Category, Transaction
+from budgetplanner.rollups import apply_transactions
+from budgetplanner.cache import bump_version
+from budgetplanner.search import index_transactions
+
+
+IMPORT_FORMATS = ['csv', 'ndjson']
+IMPORT_BATCH_SIZE = 1000
+# Cap the number of row errors returned so a completely malformed file
+# does not produce a report as large as the file itself.
+MAX_REPORTED_ERRORS = 1000
+
+
+def get_import_format(filename, default='csv'):
+    '''
+    Guess the import format from a file name, e.g. "history.ndjson".
+    '''
+    extension = filename.rsplit('.', 1)[-1].lower() if filename else ''
+    if extension in ('ndjson', 'jsonl'):
+        return 'ndjson'
+    if extension == 'csv':
+        return 'csv'
+    return default
+
+
+def _decode(lines, encoding='utf-8'):
+    '''
+    Lazily decode an iterable of lines, accepting bytes or str.
+    '''
+    lines = iter(lines)
+    first = next(lines, None)
+    if first is None:
+        return
+    if isinstance(first, bytes):
+        decoder = codecs.getincrementaldecoder(encoding)('replace')
+        # Strip a UTF-8 byte order mark written by spreadsheet exports.
+        yield decoder.decode(first).lstrip('\ufeff')
+        for line in lines:
+            yield decoder.decode(line)
+    else:
+        yield first.lstrip('\ufeff')
+        yield from lines
+
+
+def iter_rows(lines, fmt='csv'):
+    '''
+    Parse an iterable of lines into (row_number, data, error) tuples without
+    reading the whole input into memory.
+    '''
+    if fmt not in IMPORT_FORMATS:
+        raise ValueError(f'{fmt} is not a supported import format')
+
+    lines = _decode(lines)
+    if fmt == 'csv':
+        for row_number, row in enumerate(csv.DictReader(lines), start=1):
+            # CSV has no null, an empty cell is a missing value
+            yield row_number, {key: value for key, value in row.items()
+                               if value != ''}, None
+    else:
+        row_number = 0
+        for line in lines:
+            if not line.strip():
+                continue
+            row_number += 1
+            try:
+                data = json.loads(line)
+            except ValueError:
+                yield row_number, None, {'non_field_errors': ['invalid JSON']}
+                continue
+            if not isinstance(data, dict):
+                yield row_number, None, {
+                    'non_field_errors': ['expected a JSON object']}
+                continue
+            yield row_number, data, None
+
+
+def _chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _import_chunk(user, chunk, batch_size):
+    '''
+    Validate a chunk of rows, resolve category names with a single query and
+    insert the valid rows. Returns (created, errors).
+    '''
+    errors = []
+    valid = []
+    for row_number, data, error in chunk:
+        if error is None:
+            serializer = TransactionImportSerializer(data=data)
+            if serializer.is_valid():
+                valid.append((row_number, serializer.validated_data))
+                continue
+            error = serializer.errors
+        errors.append({'row': row_number, 'errors': error})
+
+    names = {data['category'] for _, data in valid}
+    category_ids = dict(Category.objects.filter(user=user, name__in=names)
+                        .values_list('name', 'id'))
+
+    transactions = []
+    for row_number, data in valid:
+        category_id = category_ids.get(data['category'])
+        if category_id is None:
+            errors.append({'row': row_number, 'errors': {'category': [
+                f'{data["category"]} category does not exist']}})
+            continue
+        fields = {key: value for key, value in data.items()
+                  if key != 'category'}
+        transactions.append(Transaction(category_id=category_id, **fields))
+
+    with transaction.atomic():
+        Transaction.objects.bulk_create(transactions, batch_size=batch_size)
+        # bulk_create skips post_save, keep the monthly rollups in sync
+        apply_transactions(transactions)
+    return len(transactions), errors
+
+
+def import_transactions(user, lines, fmt='csv', batch_size=IMPORT_BATCH_SIZE):
+    '''
+    Import transactions for user from an iterable of CSV or NDJSON lines.
+
+    CSV input needs a header row, empty cells are treated as missing. Both
+    formats accept the keys date (YYYY-MM-DD, defaults to today), category
+    (name of one of the user's categories), amount, description and
+    comment. Invalid rows are reported and skipped instead of aborting the
+    import.
+    '''
+    report = {'created': 0, 'error_count': 0, 'errors': []}
+    started = timezone.now()
+    for chunk in _chunked(iter_rows(lines, fmt), batch_size):
+        created, errors = _import_chunk(user, chunk, batch_size)
+        report['created'] += created
+        report['error_count'] += len(errors)
+        room = MAX_REPORTED_ERRORS - len(report['errors'])
+        report['errors'] += sorted(errors, key=lambda e: e['row'])[:room]
+
+    if report['created']:
+        # bulk_create skips the post_save cache invalidation and search
+        # indexing. Not every database returns the ids of bulk inserted
+        # rows, the new ones are found by their auto_now updated_at.
+        bump_version(user.pk)
+        index_transactions(Transaction.objects.filter(
+            category__user=user, updated_at__gte=started))
+    return report
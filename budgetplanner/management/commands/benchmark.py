@@ -0,0 +1,71 @@
+import json
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from budgetplanner import benchmarks
+
+
+USER_MODEL = get_user_model()
+
+
+class Command(BaseCommand):
+    help = ('Seed a throwaway test database and measure the latency and '
+            'query count of the API endpoints against their budgets.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10)
+        parser.add_argument('--categories', type=int, default=10,
+                            help='Categories per user.')
+        parser.add_argument('--transactions', type=int, default=1000,
+                            help='Transactions per user.')
+        parser.add_argument('--iterations', type=int, default=20)
+        parser.add_argument('--endpoint', action='append', dest='endpoints',
+                            choices=list(benchmarks.ENDPOINTS),
+                            help='Only run this endpoint, repeatable.')
+        parser.add_argument('--baseline',
+                            help='JSON results of an earlier run to compare '
+                                 'the p95 latencies against.')
+        parser.add_argument('--tolerance', type=float, default=0.5,
+                            help='Allowed p95 slowdown against the baseline.')
+        parser.add_argument('--output', help='Write the results as JSON.')
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)['endpoints']
+
+        with benchmarks.benchmark_database():
+            user = benchmarks.seed(
+                settings.ADMIN_USERNAME, users=options['users'],
+                categories=options['categories'],
+                transactions=options['transactions'])
+            admin = USER_MODEL.objects.get(username=settings.ADMIN_USERNAME)
+            results = benchmarks.run(
+                user, admin, iterations=options['iterations'],
+                endpoints=options['endpoints'], baseline=baseline,
+                tolerance=options['tolerance'])
+
+        for name, result in results.items():
+            line = (f'{name:<24} {result["queries"]:>3} queries  '
+                    f'p50 {result["p50_ms"]:>8.2f}ms  '
+                    f'p95 {result["p95_ms"]:>8.2f}ms')
+            if result['failures']:
+                self.stdout.write(self.style.ERROR(
+                    f'{line}  {"; ".join(result["failures"])}'))
+            else:
+                self.stdout.write(line)
+
+        if options['output']:
+            dataset = {key: options[key]
+                       for key in ['users', 'categories', 'transactions']}
+            with open(options['output'], 'w') as f:
+                json.dump({'dataset': dataset, 'endpoints': results}, f,
+                          indent=2)
+
+        failed = [name for name, result in results.items()
+                  if result['failures']]
+        if failed:
+            raise CommandError(f'Over budget: {", ".join(failed)}')
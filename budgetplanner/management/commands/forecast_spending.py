@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils.dateparse import parse_date
+
+from budgetplanner.forecasts import store_forecasts
+
+
+class Command(BaseCommand):
+    help = ('Forecast the month end spend of every category and store it '
+            'for the dashboard. Meant to run nightly.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', type=parse_date,
+                            help='Forecast as of this day (YYYY-MM-DD), '
+                                 'defaults to today.')
+
+    def handle(self, *args, **options):
+        start = time.monotonic()
+        count = store_forecasts(today=options['date'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Stored {count} forecasts in {time.monotonic() - start:.2f}s'))
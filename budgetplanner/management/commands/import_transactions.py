@@ -0,0 +1,41 @@
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from budgetplanner.importers import IMPORT_BATCH_SIZE, IMPORT_FORMATS
+from budgetplanner.importers import get_import_format, import_transactions
+
+
+USER_MODEL = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Import transactions for a user from a CSV or NDJSON file.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=IMPORT_FORMATS,
+                            help='Defaults to a guess from the file name.')
+        parser.add_argument('--batch-size', type=int,
+                            default=IMPORT_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        try:
+            user = USER_MODEL.objects.get(username=options['username'])
+        except USER_MODEL.DoesNotExist:
+            raise CommandError(f'{options["username"]} user does not exist')
+
+        fmt = options['format'] or get_import_format(options['path'])
+        start = time.monotonic()
+        with open(options['path'], 'rb') as lines:
+            report = import_transactions(
+                user, lines, fmt=fmt, batch_size=options['batch_size'])
+        elapsed = time.monotonic() - start
+
+        for error in report['errors']:
+            self.stderr.write(f'row {error["row"]}: {dict(error["errors"])}')
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {report["created"]} transactions in {elapsed:.2f}s, '
+            f'{report["error_count"]} rows rejected'))
@@ -0,0 +1,58 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from budgetplanner import benchmarks
+
+
+class Command(BaseCommand):
+    help = ('Seed a throwaway test database and compare the requests per '
+            'second of the WSGI and ASGI handlers under concurrent load.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10)
+        parser.add_argument('--categories', type=int, default=10,
+                            help='Categories per user.')
+        parser.add_argument('--transactions', type=int, default=1000,
+                            help='Transactions per user.')
+        parser.add_argument('--concurrency', type=int, default=16,
+                            help='Requests in flight.')
+        parser.add_argument('--requests', type=int, default=500,
+                            help='Requests per endpoint and handler.')
+        parser.add_argument('--endpoint', action='append', dest='endpoints',
+                            choices=benchmarks.LOAD_ENDPOINTS,
+                            help='Only run this endpoint, repeatable.')
+        parser.add_argument('--output', help='Write the results as JSON.')
+
+    def handle(self, *args, **options):
+        with benchmarks.benchmark_database():
+            user = benchmarks.seed(
+                settings.ADMIN_USERNAME, users=options['users'],
+                categories=options['categories'],
+                transactions=options['transactions'])
+            results = benchmarks.run_load(
+                user, endpoints=options['endpoints'],
+                concurrency=options['concurrency'],
+                requests=options['requests'])
+
+        for name, result in results.items():
+            for handler in ['wsgi', 'asgi']:
+                load = result[handler]
+                line = (f'{name:<20} {handler}  '
+                        f'{load["requests_per_second"]:>8.1f} req/s  '
+                        f'p50 {load["p50_ms"]:>8.2f}ms  '
+                        f'p95 {load["p95_ms"]:>8.2f}ms')
+                if load['errors']:
+                    self.stdout.write(self.style.ERROR(
+                        f'{line}  {load["errors"]} errors'))
+                else:
+                    self.stdout.write(line)
+
+        if options['output']:
+            dataset = {key: options[key] for key in
+                       ['users', 'categories', 'transactions',
+                        'concurrency', 'requests']}
+            with open(options['output'], 'w') as f:
+                json.dump({'dataset': dataset, 'endpoints': results}, f,
+                          indent=2)
@@ -0,0 +1,49 @@
+import csv
+import time
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+
+from budgetplanner.provisioning import bulk_provision_users
+
+
+class Command(BaseCommand):
+    help = ('Create users with their profile, token and default categories '
+            'from a CSV file with username, email and password columns.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Users created per transaction.')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Threads used to hash passwords.')
+
+    def handle(self, *args, **options):
+        created = skipped = 0
+        start = time.monotonic()
+
+        with open(options['path'], newline='') as f:
+            reader = csv.DictReader(f)
+            if 'username' not in (reader.fieldnames or []):
+                raise CommandError('The file needs a username column')
+
+            while True:
+                chunk = list(islice(reader, options['batch_size']))
+                if not chunk:
+                    break
+                chunk_created, chunk_skipped = bulk_provision_users(
+                    chunk, workers=options['workers'])
+                created += len(chunk_created)
+                skipped += len(chunk_skipped)
+                for username in chunk_skipped:
+                    self.stderr.write(f'{username} already exists, skipped')
+
+                elapsed = time.monotonic() - start
+                self.stdout.write(f'{created} users created '
+                                  f'({created / elapsed:.1f} users/s)')
+
+        elapsed = time.monotonic() - start
+        self.stdout.write(self.style.SUCCESS(
+            f'Created {created} users in {elapsed:.2f}s '
+            f'({created / elapsed if elapsed else 0:.1f} users/s), '
+            f'{skipped} skipped'))
@@ -0,0 +1,27 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from budgetplanner.rollups import rebuild_rollups
+
+
+USER_MODEL = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Recompute the monthly transaction rollups from scratch.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--username',
+                            help='Only rebuild the rollups of this user.')
+
+    def handle(self, *args, **options):
+        user = None
+        if options['username']:
+            try:
+                user = USER_MODEL.objects.get(username=options['username'])
+            except USER_MODEL.DoesNotExist:
+                raise CommandError(
+                    f'{options["username"]} user does not exist')
+
+        count = rebuild_rollups(user=user)
+        self.stdout.write(self.style.SUCCESS(f'Wrote {count} rollup rows'))
@@ -0,0 +1,27 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from budgetplanner.search import rebuild_index
+
+
+USER_MODEL = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Recreate the full-text search index from scratch.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--username',
+                            help='Only rebuild the documents of this user.')
+
+    def handle(self, *args, **options):
+        user = None
+        if options['username']:
+            try:
+                user = USER_MODEL.objects.get(username=options['username'])
+            except USER_MODEL.DoesNotExist:
+                raise CommandError(
+                    f'{options["username"]} user does not exist')
+
+        count = rebuild_index(user=user)
+        self.stdout.write(self.style.SUCCESS(f'Indexed {count} documents'))
@@ -1,3 +1,5 @@
+import datetime
+
 from django.db import models
 from django.contrib.auth import get_user_model
 
@@ -8,6 +10,13 @@ class CategoryType(models.Model):
     name = models.CharField(max_length=50)
     user = models.ForeignKey(
         USER_MODEL, on_delete=models.CASCADE, null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'name'],
+                                    name='bp_category_type_user_name'),
+        ]
 
     def __str__(self):
         return self.name
@@ -21,16 +30,21 @@ class Category(models.Model):
                                  null=True, blank=True, related_name='categories')
     amount_planned = models.FloatField(default=0)
     description = models.TextField(default='', blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         verbose_name_plural = 'Categories'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'name'],
+                                    name='bp_category_user_name'),
+        ]
 
     def __str__(self):
         return self.user.username + ' - ' + self.name.capitalize()
 
 
 class Transaction(models.Model):
-    date = models.DateField(auto_now_add=True)
+    date = models.DateField(default=datetime.date.today)
     category = models.ForeignKey(Category, on_delete=models.SET_NULL,
                                  blank=True, null=True, related_name='transaction')
     amount = models.FloatField()
@@ -38,5 +52,66 @@ class Transaction(models.Model):
     comment = models.TextField(null=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['category', 'date'],
+                         name='bp_txn_category_date_idx'),
+            models.Index(fields=['category', 'updated_at'],
+                         name='bp_txn_category_updated_idx'),
+        ]
+
     def __str__(self):
         return self.description[:10]
+
+
+class MonthlyRollup(models.Model):
+    '''
+    Transaction count and sum per user, category and month. Maintained
+    incrementally by budgetplanner.signals, rebuilt with the rebuild_rollups
+    management command.
+    '''
+    user = models.ForeignKey(USER_MODEL, on_delete=models.CASCADE)
+    category = models.ForeignKey(Category, on_delete=models.CASCADE,
+                                 related_name='rollups')
+    month = models.DateField()  # first day of the month
+    count = models.IntegerField(default=0)
+    total = models.FloatField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'month', 'category'],
+                                    name='bp_rollup_user_month_category'),
+        ]
+
+    def __str__(self):
+        return f'{self.category} - {self.month:%Y-%m}'
+
+
+class CategoryForecast(models.Model):
+    '''
+    Projected month end spend of a category, stored by the
+    forecast_spending management command.
+    '''
+    ON_TRACK = 'on_track'
+    OVER_BUDGET = 'over_budget'
+    STATUS_CHOICES = [(ON_TRACK, 'On track'), (OVER_BUDGET, 'Over budget')]
+
+    user = models.ForeignKey(USER_MODEL, on_delete=models.CASCADE)
+    category = models.ForeignKey(Category, on_delete=models.CASCADE,
+                                 related_name='forecasts')
+    month = models.DateField()  # first day of the month
+    date = models.DateField()  # day the forecast was made as of
+    planned = models.FloatField()
+    spent = models.FloatField()
+    projected = models.FloatField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES)
+    computed_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'month', 'category'],
+                                    name='bp_forecast_user_month_category'),
+        ]
+
+    def __str__(self):
+        return f'{self.category} - {self.month:%Y-%m}'
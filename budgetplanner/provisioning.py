@@ -0,0 +1,117 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+
+from rest_framework.authtoken.models import Token
+
+from profiles.models import Profile
+from budgetplanner.models import CategoryType, Category
+from budgetplanner.global_types import get_global_category_types
+from budgetplanner.global_types import clear_global_cache
+from budgetplanner.search import index_categories
+
+
+USER_MODEL = get_user_model()
+DEFAULT_CATEGORY_TYPES = settings.BUDGET_PLANNER_DEFAULTS['CATEGORY_TYPES']
+DEFAULT_CATEGORIES = settings.BUDGET_PLANNER_DEFAULTS['CATEGORIES']
+
+
+def get_expenditure_type_id():
+    try:
+        return get_global_category_types()['expenditure']
+    except KeyError:
+        raise CategoryType.DoesNotExist(
+            'expenditure category type does not exist')
+
+
+def build_default_categories(user, expenditure_id):
+    return [Category(name=category.get('name'),
+                     user=user,
+                     cat_type_id=expenditure_id,
+                     description=category.get('description'))
+            for category in DEFAULT_CATEGORIES]
+
+
+def provision_admin(admin):
+    '''
+    Create the global default category types owned by the admin user.
+    '''
+    # bulk_create does not send post_save, clear the cache explicitly
+    CategoryType.objects.bulk_create(
+        [CategoryType(name=category_type, user=admin)
+         for category_type in DEFAULT_CATEGORY_TYPES])
+    clear_global_cache()
+
+
+def provision_user(user):
+    '''
+    Create the profile and default expenditure categories of a new user in
+    a single transaction. Superusers do not get a profile.
+    '''
+    expenditure_id = get_expenditure_type_id()
+    with transaction.atomic():
+        if not user.is_superuser:
+            Profile.objects.create(user=user)
+        Category.objects.bulk_create(
+            build_default_categories(user, expenditure_id))
+        # bulk_create skips the post_save search indexing
+        index_categories(Category.objects.filter(user=user))
+
+
+def _hash_passwords(users_data, workers):
+    '''
+    Hash passwords in a thread pool. The PBKDF2 hasher releases the GIL, so
+    this scales with the number of cores.
+    '''
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(
+            lambda data: make_password(data.get('password') or None),
+            users_data))
+
+
+def bulk_provision_users(users_data, workers=None):
+    '''
+    Create users with their profile, token and default categories using one
+    bulk insert per table, inside a single transaction. users_data is a list
+    of dicts with username, email, password and optionally first_name and
+    last_name. Usernames that already exist are skipped.
+
+    Returns a (created, skipped) tuple of username lists. This does not go
+    through post_save, the end state matches provision_user().
+    '''
+    usernames = [data['username'] for data in users_data]
+    existing = set(USER_MODEL.objects.filter(username__in=usernames)
+                   .values_list('username', flat=True))
+    new_users, skipped, seen = [], [], set()
+    for data in users_data:
+        if data['username'] in existing or data['username'] in seen:
+            skipped.append(data['username'])
+            continue
+        seen.add(data['username'])
+        new_users.append(data)
+
+    passwords = _hash_passwords(new_users, workers)
+    users = [USER_MODEL(username=data['username'],
+                        email=data.get('email') or '',
+                        first_name=data.get('first_name') or '',
+                        last_name=data.get('last_name') or '',
+                        password=password)
+             for data, password in zip(new_users, passwords)]
+
+    expenditure_id = get_expenditure_type_id()
+    with transaction.atomic():
+        USER_MODEL.objects.bulk_create(users)
+        # Not every backend sets primary keys on bulk_create, fetch them
+        users = list(USER_MODEL.objects.filter(username__in=seen))
+        Profile.objects.bulk_create([Profile(user=user) for user in users])
+        Token.objects.bulk_create(
+            [Token(user=user, key=Token.generate_key()) for user in users])
+        Category.objects.bulk_create(
+            [category for user in users
+             for category in build_default_categories(user, expenditure_id)])
+        index_categories(Category.objects.filter(user__in=users))
+
+    return [data['username'] for data in new_users], skipped
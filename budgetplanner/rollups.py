@@ -0,0 +1,182 @@
+import datetime
+from collections import defaultdict
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncMonth
+
+from budgetplanner.models import Category, MonthlyRollup, Transaction
+
+
+# Longest range of monthly_report(), every month lists every category
+MAX_REPORT_MONTHS = 120
+
+def month_start(date):
+    return date.replace(day=1)
+
+
+def get_rollup_key(instance):
+    '''
+    Return the (category_id, month, amount) a transaction contributes to the
+    rollup table, or None if it does not belong to a category.
+    '''
+    if instance.category_id is None or instance.date is None:
+        return None
+    # Values assigned by callers may not have been converted yet,
+    # e.g. date='2020-01-31'
+    date = Transaction._meta.get_field('date').to_python(instance.date)
+    return (instance.category_id, month_start(date),
+            float(instance.amount or 0))
+
+
+def apply_delta(category_id, month, count, total, user_id=None):
+    '''
+    Add count and total to a rollup row, creating it if needed.
+    '''
+    if not count and not total:
+        return
+    if user_id is None:
+        user_id = Category.objects.values_list('user_id', flat=True) \
+            .get(pk=category_id)
+    if user_id is None:
+        return
+
+    rows = MonthlyRollup.objects.filter(
+        user_id=user_id, category_id=category_id, month=month)
+    if rows.update(count=F('count') + count, total=F('total') + total):
+        if count < 0:
+            # Drop months that no longer have any transaction
+            rows.filter(count__lte=0).delete()
+        return
+    try:
+        with transaction.atomic():
+            MonthlyRollup.objects.create(
+                user_id=user_id, category_id=category_id, month=month,
+                count=count, total=total)
+    except IntegrityError:
+        # Created concurrently, apply the delta to that row instead.
+        rows.update(count=F('count') + count, total=F('total') + total)
+
+
+def apply_transactions(transactions, sign=1):
+    '''
+    Apply a batch of transactions to the rollup table with one update per
+    (category, month). Used after bulk operations that skip signals.
+    '''
+    deltas = defaultdict(lambda: [0, 0])
+    for instance in transactions:
+        key = get_rollup_key(instance)
+        if key is None:
+            continue
+        category_id, month, amount = key
+        deltas[(category_id, month)][0] += sign
+        deltas[(category_id, month)][1] += sign * amount
+
+    user_ids = dict(Category.objects
+                    .filter(pk__in={key[0] for key in deltas})
+                    .values_list('id', 'user_id'))
+    for (category_id, month), (count, total) in deltas.items():
+        apply_delta(category_id, month, count, total,
+                    user_id=user_ids.get(category_id))
+
+
+def rebuild_rollups(user=None):
+    '''
+    Recompute the rollup table from the transactions, for a single user or
+    for everybody. Returns the number of rollup rows written.
+    '''
+    transactions = Transaction.objects.filter(category__user__isnull=False)
+    rollups = MonthlyRollup.objects.all()
+    if user is not None:
+        transactions = transactions.filter(category__user=user)
+        rollups = rollups.filter(user=user)
+
+    rows = transactions \
+        .annotate(month=TruncMonth('date')) \
+        .values('category__user_id', 'category_id', 'month') \
+        .annotate(count=Count('id'), total=Sum('amount')) \
+        .order_by()
+
+    with transaction.atomic():
+        rollups.delete()
+        created = MonthlyRollup.objects.bulk_create(
+            (MonthlyRollup(user_id=row['category__user_id'],
+                           category_id=row['category_id'],
+                           month=row['month'],
+                           count=row['count'],
+                           total=row['total'])
+             for row in rows.iterator()),
+            batch_size=1000)
+    return len(created)
+
+
+def next_month(month):
+    '''
+    Return the first day of the month after month, None after December 9999.
+    '''
+    if month.year == datetime.MAXYEAR and month.month == 12:
+        return None
+    return (month + datetime.timedelta(days=31)).replace(day=1)
+
+
+def count_months(first, last):
+    return (last.year - first.year) * 12 + last.month - first.month + 1
+
+
+def monthly_report(user, start=None, end=None):
+    '''
+    Planned vs actual amounts per month, per category and per category type.
+    Every month from start (or the first month with transactions) to end
+    (or the last one) is reported with every category of the user, budgets
+    without spending included. Planned amounts are the current budgets of
+    the categories. start and end are dates matched against the first day
+    of each month. Raises ValueError for ranges over MAX_REPORT_MONTHS.
+    '''
+    rollups = MonthlyRollup.objects.filter(user=user)
+    if start is not None:
+        rollups = rollups.filter(month__gte=month_start(start))
+    if end is not None:
+        rollups = rollups.filter(month__lte=month_start(end))
+    actuals = {(month, category_id): (count, total)
+               for month, category_id, count, total in rollups.values_list(
+                   'month', 'category_id', 'count', 'total')}
+
+    months = sorted({month for month, _ in actuals})
+    if start is not None:
+        first = month_start(start)
+    elif months:
+        first = months[0]
+    else:
+        return []
+    if end is not None:
+        last = month_start(end)
+    else:
+        last = max(months[-1:] + [first])
+    if count_months(first, last) > MAX_REPORT_MONTHS:
+        raise ValueError(
+            f'Reports are limited to {MAX_REPORT_MONTHS} months')
+
+    categories = list(Category.objects.filter(user=user).order_by('name')
+                      .values_list('id', 'name', 'amount_planned',
+                                   'cat_type__name'))
+
+    report = []
+    month = first
+    while month is not None and month <= last:
+        entry = {'month': f'{month:%Y-%m}', 'planned': 0, 'actual': 0,
+                 'categories': [], 'category_types': {}}
+        for category_id, name, planned, cat_type in categories:
+            count, total = actuals.get((month, category_id), (0, 0))
+            entry['planned'] += planned
+            entry['actual'] += total
+            entry['categories'].append({
+                'id': category_id, 'name': name, 'category_type': cat_type,
+                'planned': planned, 'actual': total, 'count': count})
+            totals = entry['category_types'].setdefault(
+                cat_type, {'name': cat_type, 'planned': 0, 'actual': 0})
+            totals['planned'] += planned
+            totals['actual'] += total
+        entry['category_types'] = list(entry['category_types'].values())
+        report.append(entry)
+        month = next_month(month)
+    return report
@@ -0,0 +1,339 @@
+"""
+Full-text search over the transactions and categories of a user.
+
+Both kinds of documents are stored in the bp_search table, created by
+create_index() after migrate:
+
+- SQLite: an FTS5 virtual table ranked with bm25(). The owner column holds
+  u<user id> and kind tokens so these filters are answered by the index
+  too.
+- PostgreSQL: a tsvector column with a GIN index ranked with ts_rank().
+
+Other databases, and SQLite builds without FTS5, fall back to unindexed
+icontains lookups.
+
+Documents are keyed by get_doc_id() and kept in sync by
+budgetplanner.signals. Bulk writes skip the signals and call
+index_transactions() / index_categories() instead, rebuild_index() (the
+rebuild_search_index command) recreates the documents from scratch.
+"""
+
+import re
+
+from django.conf import settings
+from django.db import connections, router
+from django.db.models import Q
+
+from budgetplanner.models import Category, Transaction
+
+
+TABLE = 'bp_search'
+KINDS = ['transaction', 'category']
+INDEX_BATCH_SIZE = 1000
+
+SEARCH_SETTINGS = settings.BUDGET_PLANNER_SEARCH
+
+# Words as split by the FTS5 unicode61 and PostgreSQL parsers
+_WORD = re.compile(r'[^\W_]+')
+
+
+def get_doc_id(kind, pk):
+    return pk * len(KINDS) + KINDS.index(kind)
+
+
+def parse_doc_id(doc_id):
+    return KINDS[doc_id % len(KINDS)], doc_id // len(KINDS)
+
+
+def get_words(query):
+    return _WORD.findall(query.lower())
+
+
+class SQLiteBackend:
+
+    def create(self, cursor):
+        cursor.execute(
+            f'CREATE VIRTUAL TABLE IF NOT EXISTS {TABLE} USING fts5('
+            f"owner, body, tokenize='porter unicode61')")
+
+    def delete(self, cursor, doc_ids):
+        cursor.executemany(f'DELETE FROM {TABLE} WHERE rowid = %s',
+                           [(doc_id,) for doc_id in doc_ids])
+
+    def delete_user(self, cursor, user_id):
+        cursor.execute(
+            f'DELETE FROM {TABLE} WHERE rowid IN (SELECT rowid FROM {TABLE} '
+            f'WHERE {TABLE} MATCH %s)', [f'owner : "u{user_id}"'])
+
+    def upsert(self, cursor, documents):
+        documents = list(documents)
+        self.delete(cursor, [doc_id for doc_id, _, _ in documents])
+        cursor.executemany(
+            f'INSERT INTO {TABLE} (rowid, owner, body) VALUES (%s, %s, %s)',
+            [(doc_id, f'u{user_id} {parse_doc_id(doc_id)[0]}', body)
+             for doc_id, user_id, body in documents])
+
+    def get_match(self, user_id, words, kind):
+        owner = [f'owner : "u{user_id}"']
+        if kind is not None:
+            owner.append(f'owner : "{kind}"')
+        # Every word is quoted, the last one also matches as a prefix
+        terms = [f'body : "{word}"' for word in words]
+        terms[-1] += ' *'
+        return ' AND '.join(owner + terms)
+
+    def count(self, cursor, user_id, words, kind):
+        cursor.execute(
+            f'SELECT count(*) FROM {TABLE} WHERE {TABLE} MATCH %s',
+            [self.get_match(user_id, words, kind)])
+        return cursor.fetchone()[0]
+
+    def search(self, cursor, user_id, words, kind, limit, offset):
+        # bm25() is lower for better matches
+        cursor.execute(
+            f'SELECT rowid, -bm25({TABLE}) FROM {TABLE} '
+            f'WHERE {TABLE} MATCH %s ORDER BY bm25({TABLE}), rowid '
+            f'LIMIT %s OFFSET %s',
+            [self.get_match(user_id, words, kind), limit, offset])
+        return cursor.fetchall()
+
+
+class PostgreSQLBackend:
+
+    def create(self, cursor):
+        cursor.execute(
+            f'CREATE TABLE IF NOT EXISTS {TABLE} (id bigint PRIMARY KEY, '
+            f'user_id integer NOT NULL, document tsvector NOT NULL)')
+        cursor.execute(
+            f'CREATE INDEX IF NOT EXISTS {TABLE}_document_idx '
+            f'ON {TABLE} USING gin (document)')
+        cursor.execute(
+            f'CREATE INDEX IF NOT EXISTS {TABLE}_user_idx '
+            f'ON {TABLE} (user_id)')
+
+    def delete(self, cursor, doc_ids):
+        cursor.execute(f'DELETE FROM {TABLE} WHERE id = ANY(%s)',
+                       [list(doc_ids)])
+
+    def delete_user(self, cursor, user_id):
+        cursor.execute(f'DELETE FROM {TABLE} WHERE user_id = %s', [user_id])
+
+    def upsert(self, cursor, documents):
+        cursor.executemany(
+            f'INSERT INTO {TABLE} (id, user_id, document) '
+            f'VALUES (%s, %s, to_tsvector(%s::regconfig, %s)) '
+            f'ON CONFLICT (id) DO UPDATE SET user_id = EXCLUDED.user_id, '
+            f'document = EXCLUDED.document',
+            [(doc_id, user_id, SEARCH_SETTINGS['CONFIG'], body)
+             for doc_id, user_id, body in documents])
+
+    def get_where(self, user_id, words, kind):
+        # Every word is required, the last one also matches as a prefix
+        query = ' & '.join(words[:-1] + [f'{words[-1]}:*'])
+        where = 'user_id = %s AND document @@ to_tsquery(%s::regconfig, %s)'
+        params = [user_id, SEARCH_SETTINGS['CONFIG'], query]
+        if kind is not None:
+            where += ' AND mod(id, %s) = %s'
+            params += [len(KINDS), KINDS.index(kind)]
+        return where, params
+
+    def count(self, cursor, user_id, words, kind):
+        where, params = self.get_where(user_id, words, kind)
+        cursor.execute(f'SELECT count(*) FROM {TABLE} WHERE {where}', params)
+        return cursor.fetchone()[0]
+
+    def search(self, cursor, user_id, words, kind, limit, offset):
+        where, params = self.get_where(user_id, words, kind)
+        cursor.execute(
+            f'SELECT id, ts_rank(document, to_tsquery(%s::regconfig, %s)) '
+            f'AS rank FROM {TABLE} WHERE {where} '
+            f'ORDER BY rank DESC, id LIMIT %s OFFSET %s',
+            params[1:3] + params + [limit, offset])
+        return cursor.fetchall()
+
+
+_fts5 = {}
+
+
+def _has_fts5(connection):
+    if connection.alias not in _fts5:
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA compile_options')
+            _fts5[connection.alias] = any(
+                option == 'ENABLE_FTS5' for option, in cursor.fetchall())
+    return _fts5[connection.alias]
+
+
+def get_backend(connection):
+    '''
+    Return the search backend of a connection or None to fall back to
+    icontains lookups.
+    '''
+    if connection.vendor == 'postgresql':
+        return PostgreSQLBackend()
+    if connection.vendor == 'sqlite' and _has_fts5(connection):
+        return SQLiteBackend()
+    return None
+
+
+def _get_write_connection():
+    return connections[router.db_for_write(Transaction)]
+
+
+def create_index(using):
+    connection = connections[using]
+    backend = get_backend(connection)
+    if backend is not None:
+        with connection.cursor() as cursor:
+            backend.create(cursor)
+
+
+def _write(documents, removed):
+    connection = _get_write_connection()
+    backend = get_backend(connection)
+    if backend is None:
+        return
+    with connection.cursor() as cursor:
+        if removed:
+            backend.delete(cursor, removed)
+        if documents:
+            backend.upsert(cursor, documents)
+
+
+def _index(kind, rows):
+    '''
+    Write the (pk, user id, *text) rows of kind in batches, rows without a
+    user are removed from the index. Returns the number of documents.
+    '''
+    count, documents, removed = 0, [], []
+    for pk, user_id, *text in rows:
+        doc_id = get_doc_id(kind, pk)
+        if user_id is None:
+            removed.append(doc_id)
+        else:
+            documents.append((doc_id, user_id, ' '.join(filter(None, text))))
+        if len(documents) + len(removed) >= INDEX_BATCH_SIZE:
+            _write(documents, removed)
+            count += len(documents)
+            documents, removed = [], []
+    _write(documents, removed)
+    return count + len(documents)
+
+
+def index_transactions(transactions):
+    return _index('transaction', transactions.values_list(
+        'id', 'category__user_id', 'description', 'comment').iterator())
+
+
+def index_categories(categories):
+    return _index('category', categories.values_list(
+        'id', 'user_id', 'name', 'description', 'cat_type__name').iterator())
+
+
+def remove(kind, pks):
+    _write([], [get_doc_id(kind, pk) for pk in pks])
+
+
+def rebuild_index(user=None):
+    '''
+    Recreate the documents of user, or of every user. Returns the number of
+    indexed documents.
+    '''
+    connection = _get_write_connection()
+    backend = get_backend(connection)
+    if backend is None:
+        return 0
+
+    transactions = Transaction.objects.all()
+    categories = Category.objects.all()
+    with connection.cursor() as cursor:
+        if user is None:
+            cursor.execute(f'DELETE FROM {TABLE}')
+        else:
+            backend.delete_user(cursor, user.pk)
+            transactions = transactions.filter(category__user=user)
+            categories = categories.filter(user=user)
+    return index_transactions(transactions) + index_categories(categories)
+
+
+def _fallback_hits(user, words, kind):
+    transactions, categories = Q(), Q()
+    for word in words:
+        transactions &= Q(description__icontains=word) | \
+            Q(comment__icontains=word)
+        categories &= Q(name__icontains=word) | \
+            Q(description__icontains=word) | \
+            Q(cat_type__name__icontains=word)
+    hits = []
+    if kind in (None, 'category'):
+        hits += [('category', pk, 0.0) for pk in Category.objects
+                 .filter(categories, user=user).order_by('-id')
+                 .values_list('id', flat=True)]
+    if kind in (None, 'transaction'):
+        hits += [('transaction', pk, 0.0) for pk in Transaction.objects
+                 .filter(transactions, category__user=user).order_by('-id')
+                 .values_list('id', flat=True)]
+    return hits
+
+
+def _get_read_connection():
+    return connections[router.db_for_read(Transaction)]
+
+
+def count(user, query, kind=None):
+    words = get_words(query)
+    if not words:
+        return 0
+    connection = _get_read_connection()
+    backend = get_backend(connection)
+    if backend is None:
+        return len(_fallback_hits(user, words, kind))
+    with connection.cursor() as cursor:
+        return backend.count(cursor, user.pk, words, kind)
+
+
+def search(user, query, limit, offset=0, kind=None):
+    '''
+    Return the [(kind, pk, rank)] documents of user, optionally only of one
+    kind, matching every word of query, best matches first. The last word
+    also matches as a prefix.
+    '''
+    words = get_words(query)
+    if not words:
+        return []
+    connection = _get_read_connection()
+    backend = get_backend(connection)
+    if backend is None:
+        return _fallback_hits(user, words, kind)[offset:offset + limit]
+    with connection.cursor() as cursor:
+        rows = backend.search(cursor, user.pk, words, kind, limit, offset)
+    return [parse_doc_id(doc_id) + (rank,) for doc_id, rank in rows]
+
+
+def has_index():
+    return get_backend(_get_read_connection()) is not None
+
+
+class SearchHits:
+    '''
+    Lazy sequence of the search() hits for the Django paginator, only the
+    count and the requested page are queried.
+    '''
+
+    def __init__(self, user, query, kind=None):
+        self.user = user
+        self.query = query
+        self.kind = kind
+
+    def count(self):
+        return count(self.user, self.query, kind=self.kind)
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice) or key.step is not None:
+            raise TypeError('SearchHits only support slices')
+        start = key.start or 0
+        return search(self.user, self.query, key.stop - start,
+                      offset=start, kind=self.kind)
@@ -1,33 +1,166 @@
 from django.contrib.auth import get_user_model
-from django.db.models.signals import post_save
+from django.db.models import DEFERRED
+from django.db.models.signals import post_init, pre_save, post_save
+from django.db.models.signals import post_delete, post_migrate, pre_delete
 from django.dispatch import receiver
 from django.conf import settings
-from profiles.models import Profile
-from budgetplanner.models import CategoryType, Category
+from budgetplanner.models import CategoryType, Category, Transaction
+from budgetplanner.cache import GLOBAL_VERSION_OWNER, bump_version
+from budgetplanner.rollups import apply_delta, get_rollup_key
+from budgetplanner.provisioning import provision_admin, provision_user
+from budgetplanner.global_types import clear_global_cache
+from budgetplanner.global_types import is_global_category_type
+from budgetplanner import search
 
 
 USER_MODEL = get_user_model()
 ADMIN_USERNAME = settings.ADMIN_USERNAME
-DEFAULT_CATEGORY_TYPES = settings.BUDGET_PLANNER_DEFAULTS['CATEGORY_TYPES']
-DEFAULT_CATEGORIES = settings.BUDGET_PLANNER_DEFAULTS['CATEGORIES']
 
 
 @receiver(post_save, sender=USER_MODEL)
 def create_default_category(sender, instance, created, **kwargs):
     if created:
         if instance.is_superuser and instance.username == ADMIN_USERNAME:
-            admin = USER_MODEL.objects.get(username=ADMIN_USERNAME)
-            for category_type in DEFAULT_CATEGORY_TYPES:
-                CategoryType.objects.create(name=category_type, user=admin)
+            provision_admin(instance)
 
         else:
-            # Create default expenditure categories
-            expenditure = CategoryType.objects.get(name='expenditure')
-
-            for category in DEFAULT_CATEGORIES:
-                Category.objects.create(
-                    name=category.get('name'),
-                    user=instance,
-                    cat_type=expenditure,
-                    description=category.get('description')
-                )
+            # Profile and default expenditure categories
+            provision_user(instance)
+
+
+@receiver(post_save, sender=CategoryType)
+@receiver(post_delete, sender=CategoryType)
+def invalidate_global_category_types(sender, **kwargs):
+    clear_global_cache()
+
+
+@receiver(post_delete, sender=USER_MODEL)
+def invalidate_admin_id(sender, instance, **kwargs):
+    if instance.username == ADMIN_USERNAME:
+        clear_global_cache()
+
+
+def _category_user_id(instance):
+    # Avoid a query when the category was already loaded
+    if Transaction.category.is_cached(instance) and instance.category:
+        return instance.category.user_id
+    return None
+
+
+@receiver(post_save, sender=Transaction)
+@receiver(post_delete, sender=Transaction)
+def invalidate_transaction_cache(sender, instance, **kwargs):
+    # Connected before the rollup receivers so that _rollup_key still holds
+    # the previous category. Both the new and the previous category may
+    # have changed totals.
+    category_ids = {instance.category_id}
+    if instance._rollup_key not in (None, DEFERRED):
+        category_ids.add(instance._rollup_key[0])
+    category_ids.discard(None)
+
+    user_ids = {_category_user_id(instance)} - {None}
+    if not user_ids:
+        user_ids = set(Category.objects.filter(pk__in=category_ids)
+                       .values_list('user_id', flat=True))
+    for user_id in user_ids - {None}:
+        bump_version(user_id)
+
+
+ROLLUP_FIELDS = {'category_id', 'date', 'amount'}
+
+
+@receiver(post_init, sender=Transaction)
+def remember_rollup_key(sender, instance, **kwargs):
+    if ROLLUP_FIELDS.issubset(instance.__dict__):
+        instance._rollup_key = get_rollup_key(instance)
+    else:
+        # Loaded with .only()/.defer(), resolved in pre_save if needed
+        instance._rollup_key = DEFERRED
+
+
+@receiver(pre_save, sender=Transaction)
+def load_rollup_key(sender, instance, **kwargs):
+    if instance._state.adding:
+        instance._rollup_key = None
+    elif instance._rollup_key is DEFERRED:
+        old = Transaction.objects.filter(pk=instance.pk).first()
+        instance._rollup_key = old and old._rollup_key
+
+
+@receiver(post_save, sender=Transaction)
+def update_rollup(sender, instance, **kwargs):
+    old_key = instance._rollup_key
+    new_key = get_rollup_key(instance)
+    if old_key == new_key:
+        return
+
+    if old_key is not None:
+        category_id, month, amount = old_key
+        apply_delta(category_id, month, -1, -amount)
+    if new_key is not None:
+        category_id, month, amount = new_key
+        apply_delta(category_id, month, 1, amount,
+                    user_id=_category_user_id(instance))
+    instance._rollup_key = new_key
+
+
+@receiver(post_delete, sender=Transaction)
+def remove_from_rollup(sender, instance, **kwargs):
+    if instance._rollup_key is DEFERRED:
+        instance._rollup_key = get_rollup_key(instance)
+    if instance._rollup_key is not None:
+        category_id, month, amount = instance._rollup_key
+        apply_delta(category_id, month, -1, -amount)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_category_cache(sender, instance, **kwargs):
+    if instance.user_id is not None:
+        bump_version(instance.user_id)
+
+
+@receiver(post_save, sender=CategoryType)
+@receiver(post_delete, sender=CategoryType)
+def invalidate_category_type_cache(sender, instance, **kwargs):
+    if is_global_category_type(instance):
+        # Global category types are listed for every user
+        bump_version(GLOBAL_VERSION_OWNER)
+    else:
+        bump_version(instance.user_id)
+
+
+@receiver(post_migrate)
+def create_search_index(sender, using, **kwargs):
+    if sender.name == 'budgetplanner':
+        search.create_index(using)
+
+
+@receiver(post_save, sender=Transaction)
+def index_transaction(sender, instance, **kwargs):
+    search.index_transactions(Transaction.objects.filter(pk=instance.pk))
+
+
+@receiver(post_delete, sender=Transaction)
+def unindex_transaction(sender, instance, **kwargs):
+    search.remove('transaction', [instance.pk])
+
+
+@receiver(post_save, sender=Category)
+def index_category(sender, instance, **kwargs):
+    search.index_categories(Category.objects.filter(pk=instance.pk))
+
+
+@receiver(pre_delete, sender=Category)
+def unindex_category(sender, instance, **kwargs):
+    # Its transactions lose their category, and their owner
+    search.remove('transaction', instance.transaction.values_list(
+        'id', flat=True))
+    search.remove('category', [instance.pk])
+
+
+@receiver(post_save, sender=CategoryType)
+def index_category_type(sender, instance, created, **kwargs):
+    if not created:
+        # The type name is part of the category documents
+        search.index_categories(instance.categories.all())
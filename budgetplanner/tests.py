@@ -1,18 +1,42 @@
+import asyncio
+import datetime
+import json
 from pprint import pprint
+from unittest import skipUnless
 
+from asgiref.sync import async_to_sync
 from django.contrib.auth import get_user_model
 from django.conf import settings
-from django.urls import reverse
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, router
+from django.http import HttpResponse
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve, reverse
 
 from django.conf import settings
 
 from rest_framework import status
 from rest_framework.authtoken.models import Token
-from rest_framework.test import APITestCase
+from rest_framework.test import APITestCase, APITransactionTestCase
 
 from budgetplanner.api.serializers import CategoryTypeSerializer
 from budgetplanner.api.serializers import CategorySerializer
-from budgetplanner.models import CategoryType, Category
+from budgetplanner.models import CategoryType, Category, Transaction
+from budgetplanner.models import MonthlyRollup
+from budgetplanner.cache import get_cache
+from budgetplanner.global_types import clear_global_cache
+from budgetplanner import analytics
+from budgetplanner.provisioning import bulk_provision_users
+from budgetplanner.rollups import rebuild_rollups
+from budgetplanner.forecasts import store_forecasts
+from budgetplanner import benchmarks
+from budgetplanner import search
+from budgetbuddy.async_views import ASGI_URLCONF, BudgetBuddyASGIHandler
+from budgetbuddy.db.routers import ReplicaMiddleware
+from budgetbuddy.middleware import normalize_sql
 
 
 USER_MODEL = get_user_model()
@@ -78,6 +102,11 @@ class BudgetPlannerEndpointTestCase(APITestCase):
         '''
         Create objects
         '''
+        # Start every test with empty caches
+        get_cache().clear()
+        clear_global_cache()
+        analytics.snapshots.clear()
+
         # Login admin and create default category types
         self._login_user(self.admin_creds['username'])
         # response = self.client.post(path=reverse('create-defaults'))
@@ -139,6 +168,51 @@ class CategoryTypeEndpointTestCase(BudgetPlannerEndpointTestCase):
         response = self.client.get(path=reverse(self.list_endpoint))
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
 
+    def test_global_cat_type_cache(self):
+        self._login_user(self.usera_creds['username'])
+        # warm up the global category type cache
+        self.client.get(path=reverse(self.list_endpoint))
+        get_cache().clear()
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(path=reverse(self.list_endpoint))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            response = self.client.post(path=reverse(self.list_endpoint),
+                                        data={'name': 'income'})
+            self.assertEqual(response.status_code,
+                             status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(any('"username" =' in query['sql']
+                             for query in context.captured_queries))
+
+        # renaming a global category type invalidates the cache
+        income = CategoryType.objects.get(name='income')
+        income.name = 'salary'
+        income.save()
+        response = self.client.post(path=reverse(self.list_endpoint),
+                                    data={'name': 'income'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        response = self.client.post(path=reverse(self.list_endpoint),
+                                    data={'name': 'salary'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self._logout_user()
+
+    def test_create_default_cat_types(self):
+        self._login_user(self.admin_creds['username'])
+        # the default types exist already, calling it again is a no-op
+        for _ in range(2):
+            response = self.client.post(path=reverse('create-defaults'))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual([item['name'] for item in response.data],
+                             ['income', 'savings', 'expenditure'])
+        admin = USER_MODEL.objects.get(username=ADMIN_USERNAME)
+        self.assertEqual(CategoryType.objects.filter(user=admin).count(), 3)
+
+        CategoryType.objects.filter(user=admin, name='savings').delete()
+        response = self.client.post(path=reverse('create-defaults'))
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(CategoryType.objects.filter(user=admin).count(), 3)
+        self._logout_user()
+
     def test_create_cat_type(self):
         '''
         Create common category type for usera and userb. The API allows
@@ -421,6 +495,225 @@ class CategoryEnpointTestCase(BudgetPlannerEndpointTestCase):
         response = self.client.get(usera_endpoint)
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_bulk_create_cat_endpoint(self):
+        expenditure = CategoryType.objects.get(name='expenditure')
+        userb_cat_type = CategoryType.objects.get(name='userb_test_cat_type')
+        data = [{'name': f'bulk_{i}', 'category_type_id': expenditure.id,
+                 'amount_planned': i} for i in range(30)]
+
+        self._login_user(self.usera_creds['username'])
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post(
+                reverse(self.list_endpoint), data=data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(response.data), 30)
+        self.assertLess(len(context.captured_queries), 15)
+        self.assertEqual(Category.objects.filter(
+            user__username=self.usera_creds['username'],
+            name__startswith='bulk_').count(), 30)
+
+        # duplicates within the batch, with existing rows and unowned
+        # category types are rejected as a whole
+        response = self.client.post(reverse(self.list_endpoint), data=[
+            {'name': 'new', 'category_type_id': expenditure.id},
+            {'name': 'new', 'category_type_id': expenditure.id},
+            {'name': 'food', 'category_type_id': expenditure.id},
+            {'name': 'other', 'category_type_id': userb_cat_type.id},
+        ], format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data[0], {})
+        self.assertIn('name', response.data[1])
+        self.assertIn('name', response.data[2])
+        self.assertIn('category_type_id', response.data[3])
+        self.assertFalse(Category.objects.filter(name='new').exists())
+        self._logout_user()
+
+    def test_bulk_update_cat_endpoint(self):
+        usera = USER_MODEL.objects.get(username=self.usera_creds['username'])
+        food = Category.objects.get(user=usera, name='food')
+        housing = Category.objects.get(user=usera, name='housing')
+        userb_food = Category.objects.get(
+            user__username=self.userb_creds['username'], name='food')
+
+        self._login_user(self.usera_creds['username'])
+        response = self.client.patch(reverse(self.list_endpoint), data=[
+            {'id': food.id, 'amount_planned': 300},
+            {'id': housing.id, 'name': 'rent', 'amount_planned': 900},
+        ], format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        food.refresh_from_db()
+        housing.refresh_from_db()
+        self.assertEqual(food.amount_planned, 300)
+        self.assertEqual((housing.name, housing.amount_planned), ('rent', 900))
+
+        # ids are integers, numeric strings are accepted
+        response = self.client.patch(reverse(self.list_endpoint), data=[
+            {'id': str(food.id), 'amount_planned': 350}], format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        food.refresh_from_db()
+        self.assertEqual(food.amount_planned, 350)
+        for item_id in [[food.id], 'abc', None, True]:
+            response = self.client.patch(reverse(self.list_endpoint), data=[
+                {'id': item_id, 'amount_planned': 1}], format='json')
+            self.assertEqual(response.status_code,
+                             status.HTTP_400_BAD_REQUEST)
+
+        # rename to an existing name
+        response = self.client.patch(reverse(self.list_endpoint), data=[
+            {'id': food.id, 'name': 'rent'}], format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # unowned category
+        response = self.client.patch(reverse(self.list_endpoint), data=[
+            {'id': userb_food.id, 'amount_planned': 1}], format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self._logout_user()
+
+    def test_list_cat_cache(self):
+        category = Category.objects.get(name='usera_test_income_category')
+
+        self._login_user(self.usera_creds['username'])
+        response = self.client.get(reverse(self.list_endpoint))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # queryset.update() does not send post_save, the cached response
+        # is still served
+        Category.objects.filter(id=category.id).update(amount_planned=1)
+        response = self.client.get(reverse(self.list_endpoint))
+        data = next(item for item in response.data
+                    if item['id'] == category.id)
+        self.assertEqual(data['amount_planned'], 10000)
+
+        # saving the category invalidates the cached responses of its owner
+        category.refresh_from_db()
+        category.save()
+        response = self.client.get(reverse(self.list_endpoint))
+        data = next(item for item in response.data
+                    if item['id'] == category.id)
+        self.assertEqual(data['amount_planned'], 1)
+
+        # adding a transaction invalidates them too
+        Transaction.objects.create(
+            category=category, amount=25, description='bonus')
+        response = self.client.get(reverse(self.list_endpoint))
+        data = next(item for item in response.data
+                    if item['id'] == category.id)
+        self.assertEqual(data['amount_actual'], 25)
+        self._logout_user()
+
+    def test_list_cat_conditional_get(self):
+        category = Category.objects.get(name='usera_test_income_category')
+
+        self._login_user(self.usera_creds['username'])
+        response = self.client.get(reverse(self.list_endpoint))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response['ETag']
+        self.assertIn('Last-Modified', response)
+
+        response = self.client.get(reverse(self.list_endpoint),
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+
+        # a new transaction changes the validators
+        Transaction.objects.create(
+            category=category, amount=25, description='bonus')
+        response = self.client.get(reverse(self.list_endpoint),
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+        # a delete made by another process, which bumped the versions in
+        # its own cache only, also changes the validators
+        etag = response['ETag']
+        versions = get_cache().get_many(
+            ['bp:version:global', f'bp:version:{category.user_id}'])
+        Transaction.objects.get(description='bonus').delete()
+        get_cache().set_many(versions, timeout=None)
+        response = self.client.get(reverse(self.list_endpoint),
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+        # preconditions don't hide missing or unowned objects
+        userb_category = Category.objects.filter(
+            user__username=self.userb_creds['username']).first()
+        for pk in [userb_category.id, 0]:
+            response = self.client.get(
+                reverse(self.detail_endpoint, kwargs={'pk': pk}),
+                HTTP_IF_NONE_MATCH='*')
+            self.assertEqual(response.status_code,
+                             status.HTTP_404_NOT_FOUND)
+        response = self.client.get(
+            reverse(self.detail_endpoint, kwargs={'pk': category.id}),
+            HTTP_IF_NONE_MATCH='*')
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self._logout_user()
+
+    def test_sql_instrumentation(self):
+        self._login_user(self.usera_creds['username'])
+        # disabled by default
+        response = self.client.get(reverse(self.list_endpoint))
+        self.assertNotIn('Server-Timing', response)
+
+        options = dict(settings.SQL_INSTRUMENTATION, ENABLED=True,
+                       MAX_QUERIES=0)
+        with self.settings(SQL_INSTRUMENTATION=options), \
+                self.assertLogs('budgetbuddy.sql', 'WARNING') as logs:
+            # a new client loads the middleware again
+            self.client = self.client_class()
+            self._login_user(self.usera_creds['username'])
+            response = self.client.get(reverse(self.list_endpoint))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertRegex(response['Server-Timing'],
+                         r'^db;desc="\d+ queries";dur=[\d.]+, app;dur=')
+        self.assertIn('budgetplanner_category', logs.output[0])
+        self._logout_user()
+
+    def test_normalize_sql(self):
+        self.assertEqual(
+            normalize_sql("SELECT * FROM t WHERE id IN (%s, %s,\n %s) "
+                          "AND name = 'x' LIMIT 21"),
+            'SELECT * FROM t WHERE id IN (?, ...) AND name = ? LIMIT ?')
+
+    def test_default_category_provisioning(self):
+        with CaptureQueriesContext(connection) as context:
+            user = USER_MODEL.objects.create_user(
+                username='userc', email='userc@gmail.com', password='test1234')
+        inserts = [query['sql'] for query in context.captured_queries
+                   if query['sql'].startswith('INSERT')]
+        # user, profile and a single bulk insert of the default categories
+        self.assertEqual(len(inserts), 3)
+
+        categories = Category.objects.filter(user=user)
+        self.assertEqual(categories.count(), len(DEFAULT_CATEGORIES))
+        self.assertTrue(all(category.cat_type.name == 'expenditure'
+                            for category in categories))
+        self.assertTrue(hasattr(user, 'profile'))
+
+    def test_bulk_provision_users(self):
+        created, skipped = bulk_provision_users([
+            {'username': 'userc', 'email': 'userc@gmail.com',
+             'password': 'test1234'},
+            {'username': 'userd', 'email': 'userd@gmail.com',
+             'password': 'test1234'},
+            {'username': 'usera', 'email': 'usera@gmail.com',
+             'password': 'test1234'},
+        ])
+        self.assertEqual(created, ['userc', 'userd'])
+        self.assertEqual(skipped, ['usera'])
+
+        # same end state as a user created through the post_save signals
+        userc = USER_MODEL.objects.get(username='userc')
+        self.assertTrue(userc.check_password('test1234'))
+        self.assertTrue(hasattr(userc, 'profile'))
+        self.assertTrue(Token.objects.filter(user=userc).exists())
+        self.assertEqual(
+            set(Category.objects.filter(user=userc)
+                .values_list('name', 'cat_type__name')),
+            {(category['name'], 'expenditure')
+             for category in DEFAULT_CATEGORIES})
+
     def test_set_null_with_cat_type(self):
         test_cat_type = CategoryType.objects.get(name='usera_test_cat_type')
         # create a new category and set test_cat_type as cat_type
@@ -431,3 +724,588 @@ class CategoryEnpointTestCase(BudgetPlannerEndpointTestCase):
         test_cat_type.delete()
         category = Category.objects.get(name='test')
         self.assertEqual(category.cat_type, None)
+
+    def test_amount_actual(self):
+        income = Category.objects.get(name='usera_test_income_category')
+        expenditure = Category.objects.get(
+            name='usera_test_expenditure_category')
+        Transaction.objects.create(
+            category=income, amount=100, description='salary')
+        Transaction.objects.create(
+            category=expenditure, amount=250, description='groceries')
+        old = Transaction.objects.create(
+            category=expenditure, amount=50, description='old groceries')
+        Transaction.objects.filter(id=old.id).update(date='2020-01-15')
+
+        self._login_user(self.usera_creds['username'])
+        response = self.client.get(
+            reverse(self.list_endpoint) + '?ordering=-amount_actual')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = iter(response.data)
+        category = next(data)
+        self.assertEqual(category.get('name'),
+                         'usera_test_expenditure_category')
+        self.assertEqual(category.get('amount_actual'), 300)
+        self.assertEqual(next(data).get('amount_actual'), 100)
+        self.assertEqual(next(data).get('amount_actual'), 0)
+
+        # test date range
+        response = self.client.get(
+            reverse(self.detail_endpoint, kwargs={'pk': expenditure.id}) +
+            '?from=2020-01-01&to=2020-01-31')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data.get('amount_actual'), 50)
+
+        response = self.client.get(
+            reverse(self.list_endpoint) + '?from=not-a-date')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self._logout_user()
+
+
+class TransactionEndpointTestCase(BudgetPlannerEndpointTestCase):
+
+    list_endpoint = 'transaction-list'
+    detail_endpoint = 'transaction-detail'
+
+    def setUp(self):
+        super().setUp()
+
+        food = Category.objects.get(
+            user__username=self.usera_creds['username'], name='food')
+        for i in range(5):
+            Transaction.objects.create(
+                category=food, amount=i, description=f'usera_food_{i}')
+
+        food = Category.objects.get(
+            user__username=self.userb_creds['username'], name='food')
+        Transaction.objects.create(
+            category=food, amount=10, description='userb_food')
+
+    def test_list_transaction_endpoint(self):
+        self._login_user(self.usera_creds['username'])
+        response = self.client.get(
+            reverse(self.list_endpoint) + '?page_size=2')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # walk through every page using the cursor links
+        descriptions = []
+        while True:
+            descriptions += [item['description']
+                             for item in response.data['results']]
+            if not response.data['next']:
+                break
+            response = self.client.get(response.data['next'])
+        self.assertEqual(descriptions,
+                         [f'usera_food_{i}' for i in reversed(range(5))])
+        self._logout_user()
+
+        # test anonymous user
+        response = self.client.get(reverse(self.list_endpoint))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_list_transaction_same_date(self):
+        # More rows on one date than CursorPagination.offset_cutoff
+        food = Category.objects.get(
+            user__username=self.usera_creds['username'], name='food')
+        date = datetime.date(2020, 1, 1)
+        Transaction.objects.bulk_create(
+            [Transaction(category=food, amount=1, description=f'bulk_{i}',
+                         date=date) for i in range(1200)])
+        expected = list(Transaction.objects.filter(category__user=food.user)
+                        .order_by('-date', '-id').values_list('id', flat=True))
+
+        self._login_user(self.usera_creds['username'])
+        ids, pages = [], []
+        url = reverse(self.list_endpoint) + '?page_size=500'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            pages.append(response.data)
+            ids += [item['id'] for item in response.data['results']]
+            url = response.data['next']
+            self.assertLessEqual(len(pages), 3)
+        self.assertEqual(ids, expected)
+
+        # Back from the last page
+        response = self.client.get(pages[-1]['previous'])
+        self.assertEqual([item['id'] for item in response.data['results']],
+                         expected[500:1000])
+        self.assertEqual(response.data['next'], pages[1]['next'])
+        response = self.client.get(reverse(self.list_endpoint),
+                                   {'cursor': 'invalid'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self._logout_user()
+
+    def test_search(self):
+        self.assertTrue(search.has_index())
+        usera_food = Category.objects.get(
+            user__username=self.usera_creds['username'], name='food')
+        dinner = Transaction.objects.create(
+            category=usera_food, amount=30, description='Dinner',
+            comment='Birthday dinner at the seafood restaurant')
+        Transaction.objects.create(
+            category=usera_food, amount=5, description='Snacks',
+            comment='Dinner leftovers')
+
+        self._login_user(self.usera_creds['username'])
+        response = self.client.get(reverse('search'), {'q': 'dinner'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 2)
+        # Ranked, every word required, the last one as a prefix
+        self.assertEqual(response.data['results'][0]['data']['id'], dinner.id)
+        response = self.client.get(reverse('search'),
+                                   {'q': 'dinner restaur'})
+        self.assertEqual([hit['data']['id']
+                          for hit in response.data['results']], [dinner.id])
+
+        # Categories by name, description and type, userb's are not listed
+        response = self.client.get(reverse('search'), {'q': 'groceries'})
+        self.assertEqual([(hit['type'], hit['data']['name'])
+                          for hit in response.data['results']],
+                         [('category', 'food')])
+        response = self.client.get(reverse('search'),
+                                   {'q': 'food', 'type': 'transaction'})
+        self.assertEqual(response.data['count'], 5)
+        self.assertEqual(
+            {hit['type'] for hit in response.data['results']},
+            {'transaction'})
+        response = self.client.get(reverse('search'),
+                                   {'q': 'food', 'page_size': 2, 'page': 3})
+        self.assertEqual(response.data['count'], 6)
+        self.assertEqual(len(response.data['results']), 2)
+        self.assertIsNone(response.data['next'])
+
+        # Kept in sync on save and delete
+        dinner.description = 'Supper'
+        dinner.comment = None
+        dinner.save()
+        response = self.client.get(reverse('search'), {'q': 'dinner'})
+        self.assertEqual(response.data['count'], 1)
+        Transaction.objects.filter(description='Snacks').get().delete()
+        response = self.client.get(reverse('search'), {'q': 'dinner'})
+        self.assertEqual(response.data['count'], 0)
+        usera_food.name = 'eating'
+        usera_food.save()
+        response = self.client.get(reverse('search'), {'q': 'eat'})
+        self.assertEqual([hit['data']['name']
+                          for hit in response.data['results']],
+                         ['eating'])
+        # ?search= on the category list still matches any substring
+        response = self.client.get(reverse('category-list'),
+                                   {'search': 'atin'})
+        self.assertEqual([category['name'] for category in response.data],
+                         ['eating'])
+
+        # Bulk imports and rebuilds
+        response = self.client.post(reverse('transaction-import'), {
+            'file': SimpleUploadedFile(
+                'rows.csv', b'category,amount,description\n'
+                            b'eating,12,Pizza night\n')})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        response = self.client.get(reverse('search'), {'q': 'pizza'})
+        self.assertEqual(response.data['count'], 1)
+        self.assertEqual(search.rebuild_index(), Transaction.objects.filter(
+            category__isnull=False).count() + Category.objects.count())
+        response = self.client.get(reverse('search'), {'q': 'pizza'})
+        self.assertEqual(response.data['count'], 1)
+
+        response = self.client.get(reverse('search'), {'q': 'x', 'type': 'y'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self._logout_user()
+
+        response = self.client.get(reverse('search'), {'q': 'dinner'})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_create_transaction_endpoint(self):
+        usera_food = Category.objects.get(
+            user__username=self.usera_creds['username'], name='food')
+        userb_food = Category.objects.get(
+            user__username=self.userb_creds['username'], name='food')
+
+        self._login_user(self.usera_creds['username'])
+        response = self.client.post(reverse(self.list_endpoint), data={
+            'category': usera_food.id, 'amount': 20, 'description': 'lunch'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        # test create on unowned category
+        response = self.client.post(reverse(self.list_endpoint), data={
+            'category': userb_food.id, 'amount': 20, 'description': 'lunch'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(reverse(self.list_endpoint), data={
+            'category': None, 'amount': 20, 'description': 'lunch'},
+            format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # test retrieve unowned transaction
+        transaction = Transaction.objects.get(description='userb_food')
+        response = self.client.get(
+            reverse(self.detail_endpoint, kwargs={'pk': transaction.id}))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self._logout_user()
+
+    def test_import_transaction_endpoint(self):
+        endpoint = reverse('transaction-import')
+        content = (
+            'date,category,amount,description,comment\n'
+            '2020-01-15,food,12.5,lunch,\n'
+            '2020-01-16,unknown,10,dinner,\n'
+            'not-a-date,food,10,dinner,\n'
+            '2020-01-17,housing,1000,rent,january\n'
+            ',food,4,coffee,\n'
+        ).encode()
+
+        self._login_user(self.usera_creds['username'])
+        response = self.client.post(endpoint, data={
+            'file': SimpleUploadedFile('history.csv', content)})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['created'], 3)
+        self.assertEqual([error['row'] for error in response.data['errors']],
+                         [2, 3])
+        transaction = Transaction.objects.get(description='rent')
+        self.assertEqual(str(transaction.date), '2020-01-17')
+        # an empty date cell defaults to today
+        transaction = Transaction.objects.get(description='coffee')
+        self.assertEqual(transaction.date, datetime.date.today())
+        self.assertEqual(transaction.category.user.username,
+                         self.usera_creds['username'])
+
+        content = b'{"category": "food", "amount": 3, "description": "tea"}\n'
+        response = self.client.post(endpoint, data={
+            'file': SimpleUploadedFile('history.ndjson', content)})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['created'], 1)
+        self._logout_user()
+
+    def test_export_transaction_endpoint(self):
+        endpoint = reverse('transaction-export')
+
+        self._login_user(self.usera_creds['username'])
+        response = self.client.get(endpoint + '?names=true')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 6)
+        self.assertIn('category_type', lines[0])
+        self.assertTrue(all(',food,expenditure' in line for line in lines[1:]))
+
+        response = self.client.get(endpoint + '?format_type=ndjson')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 5)
+        self.assertNotIn('userb_food', ''.join(lines))
+
+        response = self.client.get(endpoint + '?format_type=xml')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self._logout_user()
+
+    def test_monthly_report_endpoint(self):
+        usera = USER_MODEL.objects.get(username=self.usera_creds['username'])
+        food = Category.objects.get(user=usera, name='food')
+        housing = Category.objects.get(user=usera, name='housing')
+        Category.objects.filter(id=housing.id).update(amount_planned=1000)
+        rent = Transaction.objects.create(
+            category=housing, amount=900, description='rent',
+            date='2020-01-05')
+        Transaction.objects.create(
+            category=food, amount=30, description='lunch', date='2020-02-01')
+
+        # move the rent to the next month and update its amount
+        rent.date = datetime.date(2020, 2, 5)
+        rent.amount = 950
+        rent.save()
+        Transaction.objects.get(description='usera_food_0').delete()
+
+        self._login_user(self.usera_creds['username'])
+        response = self.client.get(
+            reverse('monthly-report') + '?from=2020-01&to=2020-12')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # Every month of the range, with every budget
+        planned = sum(Category.objects.filter(user=usera)
+                      .values_list('amount_planned', flat=True))
+        self.assertEqual(planned, 1000)
+        self.assertEqual([report['month'] for report in response.data],
+                         [f'2020-{month:02}' for month in range(1, 13)])
+        report = response.data[1]
+        self.assertEqual(report['actual'], 980)
+        self.assertEqual(report['planned'], planned)
+        self.assertEqual(report['category_types'], [
+            {'name': 'expenditure', 'planned': planned, 'actual': 980}])
+
+        # Budget without spending
+        report = response.data[0]
+        self.assertEqual((report['planned'], report['actual']), (planned, 0))
+        housing_entry = next(category for category in report['categories']
+                             if category['id'] == housing.id)
+        self.assertEqual(
+            (housing_entry['planned'], housing_entry['actual'],
+             housing_entry['count']), (1000, 0, 0))
+        # Without a range, from the first to the last month with spending
+        response = self.client.get(reverse('monthly-report'))
+        self.assertEqual(response.data[0]['month'], '2020-02')
+        self.assertEqual(response.data[-1]['month'],
+                         f'{datetime.date.today():%Y-%m}')
+        # Ranges are capped, up to the last representable month
+        for query in ['?to=9999-12', '?from=0001-01&to=9999-12']:
+            response = self.client.get(reverse('monthly-report') + query)
+            self.assertEqual(response.status_code,
+                             status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(
+            reverse('monthly-report') + '?from=9999-12&to=9999-12')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([entry['month'] for entry in response.data],
+                         ['9999-12'])
+
+        # the incrementally maintained table matches a full rebuild
+        rollups = set(MonthlyRollup.objects.filter(user=usera).values_list(
+            'category_id', 'month', 'count', 'total'))
+        rebuild_rollups(user=usera)
+        self.assertEqual(
+            rollups, set(MonthlyRollup.objects.filter(user=usera).values_list(
+                'category_id', 'month', 'count', 'total')))
+        self.assertEqual(len(rollups), 3)
+        self._logout_user()
+
+    @skipUnless(analytics.is_available(), 'numpy is not installed')
+    def test_analytics_endpoint(self):
+        usera = USER_MODEL.objects.get(username=self.usera_creds['username'])
+        food = Category.objects.get(user=usera, name='food')
+        housing = Category.objects.get(user=usera, name='housing')
+        Transaction.objects.create(
+            category=housing, amount=900, description='rent',
+            date='2020-01-05')
+        Transaction.objects.create(
+            category=food, amount=100, description='lunch', date='2020-03-01')
+
+        self._login_user(self.usera_creds['username'])
+        endpoint = reverse('analytics') + '?from=2020-01-01&to=2020-12-31'
+        response = self.client.get(endpoint + '&window=2')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['months'],
+                         ['2020-01', '2020-02', '2020-03'])
+        self.assertEqual(response.data['totals'], [900, 0, 100])
+        self.assertEqual(response.data['month_over_month'], [0, -900, 100])
+        self.assertEqual(response.data['rolling_average'], [900, 450, 50])
+        shares = {category['name']: category['share']
+                  for category in response.data['categories']}
+        self.assertEqual(shares, {'housing': 0.9, 'food': 0.1})
+
+        # the cached snapshot picks up updates and deletes
+        rent = Transaction.objects.get(description='rent')
+        rent.amount = 400
+        rent.save()
+        Transaction.objects.get(description='lunch').delete()
+        response = self.client.get(endpoint)
+        self.assertEqual(response.data['totals'], [400])
+        self.assertEqual(len(analytics.snapshots.get(usera)), 6)
+
+        response = self.client.get(endpoint + '&window=0')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self._logout_user()
+
+    def test_forecast_endpoint(self):
+        usera = USER_MODEL.objects.get(username=self.usera_creds['username'])
+        food = Category.objects.get(user=usera, name='food')
+        housing = Category.objects.get(user=usera, name='housing')
+        Category.objects.filter(id=food.id).update(amount_planned=300)
+        Category.objects.filter(id=housing.id).update(amount_planned=1000)
+        Transaction.objects.create(
+            category=food, amount=200, description='groceries',
+            date='2020-04-10')
+        Transaction.objects.create(
+            category=housing, amount=300, description='repair',
+            date='2020-04-05')
+
+        self._login_user(self.usera_creds['username'])
+        endpoint = reverse('forecasts') + '?date=2020-04-15'
+        response = self.client.get(endpoint)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(response.data['stored'])
+        forecasts = {forecast['name']: forecast
+                     for forecast in response.data['categories']}
+        self.assertEqual(len(forecasts), len(DEFAULT_CATEGORIES))
+        self.assertEqual(forecasts['food']['projected'], 400)
+        self.assertEqual(forecasts['food']['status'], 'over_budget')
+        self.assertEqual(forecasts['housing']['projected'], 600)
+        self.assertEqual(forecasts['housing']['status'], 'on_track')
+
+        # batch mode stores the same forecasts for every user
+        store_forecasts(today=datetime.date(2020, 4, 15))
+        response = self.client.get(endpoint)
+        self.assertTrue(response.data['stored'])
+        self.assertEqual(
+            {forecast['name']: forecast
+             for forecast in response.data['categories']}, forecasts)
+
+        # another day of the month is not served from that batch
+        response = self.client.get(reverse('forecasts') + '?date=2020-04-30')
+        self.assertFalse(response.data['stored'])
+        forecasts = {forecast['name']: forecast
+                     for forecast in response.data['categories']}
+        self.assertEqual(forecasts['food']['projected'], 200)
+        self.assertEqual(forecasts['food']['status'], 'on_track')
+        self._logout_user()
+
+
+class QueryBudgetTestCase(APITestCase):
+    '''
+    Run the endpoint benchmarks on a small dataset and check the query
+    budgets only, latencies are left to the benchmark command.
+    '''
+
+    def setUp(self):
+        get_cache().clear()
+        clear_global_cache()
+        analytics.snapshots.clear()
+
+    def test_query_budgets(self):
+        user = benchmarks.seed(ADMIN_USERNAME, users=2, categories=12,
+                               transactions=50)
+        admin = USER_MODEL.objects.get(username=ADMIN_USERNAME)
+        results = benchmarks.run(user, admin, iterations=2)
+
+        self.assertEqual(set(results), set(benchmarks.ENDPOINTS))
+        for name, result in results.items():
+            self.assertEqual(result['status'], status.HTTP_200_OK, name)
+            self.assertLessEqual(
+                result['queries'], result['query_budget'], name)
+
+
+class DatabaseProfileTestCase(APITestCase):
+
+    @skipUnless(connection.vendor == 'sqlite', 'SQLite profile')
+    def test_sqlite_pragmas(self):
+        pragmas = connection.settings_dict['OPTIONS'].get('pragmas', {})
+        with connection.cursor() as cursor:
+            for name in ['busy_timeout', 'cache_size']:
+                if name in pragmas:
+                    cursor.execute(f'PRAGMA {name}')
+                    self.assertEqual(cursor.fetchone()[0], pragmas[name])
+
+    @skipUnless('pool' in connection.settings_dict['OPTIONS'],
+                'pooled PostgreSQL profile')
+    def test_postgresql_pool(self):
+        connection.ensure_connection()
+        pooled = connection.connection
+        # Leave the test case transaction alone, use a new wrapper
+        other = connection.copy()
+        other.connect()
+        self.assertIsNot(other.connection, pooled)
+        raw = other.connection
+        other.close()
+        self.assertEqual(len(other.pool), 1)
+
+        other = connection.copy()
+        other.connect()
+        self.assertIs(other.connection, raw)
+        # Closed for real once the settings changed, as in create_test_db()
+        other.settings_dict['NAME'] = 'postgres'
+        other.close()
+        self.assertTrue(raw.closed)
+        self.assertEqual(len(other.pool), 0)
+
+        # Pools are per database
+        pooled = connection.copy()
+        pooled.connect()
+        raw = pooled.connection
+        pooled.close()
+        other = connection.copy()
+        other.settings_dict['NAME'] = 'postgres'
+        other.connect()
+        self.assertIsNot(other.connection, raw)
+        other.close()
+
+
+class ReplicaRoutingTestCase(APITestCase):
+
+    def setUp(self):
+        caches[settings.DATABASE_REPLICA['CACHE']].clear()
+
+    def _get_middleware(self, **options):
+        options = dict(settings.DATABASE_REPLICA, ALIAS='replica', **options)
+        with self.settings(DATABASE_REPLICA=options):
+            return ReplicaMiddleware(self._get_response)
+
+    def _get_response(self, request):
+        self.read_db = router.db_for_read(Category)
+        self.write_db = router.db_for_write(Category)
+        self.auth_dbs = [router.db_for_read(Token),
+                         router.db_for_read(USER_MODEL)]
+        return HttpResponse()
+
+    def test_replica_routing(self):
+        middleware = self._get_middleware()
+        factory = RequestFactory()
+
+        middleware(factory.get('/', HTTP_AUTHORIZATION='Token a'))
+        self.assertEqual(self.read_db, 'replica')
+        self.assertEqual(self.write_db, 'default')
+
+        # Writes and the following reads of the same client use the primary
+        middleware(factory.post('/', HTTP_AUTHORIZATION='Token a'))
+        self.assertEqual(self.read_db, 'default')
+        middleware(factory.get('/', HTTP_AUTHORIZATION='Token a'))
+        self.assertEqual(self.read_db, 'default')
+        middleware(factory.get('/', HTTP_AUTHORIZATION='Token b'))
+        self.assertEqual(self.read_db, 'replica')
+        middleware(factory.get('/'))
+        self.assertEqual(self.read_db, 'replica')
+
+        # Authentication always reads from the primary, tokens issued by a
+        # login are usable right away
+        middleware(factory.get('/', HTTP_AUTHORIZATION='Token c'))
+        self.assertEqual(self.auth_dbs, ['default', 'default'])
+
+        # Outside of a request
+        self.assertEqual(router.db_for_read(Category), 'default')
+
+    def test_replica_cache_is_shared(self):
+        with self.assertRaises(ImproperlyConfigured):
+            self._get_middleware(CACHE='default')
+
+    def test_replica_stickiness_expires(self):
+        middleware = self._get_middleware(STICKY_SECONDS=0)
+        factory = RequestFactory()
+        middleware(factory.post('/', HTTP_AUTHORIZATION='Token a'))
+        middleware(factory.get('/', HTTP_AUTHORIZATION='Token a'))
+        self.assertEqual(self.read_db, 'replica')
+
+
+class AsyncViewTestCase(APITransactionTestCase):
+    '''
+    The async views run the viewsets in worker threads, with their own
+    database connections, so the data has to be committed.
+    '''
+
+    def setUp(self):
+        get_cache().clear()
+        clear_global_cache()
+        USER_MODEL.objects.create_superuser(
+            username=ADMIN_USERNAME, email=f'{ADMIN_USERNAME}@budgetbuddy.com',
+            password=None)
+        self.user = USER_MODEL.objects.create_user(
+            username='usera', email='usera@gmail.com', password='test1234')
+        self.token = Token.objects.create(user=self.user)
+        self.application = BudgetBuddyASGIHandler()
+
+    def tearDown(self):
+        get_cache().clear()
+        clear_global_cache()
+
+    def test_async_read_views(self):
+        urls = [reverse('category-type-list'), reverse('category-list'),
+                reverse('profiles-detail',
+                        kwargs={'user__username': self.user.username})]
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token.key)
+        for url in urls:
+            match = resolve(url, urlconf=ASGI_URLCONF)
+            self.assertTrue(asyncio.iscoroutinefunction(match.func), url)
+
+            get_cache().clear()
+            status_code, content = async_to_sync(benchmarks.asgi_request)(
+                self.application, url, self.token.key)
+            self.assertEqual(status_code, status.HTTP_200_OK, url)
+            get_cache().clear()
+            response = self.client.get(url)
+            self.assertEqual(json.loads(content), response.json(), url)
+
+        status_code, _ = async_to_sync(benchmarks.asgi_request)(
+            self.application, urls[1], 'invalid')
+        self.assertEqual(status_code, status.HTTP_401_UNAUTHORIZED)
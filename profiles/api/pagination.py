@@ -0,0 +1,12 @@
+from rest_framework.pagination import CursorPagination
+
+
+class UserCursorPagination(CursorPagination):
+    '''
+    Keyset pagination over the unique, indexed username, or the ?ordering=
+    of UserAPIViewSet. Deep pages cost the same as the first one.
+    '''
+    ordering = ('username',)
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 500
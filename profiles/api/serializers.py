@@ -1,5 +1,7 @@
 from rest_framework import serializers
 
+from profiles.avatars import AVATAR_FORMATS, get_avatar_urls
+from profiles.avatars import check_dimensions, check_upload_size
 from profiles.models import Profile
 from django.contrib.auth import get_user_model
 
@@ -10,14 +12,27 @@ class UserSerializer(serializers.ModelSerializer):
         fields = ['username', 'email', 'is_staff', 'is_active', 'groups']
 
 
+class UserSummarySerializer(UserSerializer):
+    category_count = serializers.IntegerField(read_only=True)
+    transaction_count = serializers.IntegerField(read_only=True)
+
+    class Meta(UserSerializer.Meta):
+        fields = UserSerializer.Meta.fields + [
+            'category_count', 'transaction_count']
+
+
 class ProfileSerializer(serializers.ModelSerializer):
 
     user = serializers.StringRelatedField(read_only=True)
-    avatar = serializers.ImageField(read_only=True)
+    # {size: url} of the thumbnails, the original is never listed
+    avatar = serializers.SerializerMethodField()
 
     class Meta:
         model = Profile
-        fields = '__all__'
+        exclude = ['avatar_processed']
+
+    def get_avatar(self, profile):
+        return get_avatar_urls(profile, self.context.get('request'))
 
 
 class ProfileAvatarSerializer(serializers.ModelSerializer):
@@ -25,3 +40,15 @@ class ProfileAvatarSerializer(serializers.ModelSerializer):
     class Meta:
         model = Profile
         fields = ['avatar']
+        extra_kwargs = {'avatar': {'required': True, 'allow_null': False}}
+
+    def validate_avatar(self, avatar):
+        try:
+            check_upload_size(avatar)
+            check_dimensions(avatar.image)
+        except ValueError as e:
+            raise serializers.ValidationError(f'{e}.')
+        if avatar.image.format not in AVATAR_FORMATS:
+            raise serializers.ValidationError(
+                f'Supported formats are {", ".join(AVATAR_FORMATS)}.')
+        return avatar
@@ -1,17 +1,24 @@
 from django.contrib.auth import get_user_model
+from django.db.models import Count, Max
 
 from rest_framework import generics
 from rest_framework import mixins
 from rest_framework import permissions
 from rest_framework import viewsets
 from rest_framework import filters
+from rest_framework.decorators import action
+from rest_framework.parsers import MultiPartParser
+from rest_framework.response import Response
 
+from budgetbuddy.conditional import ConditionalGetMixin
+from profiles.avatars import store_avatar
 from profiles.models import Profile
 
+from profiles.api.pagination import UserCursorPagination
 from profiles.api.permissions import IsOwnProfileOrReadOnly
 from profiles.api.serializers import ProfileSerializer
 from profiles.api.serializers import ProfileAvatarSerializer
-from profiles.api.serializers import UserSerializer
+from profiles.api.serializers import UserSerializer, UserSummarySerializer
 
 
 USER_MODEL = get_user_model()
@@ -22,29 +29,94 @@ class UserAPIViewSet(viewsets.GenericViewSet,
                      mixins.RetrieveModelMixin,
                      mixins.UpdateModelMixin,
                      mixins.DestroyModelMixin):
+    '''
+    Admin user directory. ?is_active=true|false filters the users and
+    ?summary=true adds their category and transaction counts. ?search=
+    matches any part of the username or is_active, ?prefix= is a case
+    sensitive username prefix, answered by PostgreSQL from the
+    varchar_pattern_ops index of the column rather than a table scan.
+    '''
 
     queryset = USER_MODEL.objects.all()
     serializer_class = UserSerializer
     permission_classes = [permissions.IsAdminUser]
+    pagination_class = UserCursorPagination
     filter_backends = [filters.SearchFilter, filters.OrderingFilter]
     search_fields = ['username', 'is_active']
-    ordering_fields = ['name', 'amount_planned']
+    # Indexed and unique, as the cursor pagination requires
+    ordering_fields = ['username', 'id']
+    ordering = ['username']
     lookup_field = 'username'
 
-    def get_queryset(self):
-        return USER_MODEL.objects.exclude(is_superuser=True)
+    def is_summary(self):
+        return self.action == 'list' and \
+            self.request.query_params.get('summary') in ('1', 'true')
 
+    def get_serializer_class(self):
+        if self.is_summary():
+            return UserSummarySerializer
+        return super().get_serializer_class()
 
-class ProfileAPIViewSet(viewsets.GenericViewSet,
+    def get_queryset(self):
+        queryset = USER_MODEL.objects.exclude(is_superuser=True) \
+            .prefetch_related('groups')
+        is_active = self.request.query_params.get('is_active')
+        if is_active in ('true', 'false'):
+            queryset = queryset.filter(is_active=is_active == 'true')
+        prefix = self.request.query_params.get('prefix')
+        if prefix:
+            queryset = queryset.filter(username__startswith=prefix)
+        if self.is_summary():
+            # Every transaction joins a single category, counting the
+            # transaction ids of the join does not double count
+            queryset = queryset.annotate(
+                category_count=Count('category', distinct=True),
+                transaction_count=Count('category__transaction'))
+        return queryset
+
+
+class ProfileAPIViewSet(ConditionalGetMixin,
+                        viewsets.GenericViewSet,
                         mixins.ListModelMixin,
                         mixins.RetrieveModelMixin,
                         mixins.UpdateModelMixin):
 
-    queryset = Profile.objects.all()
+    queryset = Profile.objects.select_related('user')
     serializer_class = ProfileSerializer
     permission_classes = [permissions.IsAuthenticated, IsOwnProfileOrReadOnly]
     lookup_field = 'user__username'
 
+    def get_profile_state(self):
+        # Cached per request, the ETag and Last-Modified share the query
+        if not hasattr(self, '_profile_state'):
+            queryset = self.get_queryset()
+            if self.action == 'retrieve':
+                queryset = queryset.filter(
+                    user__username=self.kwargs[self.lookup_field])
+            self._profile_state = queryset.aggregate(
+                last_modified=Max('updated_at'), count=Count('id'))
+        return self._profile_state
+
+    def get_last_modified(self):
+        return self.get_profile_state()['last_modified']
+
+    @action(detail=True, methods=['put'], parser_classes=[MultiPartParser],
+            serializer_class=ProfileAvatarSerializer)
+    def avatar(self, request, *args, **kwargs):
+        '''
+        Upload the avatar as the "avatar" field of a multipart form.
+        '''
+        profile = self.get_object()
+        serializer = self.get_serializer(profile, data=request.data)
+        serializer.is_valid(raise_exception=True)
+        store_avatar(profile, serializer.validated_data['avatar'])
+        return Response(ProfileSerializer(
+            profile, context=self.get_serializer_context()).data)
+
+    def get_etag_parts(self):
+        # Deleting a profile does not move the last modified time
+        return [self.get_profile_state()['count']]
+
 
 class ProfileListAPIView(generics.ListAPIView):
 
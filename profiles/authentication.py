@@ -0,0 +1,196 @@
+"""
+Token authentication with cached token lookups.
+
+TokenAuthentication loads the Token and its user on every request.
+CachedTokenAuthentication keeps the user of the most recently used tokens
+in a per process LRU of TOKEN_AUTH_CACHE['MAX_SIZE'] entries and, with
+TOKEN_AUTH_CACHE['CACHE'] set to an entry of CACHES, in that cache shared
+by the worker processes. The shared cache only holds the user id and
+is_active flag under the digest of the token, a shared hit loads the user
+by primary key instead of joining the token table.
+
+Entries are dropped by profiles.signals when a token is deleted and when
+its user is saved, which covers deactivation and password changes. Signals
+only reach the process doing the write: with a shared cache every local
+hit is checked against the shared entry, which the signals drop for every
+process, otherwise local entries expire after
+TOKEN_AUTH_CACHE['LOCAL_TIMEOUT'] seconds. Shared entries expire after
+TOKEN_AUTH_CACHE['TIMEOUT'] seconds. Lookups are counted in the hits and
+misses of token_cache and in the budgetbuddy_token_cache_lookups_total
+metric.
+"""
+
+import copy
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+
+def _cache_key(key):
+    # Tokens are credentials, only their digest is stored in the cache
+    return 'auth:token:' + hashlib.sha256(key.encode()).hexdigest()
+
+
+def _copy_user(user):
+    # Requests get their own instance, without the related objects loaded
+    # by previous requests
+    user = copy.copy(user)
+    user._state = copy.copy(user._state)
+    user._state.fields_cache = {}
+    return user
+
+
+class TokenCache:
+    '''
+    LRU cache of {token key: user} with expiring entries, backed by an
+    optional shared cache.
+    '''
+
+    def __init__(self):
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def options(self):
+        return settings.TOKEN_AUTH_CACHE
+
+    @property
+    def shared(self):
+        alias = self.options['CACHE']
+        return caches[alias] if alias else None
+
+    def _count(self, result):
+        # budgetbuddy.metrics imports the DRF views, which import the
+        # authentication classes
+        from budgetbuddy.metrics import registry
+        with self._lock:
+            if result == 'miss':
+                self.misses += 1
+            else:
+                self.hits += 1
+        registry.inc('budgetbuddy_token_cache_lookups_total',
+                     {'result': result})
+
+    def get(self, key):
+        '''
+        Return the cached user of the token key or None.
+        '''
+        with self._lock:
+            user, expires = self._users.get(key, (None, 0))
+            if expires < time.monotonic():
+                self._users.pop(key, None)
+                user = None
+            elif user is not None:
+                self._users.move_to_end(key)
+
+        if user is not None and self.shared is not None and \
+                not self._is_shared(key, user):
+            # Dropped or changed by another process
+            with self._lock:
+                self._users.pop(key, None)
+            user = None
+        if user is not None:
+            self._count('hit')
+            return _copy_user(user)
+        if self.shared is not None:
+            user = self._get_shared(key)
+            if user is not None:
+                self._set_local(key, user)
+                self._count('shared_hit')
+                return _copy_user(user)
+        self._count('miss')
+        return None
+
+    def _is_shared(self, key, user):
+        # The shared cache is authoritative, local entries are only valid
+        # while it still has them
+        entry = self.shared.get(_cache_key(key))
+        return entry == {'user_id': user.pk, 'is_active': user.is_active}
+
+    def _get_shared(self, key):
+        # Inactive users go through TokenAuthentication for its error
+        entry = self.shared.get(_cache_key(key))
+        if entry is None or not entry['is_active']:
+            return None
+        try:
+            return get_user_model().objects.get(
+                pk=entry['user_id'], is_active=True)
+        except get_user_model().DoesNotExist:
+            return None
+
+    def set(self, key, user):
+        user = _copy_user(user)
+        self._set_local(key, user)
+        if self.shared is not None:
+            # No password hash or other user data outside of the database
+            self.shared.set(_cache_key(key),
+                            {'user_id': user.pk, 'is_active': user.is_active},
+                            timeout=self.options['TIMEOUT'])
+
+    def _set_local(self, key, user):
+        # Without a shared cache nothing tells this process about writes
+        # made by the others, local entries only live for LOCAL_TIMEOUT
+        timeout = self.options['TIMEOUT'] if self.shared is not None \
+            else self.options['LOCAL_TIMEOUT']
+        with self._lock:
+            expires = time.monotonic() + timeout
+            self._users[key] = (user, expires)
+            self._users.move_to_end(key)
+            while len(self._users) > self.options['MAX_SIZE']:
+                self._users.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._users.pop(key, None)
+        if keys and self.shared is not None:
+            self.shared.delete_many([_cache_key(key) for key in keys])
+
+    def delete_user(self, user_id):
+        '''
+        Drop the entries of every token of the user.
+        '''
+        with self._lock:
+            keys = {key for key, (user, _) in self._users.items()
+                    if user.pk == user_id}
+        if self.shared is not None:
+            keys.update(Token.objects.filter(user_id=user_id)
+                        .values_list('key', flat=True))
+        self.delete(*keys)
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+            self.hits = self.misses = 0
+
+
+token_cache = TokenCache()
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+
+    def authenticate_credentials(self, key):
+        user = token_cache.get(key)
+        if user is None:
+            user, token = super().authenticate_credentials(key)
+            token_cache.set(key, user)
+            return user, token
+
+        if not user.is_active:
+            raise exceptions.AuthenticationFailed(
+                'User inactive or deleted.')
+        # request.auth without loading the token
+        token = Token(key=key, user=user)
+        token._state.adding = False
+        return user, token
@@ -0,0 +1,188 @@
+"""
+Avatar storage and thumbnails.
+
+Uploads are stored under the SHA-256 of their content, identical avatars
+share one file. The square thumbnails of PROFILE_AVATARS['SIZES'] are
+generated in a bounded thread pool after the upload returns and are
+content addressed as well, Profile.avatar_processed tells the serializer
+when they are ready.
+
+Uploads are limited to PROFILE_AVATARS['MAX_SIZE'] bytes, checked before
+they are read, and images to PROFILE_AVATARS['MAX_PIXELS'] pixels, checked
+from the header before they are decoded.
+"""
+
+import hashlib
+import io
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections
+from django.utils import timezone
+from PIL import Image, ImageOps
+
+from profiles.models import Profile
+
+
+AVATAR_DIR = 'avatars'
+# Pillow format: (extension, thumbnail format)
+AVATAR_FORMATS = {
+    'JPEG': ('jpg', 'JPEG'),
+    'PNG': ('png', 'PNG'),
+    'WEBP': ('webp', 'WEBP'),
+    'GIF': ('gif', 'PNG'),
+}
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_sizes():
+    return settings.PROFILE_AVATARS['SIZES']
+
+
+def check_upload_size(upload):
+    max_size = settings.PROFILE_AVATARS['MAX_SIZE']
+    if upload.size > max_size:
+        raise ValueError(f'Avatars are limited to {max_size} bytes')
+
+
+def check_dimensions(image):
+    # Image.open() only reads the header, a small file can decode to a huge
+    # bitmap
+    max_pixels = settings.PROFILE_AVATARS['MAX_PIXELS']
+    width, height = image.size
+    if width * height > max_pixels:
+        raise ValueError(f'Avatars are limited to {max_pixels} pixels')
+
+
+def get_avatar_name(content):
+    '''
+    Return the content addressed storage name of an uploaded image.
+    '''
+    image = Image.open(io.BytesIO(content))
+    check_dimensions(image)
+    if image.format not in AVATAR_FORMATS:
+        raise ValueError(f'{image.format} avatars are not supported')
+    digest = hashlib.sha256(content).hexdigest()
+    ext = AVATAR_FORMATS[image.format][0]
+    return f'{AVATAR_DIR}/{digest[:2]}/{digest}.{ext}'
+
+
+def get_thumbnail_name(name, size):
+    digest, ext = os.path.splitext(os.path.basename(name))
+    if ext == '.gif':
+        ext = '.png'
+    return f'{AVATAR_DIR}/thumbnails/{digest[:2]}/{digest}-{size}{ext}'
+
+
+def has_thumbnails(name):
+    return all(default_storage.exists(get_thumbnail_name(name, size))
+               for size in get_sizes())
+
+
+def store_avatar(profile, upload):
+    '''
+    Store upload as the avatar of profile and schedule its thumbnails.
+    '''
+    check_upload_size(upload)
+    content = upload.read()
+    name = get_avatar_name(content)
+    if not default_storage.exists(name):
+        stored = default_storage.save(name, ContentFile(content))
+        if stored != name:
+            # Saved concurrently by another upload of the same image
+            default_storage.delete(stored)
+
+    profile.avatar.name = name
+    profile.avatar_processed = has_thumbnails(name)
+    profile.save(update_fields=['avatar', 'avatar_processed', 'updated_at'])
+    if not profile.avatar_processed and submit_thumbnails(name) is None:
+        # Generated inline
+        profile.refresh_from_db(fields=['avatar_processed', 'updated_at'])
+    return profile
+
+
+def make_thumbnail(image, size, fmt):
+    thumbnail = ImageOps.fit(image, (size, size), Image.LANCZOS)
+    if fmt == 'JPEG' and thumbnail.mode != 'RGB':
+        thumbnail = thumbnail.convert('RGB')
+    output = io.BytesIO()
+    thumbnail.save(output, fmt)
+    return output.getvalue()
+
+
+def generate_thumbnails(name):
+    '''
+    Write the missing thumbnails of the avatar stored under name and mark
+    the profiles using it as processed.
+    '''
+    with default_storage.open(name) as f:
+        image = Image.open(f)
+        check_dimensions(image)
+        fmt = AVATAR_FORMATS[image.format][1]
+        # Camera photos are often stored rotated with an EXIF orientation
+        image = ImageOps.exif_transpose(image)
+        image.load()
+
+    for size in get_sizes():
+        thumbnail_name = get_thumbnail_name(name, size)
+        if not default_storage.exists(thumbnail_name):
+            default_storage.save(thumbnail_name, ContentFile(
+                make_thumbnail(image, size, fmt)))
+
+    Profile.objects.filter(avatar=name, avatar_processed=False) \
+        .update(avatar_processed=True, updated_at=timezone.now())
+
+
+def _run_generate_thumbnails(name):
+    try:
+        generate_thumbnails(name)
+    except Exception:
+        logger.exception('Failed to generate the thumbnails of %s', name)
+    finally:
+        close_old_connections()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.PROFILE_AVATARS['WORKERS'],
+                thread_name_prefix='avatars')
+        return _executor
+
+
+def submit_thumbnails(name):
+    '''
+    Generate the thumbnails of name in the pool, or inline when WORKERS is
+    0. Returns a future in the first case.
+    '''
+    if not settings.PROFILE_AVATARS['WORKERS']:
+        generate_thumbnails(name)
+        return None
+    return get_executor().submit(_run_generate_thumbnails, name)
+
+
+def get_avatar_urls(profile, request=None):
+    '''
+    Return {size: url} of the avatar thumbnails, pointing at the original
+    until they are generated.
+    '''
+    if not profile.avatar:
+        return None
+    urls = {}
+    for size in get_sizes():
+        name = get_thumbnail_name(profile.avatar.name, size) \
+            if profile.avatar_processed else profile.avatar.name
+        url = default_storage.url(name)
+        urls[str(size)] = request.build_absolute_uri(url) if request else url
+    return urls
@@ -9,6 +9,8 @@ class Profile(models.Model):
         USER_MODEL, on_delete=models.CASCADE, null=True)
     bio = models.CharField(max_length=150, null=True)
     avatar = models.ImageField(null=True, blank=True)
+    # Set once the thumbnails of the avatar are generated
+    avatar_processed = models.BooleanField(default=False)
     updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
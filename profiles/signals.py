@@ -1,13 +1,22 @@
 from django.contrib.auth import get_user_model
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
-from profiles.models import Profile
+
+from rest_framework.authtoken.models import Token
+
+from profiles.authentication import token_cache
 
 
 USER_MODEL = get_user_model()
 
 
+@receiver(post_delete, sender=Token)
+def invalidate_token(sender, instance, **kwargs):
+    token_cache.delete(instance.key)
+
+
 @receiver(post_save, sender=USER_MODEL)
-def create_profile(sender, instance, created, **kwargs):
-    if created and not instance.is_superuser:
-        Profile.objects.create(user=instance)
\ No newline at end of file
+def invalidate_user_tokens(sender, instance, created, **kwargs):
+    # The cached user may be deactivated or have a new password
+    if not created:
+        token_cache.delete_user(instance.pk)
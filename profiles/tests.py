@@ -1,15 +1,33 @@
+import hashlib
+import io
+import json
+import os
+import pstats
+import tempfile
+import threading
 from pprint import pprint
 
 from django.contrib.auth import get_user_model
 from django.conf import settings
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, connections
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils.http import http_date
+from PIL import Image
 
 from rest_framework import status
 from rest_framework.authtoken.models import Token
 from rest_framework.test import APITestCase
 
-from budgetplanner.models import CategoryType
+from budgetbuddy import metrics
+from budgetplanner.models import CategoryType, Transaction
 from profiles.api.serializers import ProfileSerializer, UserSerializer
+from profiles.authentication import _cache_key, token_cache
+from profiles.avatars import generate_thumbnails, get_avatar_urls
+from profiles.avatars import get_avatar_name, get_thumbnail_name
 from profiles.models import Profile
 
 
@@ -88,9 +106,10 @@ class UserEndpointTestCase(EndpointTestCase):
         response = self.client.get(reverse(self.list_endpoint))
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
-        users = USER_MODEL.objects.exclude(is_superuser=True)
+        users = USER_MODEL.objects.exclude(is_superuser=True) \
+            .order_by('username')
         serializer = UserSerializer(users, many=True)
-        self.assertEqual(serializer.data, response.data)
+        self.assertEqual(serializer.data, response.data['results'])
         self._logout_user()
 
         # Test user access
@@ -103,6 +122,59 @@ class UserEndpointTestCase(EndpointTestCase):
         response = self.client.get(reverse(self.list_endpoint))
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
 
+    def test_user_directory(self):
+        for i in range(4):
+            self._create_user(f'userc{i}', f'userc{i}@gmail.com', 'test1234')
+        USER_MODEL.objects.filter(username='userc3').update(is_active=False)
+        usera = USER_MODEL.objects.get(username=self.usera_creds['username'])
+        category = usera.category_set.first()
+        for amount in [10, 20, 30]:
+            Transaction.objects.create(category=category, amount=amount,
+                                       description='test')
+        self._login_user(self.admin_creds['username'])
+        # Caches the token
+        self.client.get(reverse(self.list_endpoint))
+
+        # Cursor pages, the groups are prefetched for the whole page
+        usernames, url = [], reverse(self.list_endpoint) + '?page_size=2'
+        while url:
+            with self.assertNumQueries(2):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(response.data['results']), 2)
+            usernames += [user['username']
+                          for user in response.data['results']]
+            url = response.data['next']
+        self.assertEqual(usernames, sorted(
+            ['usera', 'userb', 'userc0', 'userc1', 'userc2', 'userc3']))
+
+        response = self.client.get(reverse(self.list_endpoint), {
+            'search': 'userc', 'ordering': '-username', 'is_active': 'true'})
+        self.assertEqual([user['username']
+                          for user in response.data['results']],
+                         ['userc2', 'userc1', 'userc0'])
+        # Case insensitive substring search, and an indexed prefix filter
+        response = self.client.get(reverse(self.list_endpoint),
+                                   {'search': 'SERC'})
+        self.assertEqual(len(response.data['results']), 4)
+        response = self.client.get(reverse(self.list_endpoint),
+                                   {'prefix': 'serc'})
+        self.assertEqual(response.data['results'], [])
+        response = self.client.get(reverse(self.list_endpoint),
+                                   {'prefix': 'userc'})
+        self.assertEqual(len(response.data['results']), 4)
+
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse(self.list_endpoint),
+                                       {'summary': 'true'})
+        summary = {user['username']: user
+                   for user in response.data['results']}
+        self.assertEqual(summary['usera']['category_count'],
+                         usera.category_set.count())
+        self.assertEqual(summary['usera']['transaction_count'], 3)
+        self.assertEqual(summary['userb']['transaction_count'], 0)
+        self._logout_user()
+
     def test_user_retrieve_update(self):
         usera_endpoint = reverse(self.detail_endpoint, kwargs={
                                  'username': self.usera_creds['username']})
@@ -141,6 +213,190 @@ class UserEndpointTestCase(EndpointTestCase):
         response = self.client.delete(usera_endpoint)
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
 
+    def test_metrics(self):
+        metrics.registry.reset()
+        self._login_user(self.admin_creds['username'])
+        self.client.get(reverse(self.list_endpoint))
+        self.client.get(reverse(self.list_endpoint))
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], metrics.CONTENT_TYPE)
+        text = response.content.decode()
+        self.assertIn('budgetbuddy_requests_total{method="GET",status="200",'
+                      'view="UserAPIViewSet.list"} 2', text)
+        self.assertIn('budgetbuddy_request_duration_seconds_bucket{'
+                      'view="UserAPIViewSet.list",le="+Inf"} 2', text)
+        self.assertIn('budgetbuddy_db_queries_count{'
+                      'view="UserAPIViewSet.list"} 2', text)
+
+        # Aggregated with the snapshots of the other worker processes
+        with tempfile.TemporaryDirectory() as directory:
+            other = {
+                'pid': os.getpid() + 1,
+                'values': [['budgetbuddy_requests_total',
+                            [['method', 'GET'], ['status', '200'],
+                             ['view', 'UserAPIViewSet.list']], 3]],
+                'histograms': [],
+            }
+            with open(os.path.join(directory, 'metrics-0.json'), 'w') as f:
+                json.dump(other, f)
+            with self.settings(METRICS=dict(settings.METRICS,
+                                            DIRECTORY=directory)):
+                response = self.client.get(reverse('metrics'))
+            self.assertIn('budgetbuddy_requests_total{method="GET",'
+                          'status="200",view="UserAPIViewSet.list"} 5',
+                          response.content.decode())
+            self.assertIn(f'metrics-{os.getpid()}.json',
+                          os.listdir(directory))
+
+        # Connections opened by other threads are counted too
+        opened, done = threading.Event(), threading.Event()
+
+        def open_connection():
+            connections['default'].ensure_connection()
+            opened.set()
+            done.wait()
+            connections['default'].close()
+
+        count = metrics.count_connections()['default']
+        thread = threading.Thread(target=open_connection)
+        thread.start()
+        opened.wait()
+        try:
+            self.client.get(reverse(self.list_endpoint))
+            response = self.client.get(reverse('metrics'))
+        finally:
+            done.set()
+            thread.join()
+        self.assertIn(f'budgetbuddy_db_connections{{alias="default"}} '
+                      f'{count + 1}', response.content.decode())
+        self._logout_user()
+
+        self._login_user(self.usera_creds['username'])
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self._logout_user()
+
+    def test_cached_token_authentication(self):
+        usera_endpoint = reverse('profiles-detail', kwargs={
+            'user__username': self.usera_creds['username']})
+        token_cache.clear()
+        metrics.registry.reset()
+        self._login_user(self.usera_creds['username'])
+        with CaptureQueriesContext(connection) as miss:
+            response = self.client.get(usera_endpoint)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        with CaptureQueriesContext(connection) as hit:
+            response = self.client.get(usera_endpoint)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(hit), len(miss) - 1)
+        self.assertEqual((token_cache.hits, token_cache.misses), (1, 1))
+
+        # Dropped on password changes and deactivation
+        usera = USER_MODEL.objects.get(username=self.usera_creds['username'])
+        usera.set_password('changed1234')
+        usera.save()
+        self.client.get(usera_endpoint)
+        self.assertEqual((token_cache.hits, token_cache.misses), (1, 2))
+        usera.is_active = False
+        usera.save()
+        response = self.client.get(usera_endpoint)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        usera.is_active = True
+        usera.save()
+
+        # Without a shared cache local entries are short lived
+        with self.settings(TOKEN_AUTH_CACHE=dict(
+                settings.TOKEN_AUTH_CACHE, LOCAL_TIMEOUT=0)):
+            misses = token_cache.misses
+            self.client.get(usera_endpoint)
+            self.client.get(usera_endpoint)
+            self.assertEqual(token_cache.misses, misses + 2)
+
+        # Shared between processes through the cache
+        with self.settings(TOKEN_AUTH_CACHE=dict(
+                settings.TOKEN_AUTH_CACHE, CACHE='default')):
+            self.client.get(usera_endpoint)
+            token_cache.clear()
+            response = self.client.get(usera_endpoint)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(metrics.registry.values[(
+                'budgetbuddy_token_cache_lookups_total',
+                (('result', 'shared_hit'),))], 1)
+            # Only the id and is_active flag are shared, no password hash
+            key = Token.objects.get(user=usera).key
+            self.assertEqual(caches['default'].get(_cache_key(key)),
+                             {'user_id': usera.pk, 'is_active': True})
+
+            # Dropped by another process: local entries are not used
+            misses = token_cache.misses
+            caches['default'].delete(_cache_key(key))
+            response = self.client.get(usera_endpoint)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(token_cache.misses, misses + 1)
+
+            # A user deactivated by another process is not authenticated
+            USER_MODEL.objects.filter(pk=usera.pk).update(is_active=False)
+            token_cache.clear()
+            response = self.client.get(usera_endpoint)
+            self.assertEqual(response.status_code,
+                             status.HTTP_401_UNAUTHORIZED)
+            USER_MODEL.objects.filter(pk=usera.pk).update(is_active=True)
+
+            Token.objects.filter(user=usera).delete()
+            token_cache.clear()
+            response = self.client.get(usera_endpoint)
+            self.assertEqual(response.status_code,
+                             status.HTTP_401_UNAUTHORIZED)
+        self._logout_user()
+
+
+class RequestProfilerTestCase(EndpointTestCase):
+
+    list_endpoint = 'users-list'
+
+    def test_request_profiler(self):
+        with tempfile.TemporaryDirectory() as directory, self.settings(
+                REQUEST_PROFILER=dict(settings.REQUEST_PROFILER,
+                                      DIRECTORY=directory)):
+            # Only staff requests are profiled
+            self._login_user(self.usera_creds['username'])
+            response = self.client.get(reverse('profiles-list'),
+                                       HTTP_X_PROFILE='1')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotIn('X-Profile-Id', response)
+            self.assertEqual(os.listdir(directory), [])
+            response = self.client.get(reverse('profiling-list'))
+            self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+            self._logout_user()
+
+            self._login_user(self.admin_creds['username'])
+            response = self.client.get(reverse(self.list_endpoint))
+            self.assertNotIn('X-Profile-Id', response)
+            response = self.client.get(reverse(self.list_endpoint),
+                                       {'profile': ''})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            profile_id = response['X-Profile-Id']
+
+            response = self.client.get(reverse('profiling-list'))
+            self.assertEqual(len(response.data), 1)
+            self.assertEqual(response.data[0]['id'], profile_id)
+            self.assertEqual(response.data[0]['view'], self.list_endpoint)
+            self.assertEqual(response.data[0]['user'], ADMIN_USERNAME)
+
+            response = self.client.get(
+                reverse('profiling-detail', kwargs={'profile_id': profile_id}))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            stats = os.path.join(directory, 'downloaded.prof')
+            with open(stats, 'wb') as f:
+                f.write(b''.join(response.streaming_content))
+            self.assertTrue(pstats.Stats(stats).total_calls)
+
+            response = self.client.get(
+                reverse('profiling-detail', kwargs={'profile_id': '..'}))
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+            self._logout_user()
+
 
 class ProfileEndpointTestCase(EndpointTestCase):
 
@@ -162,6 +418,36 @@ class ProfileEndpointTestCase(EndpointTestCase):
         response = self.client.get(reverse(self.list_endpoint))
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
 
+    def test_profile_conditional_get(self):
+        usera_endpoint = reverse(self.detail_endpoint, kwargs={
+            'user__username': self.usera_creds['username']})
+
+        self._login_user(self.usera_creds['username'])
+        response = self.client.get(usera_endpoint)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response['ETag']
+        last_modified = response['Last-Modified']
+
+        response = self.client.get(usera_endpoint, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        response = self.client.get(
+            usera_endpoint, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # the list endpoint has its own validators
+        response = self.client.get(
+            reverse(self.list_endpoint), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        profile = Profile.objects.get(
+            user__username=self.usera_creds['username'])
+        profile.bio = 'test_update_bio'
+        profile.save()
+        response = self.client.get(usera_endpoint, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['bio'], 'test_update_bio')
+        self._logout_user()
+
     def test_profile_update(self):
         usera_endpoint = reverse(self.detail_endpoint, kwargs={
                                  'user__username': self.usera_creds['username']})
@@ -203,3 +489,171 @@ class ProfileEndpointTestCase(EndpointTestCase):
         # test anonymous user access
         response = self.client.get(usera_endpoint)
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def _make_image(self, size=(300, 200), color='red', fmt='PNG'):
+        output = io.BytesIO()
+        Image.new('RGB', size, color).save(output, fmt)
+        return output.getvalue()
+
+    def test_profile_avatar(self):
+        content = self._make_image()
+        usera_avatar = reverse('profiles-avatar', kwargs={
+            'user__username': self.usera_creds['username']})
+        userb_avatar = reverse('profiles-avatar', kwargs={
+            'user__username': self.userb_creds['username']})
+
+        with tempfile.TemporaryDirectory() as media_root, self.settings(
+                MEDIA_ROOT=media_root,
+                PROFILE_AVATARS=dict(settings.PROFILE_AVATARS, WORKERS=0)):
+            self._login_user(self.usera_creds['username'])
+            response = self.client.put(usera_avatar, {
+                'avatar': SimpleUploadedFile('a.png', content)},
+                format='multipart')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(sorted(response.data['avatar'], key=int),
+                             ['64', '128', '256'])
+
+            profile = Profile.objects.get(
+                user__username=self.usera_creds['username'])
+            self.assertTrue(profile.avatar_processed)
+            digest = hashlib.sha256(content).hexdigest()
+            self.assertEqual(profile.avatar.name,
+                             f'avatars/{digest[:2]}/{digest}.png')
+            for size in [64, 128, 256]:
+                self.assertTrue(response.data['avatar'][str(size)].endswith(
+                    f'{digest}-{size}.png'))
+                name = get_thumbnail_name(profile.avatar.name, size)
+                with Image.open(os.path.join(media_root, name)) as image:
+                    self.assertEqual(image.size, (size, size))
+
+            # Not an image, and other users can't change the avatar
+            response = self.client.put(usera_avatar, {
+                'avatar': SimpleUploadedFile('a.png', b'text')},
+                format='multipart')
+            self.assertEqual(response.status_code,
+                             status.HTTP_400_BAD_REQUEST)
+            # Too large, in bytes or once decoded
+            limits = [{'MAX_SIZE': len(content) - 1},
+                      {'MAX_PIXELS': 300 * 200 - 1}]
+            for limit in limits:
+                with self.settings(PROFILE_AVATARS=dict(
+                        settings.PROFILE_AVATARS, **limit)):
+                    response = self.client.put(usera_avatar, {
+                        'avatar': SimpleUploadedFile('c.png', content)},
+                        format='multipart')
+                    self.assertEqual(response.status_code,
+                                     status.HTTP_400_BAD_REQUEST)
+            response = self.client.put(userb_avatar, {
+                'avatar': SimpleUploadedFile('a.png', content)},
+                format='multipart')
+            self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+            self._logout_user()
+
+            # The same image uploaded again shares the stored files
+            self._login_user(self.userb_creds['username'])
+            response = self.client.put(userb_avatar, {
+                'avatar': SimpleUploadedFile('b.png', content)},
+                format='multipart')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(
+                Profile.objects.get(
+                    user__username=self.userb_creds['username']).avatar.name,
+                profile.avatar.name)
+            self.assertEqual(
+                len(os.listdir(os.path.join(media_root, 'avatars',
+                                            digest[:2]))), 1)
+            self._logout_user()
+
+    def test_avatar_thumbnails_pending(self):
+        profile = Profile.objects.get(
+            user__username=self.usera_creds['username'])
+        with tempfile.TemporaryDirectory() as media_root, self.settings(
+                MEDIA_ROOT=media_root):
+            content = self._make_image(fmt='JPEG')
+            profile.avatar.name = get_avatar_name(content)
+            profile.avatar.save(profile.avatar.name, ContentFile(content),
+                                save=True)
+            # The original until the thumbnails are generated
+            self.assertFalse(profile.avatar_processed)
+            self.assertEqual(set(get_avatar_urls(profile).values()),
+                             {profile.avatar.url})
+
+            generate_thumbnails(profile.avatar.name)
+            profile.refresh_from_db()
+            self.assertTrue(profile.avatar_processed)
+            self.assertNotIn(profile.avatar.url,
+                             get_avatar_urls(profile).values())
+
+    def test_media_serving(self):
+        content = self._make_image()
+        name = get_avatar_name(content)
+        media = reverse('media', kwargs={'path': name})
+        with tempfile.TemporaryDirectory() as media_root, self.settings(
+                MEDIA_ROOT=media_root):
+            os.makedirs(os.path.dirname(os.path.join(media_root, name)))
+            with open(os.path.join(media_root, name), 'wb') as f:
+                f.write(content)
+            with open(os.path.join(media_root, 'notes.txt'), 'w') as f:
+                f.write('notes')
+
+            response = self.client.get(media)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(b''.join(response.streaming_content), content)
+            self.assertEqual(response['Content-Type'], 'image/png')
+            self.assertEqual(response['Accept-Ranges'], 'bytes')
+            self.assertIn('immutable', response['Cache-Control'])
+            etag, last_modified = response['ETag'], response['Last-Modified']
+            response = self.client.get(reverse('media', kwargs={
+                'path': 'notes.txt'}))
+            self.assertEqual(response['Cache-Control'],
+                             'public, max-age=3600')
+
+            # Conditional requests
+            response = self.client.get(media, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code,
+                             status.HTTP_304_NOT_MODIFIED)
+            response = self.client.get(
+                media, HTTP_IF_MODIFIED_SINCE=last_modified)
+            self.assertEqual(response.status_code,
+                             status.HTTP_304_NOT_MODIFIED)
+            response = self.client.get(
+                media, HTTP_IF_MODIFIED_SINCE=http_date(0))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+            # Ranges
+            size = len(content)
+            response = self.client.get(media, HTTP_RANGE='bytes=0-9')
+            self.assertEqual(response.status_code,
+                             status.HTTP_206_PARTIAL_CONTENT)
+            self.assertEqual(response['Content-Range'], f'bytes 0-9/{size}')
+            self.assertEqual(b''.join(response.streaming_content),
+                             content[:10])
+            response = self.client.get(media, HTTP_RANGE='bytes=-5')
+            self.assertEqual(response['Content-Range'],
+                             f'bytes {size - 5}-{size - 1}/{size}')
+            self.assertEqual(b''.join(response.streaming_content),
+                             content[-5:])
+            response = self.client.get(media, HTTP_RANGE=f'bytes={size}-')
+            self.assertEqual(
+                response.status_code,
+                status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+            self.assertEqual(response['Content-Range'], f'bytes */{size}')
+            # Stale If-Range, the whole file
+            response = self.client.get(media, HTTP_RANGE='bytes=0-9',
+                                       HTTP_IF_RANGE='"stale"')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+            with self.settings(MEDIA_SERVING=dict(
+                    settings.MEDIA_SERVING, OFFLOAD='x-accel-redirect')):
+                response = self.client.get(media)
+                self.assertEqual(response['X-Accel-Redirect'],
+                                 '/protected-media/' + name)
+                self.assertEqual(response.content, b'')
+                self.assertIn('immutable', response['Cache-Control'])
+
+            response = self.client.get(reverse('media', kwargs={
+                'path': '../' + os.path.basename(media_root)}))
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+            response = self.client.get(reverse('media', kwargs={
+                'path': 'avatars/missing.png'}))
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)